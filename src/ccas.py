@@ -4,9 +4,27 @@ This extends "gfs.py"
 No license was provided for "gfs.py" from which this file is based on.
 '''
 import os
+import json
+import random
 import time
+import uuid
+import threading
 import operator
+import collections
+from cStringIO import StringIO
 import ccasutil
+import ccaschunker
+import ccasmanifest
+import ccasindex
+import ccasbloom
+import ccaspool
+import ccascache
+import ccascodec
+import ccaspack
+import ccasrefs
+import ccasmeta
+import ccasplace
+import ccaserasure
 from gfs import GFSClient, GFSMaster, GFSChunkserver
 
 def read_in_chunks(file_object, chunk_size=1024):
@@ -17,223 +35,948 @@ def read_in_chunks(file_object, chunk_size=1024):
         yield data
 
 class CcasClient(GFSClient):
-    def __init__(self, master, debug=0):
+    def __init__(self, master, debug=0, read_window=None, cache_bytes=0):
         self.debug = debug
         self.master = master
+        self.read_window = read_window # chunks in flight while reading, None for one per enabled chunkserver
+        self.cache = ccascache.ChunkCache(cache_bytes) # chunks read back, 0 bytes disables it
 
     def setcontents(self, filename, f, op=None):
-        if op == 'append' and not self.exists(filename):
-            raise Exception("append error, file does not exist: %s" % filename)
-        chunkservers = self.master.get_chunkservers()
-        chunkuuids = []
-        for chunk in read_in_chunks(f, self.master.chunksize):
-            write_copies = 0
-            chunkuuid, write_copies = self.write_one_chunk(chunk, chunkservers)
-            if chunkuuid is not None and write_copies > 0:
-                chunkuuids.append(chunkuuid)
-            else:
-                raise Exception("FAULTED: Chunk %s failed to write anywhere." % (chunkuuid))
-        if len(chunkuuids) > 0:
-            if op == 'append':
-                # TODO appended metadata like file size in a torrent
-                self.master.alloc_append(filename, chunkuuids)
-            elif op == 'write':
-                self.master.alloc(filename, chunkuuids)
+        writer = self.open_writer(filename, op)
+        try:
+            for data in read_in_chunks(f, self.master.chunker.max_size):
+                writer.write(data)
+        except:
+            writer.abort()
+            raise
+        writer.close()
         return
 
+    def open_writer(self, filename, op='write'):
+        return ChunkWriter(self, filename, op)
+
+    def open_overlay(self, filename, chunkmap=None):
+        return FileOverlay(self, filename, chunkmap)
+
+    def write_range(self, filename, offset, data, chunkmap=None):
+        ''' overwrite a range copy on write, only the chunks under it are read
+        and written again and the new manifest shares the rest, return the
+        new chunkmap '''
+        overlay = self.open_overlay(filename, chunkmap)
+        overlay.write(offset, data)
+        return overlay.commit()
+
+    def update(self, filename, chunkmap, size, dirty, read_range):
+        ''' rewrite only the chunks under the dirty (start, end) ranges of a file
+        that is now size bytes, read_range(offset, length) returns its new data,
+        return the new chunkmap '''
+        splices = self.rechunk(chunkmap, size, dirty, read_range)
+        torrent = self.master.read_index(filename)
+        entries = self.master.update_manifest(filename, splices)
+        if torrent:
+            torrent = ccasutil.update_torrent(torrent, size, dirty, read_range)
+        else:
+            builder = ccasutil.TorrentBuilder(os.path.basename(filename.rstrip('/')))
+            for offset in range(0, size, ccasutil.PIECE_LENGTH):
+                builder.update(read_range(offset, min(ccasutil.PIECE_LENGTH, size - offset)))
+            torrent = builder.torrent()
+        self.master.write_index(filename, torrent)
+        return ccasmanifest.ChunkMap([c for c, l in entries], [l for c, l in entries])
+
+    def rechunk(self, chunkmap, size, dirty, read_range):
+        ''' cut new chunks from the start of the first chunk each dirty range
+        touches, until the cuts line up with the old chunks again past it.
+        return (first, last, chunkuuids, chunklens) splices, each replacing
+        the old chunks first to last - 1 '''
+        chunker = self.master.chunker
+        chunkservers = self.master.get_chunkservers()
+        offsets = chunkmap.offsets
+        n = len(chunkmap)
+        dirty = sorted((min(start, size), min(end, size)) for start, end in dirty)
+        splices = []
+        written = []
+        k = 0
+        pos = None # where the last splice stopped
+        try:
+            while k < len(dirty):
+                start, end = dirty[k]
+                k += 1
+                if pos is not None and start <= pos:
+                    continue # the last splice already wrote it, or ran to the end of the file
+                first = chunkmap.find(start) if n else 0
+                pos = offsets[first]
+                last = first
+                chunkuuids = []
+                chunklens = []
+                while pos < size:
+                    data = read_range(pos, chunker.max_size)
+                    if not data:
+                        raise Exception("FAULTED: Short read at %d of %d bytes." % (pos, size))
+                    cut = chunker.cut(data)
+                    chunkuuid = self.store_chunk(data[:cut], chunkservers)
+                    written.append(chunkuuid)
+                    chunkuuids.append(chunkuuid)
+                    chunklens.append(cut)
+                    pos += cut
+                    # ranges the new chunks reached into or end at are part of this splice
+                    while k < len(dirty) and dirty[k][0] <= pos:
+                        end = max(end, dirty[k][1])
+                        k += 1
+                    while last < n and offsets[last + 1] <= pos:
+                        last += 1
+                    if pos >= end and pos < size and last < n and offsets[last] == pos:
+                        break # back in step, the old chunks from here on are unchanged and still in the file
+                else:
+                    last = n
+                splices.append((first, last, chunkuuids, chunklens))
+        except:
+            self.master.release_chunks(written)
+            raise
+        return splices
+
     def write(self, filename, data): # filename is full namespace path
         if self.exists(filename): # if already exists, overwrite
             self.delete(filename)
-        # track metadata like file size in a torrent
-        if filename.startswith('/'): filename = filename[1:]
-        local_filename = os.path.join(self.master.index_path, filename)
-        torrent_info_path = ccasutil.write_torrent(local_filename, data, self.master.tmp_path)
-        self.master.write_catalog(filename, torrent_info_path)
-        chunkuuids = self.write_chunks(data)
-        self.master.alloc(filename, chunkuuids)
+        self.setcontents(filename, StringIO(data), op='write')
 
     def write_one_chunk(self, chunk, chunkservers):
         write_copies = 0
-        chunkuuid = ccasutil.hashdata(chunk)
-        chunkloc = self.master.new_chunkloc(chunkuuid)
-        if self.master.write_algorithm == 'stripe':
-            while not chunkservers[chunkloc].enabled:
+        chunkuuid = self.master.hashdata(chunk)
+        # compressed once, whichever chunkserver gets to it first
+        encoded = ccascodec.Encoder(chunk, self.master.compression, self.master.compress_threshold)
+        self.master.claim_chunk(chunkuuid)
+        try:
+            if self.master.write_algorithm == 'stripe':
+                # the master's placement policy picks the location, and another
+                # one for each chunkserver that fails. the write goes through the
+                # chunkserver's workers so policies see how busy each one is
+                tried = []
                 chunkloc = self.master.new_chunkloc(chunkuuid)
-            resp = chunkservers[chunkloc].write(chunkuuid, chunk)
-            if resp is not None:
-                write_copies += 1
-            else:
-                if self.debug > 0: print "Failed to write %s%s, consider checking the disk." % (chunkservers[chunkloc].local_filesystem_root, chunkuuid)
-                for i in chunkservers:
-                    # retry on another chunkserver but let master decide the location
-                    # retryloc = i
-                    retryloc = self.master.new_chunkloc(chunkuuid)
-                    while not chunkservers[retryloc].enabled:
-                        retryloc = self.master.new_chunkloc(chunkuuid)
-                    resp = chunkservers[retryloc].write(chunkuuid, chunk)
+                while chunkloc is not None:
+                    try:
+                        resp = chunkservers[chunkloc].pool.submit(chunkservers[chunkloc].write, chunkuuid, chunk, encoded).result()
+                    except:
+                        resp = None
                     if resp is not None:
-                        print "Rewrote to %s%s." % (chunkservers[retryloc].local_filesystem_root, chunkuuid)
+                        if tried:
+                            print "Rewrote to %s%s." % (chunkservers[chunkloc].local_filesystem_root, chunkuuid)
                         write_copies += 1
-                        chunkuuids.append(chunkuuid)
+                        self.master.add_chunkloc(chunkuuid, chunkloc)
                         break
-                    else:
-                        if self.debug > 0: print "Failed to write %s%s, consider checking the disk." % (chunkservers[retryloc].local_filesystem_root, chunkuuid)
-        elif self.master.write_algorithm == 'mirror':
-            for j in range(0, len(chunkservers)):
-                if chunkservers[j].enabled:
-                    resp = chunkservers[j].write(chunkuuid, chunk)
-                    if resp is not None:
-                        write_copies += 1
-                    else:
-                        if self.debug > 0: print "Failed to write a copy to %s%s, consider checking the disk." % (chunkservers[j].local_filesystem_root, chunkuuid)
-        if write_copies < 1:
-            raise Exception("FAULTED: Chunk %s failed to write anywhere." % (chunkuuid))
+                    if self.debug > 0: print "Failed to write %s%s, consider checking the disk." % (chunkservers[chunkloc].local_filesystem_root, chunkuuid)
+                    tried.append(chunkloc)
+                    chunkloc = self.master.new_chunkloc(chunkuuid, tried)
+            elif self.master.write_algorithm == 'mirror':
+                # write every copy at once, each disk has its own workers
+                futures = {}
+                for j in range(0, len(chunkservers)):
+                    if chunkservers[j].enabled:
+                        futures[j] = chunkservers[j].pool.submit(chunkservers[j].write, chunkuuid, chunk, encoded)
+                quorum = self.master.write_quorum
+                if quorum is not None and quorum > len(futures):
+                    # no more copies than enabled chunkservers can be written
+                    if self.debug > 0: print "Chunk %s can only have %d of %d copies, %d chunkservers are enabled." % (chunkuuid, len(futures), quorum, len(futures))
+                    quorum = len(futures)
+                write_copies = self.wait_for_copies(chunkuuid, futures, quorum or len(futures))
+                if quorum is not None and write_copies < quorum:
+                    raise Exception("FAULTED: Chunk %s only has %d of %d copies." % (chunkuuid, write_copies, quorum))
+            elif self.master.write_algorithm == 'erasure':
+                write_copies = self.write_shards(chunkuuid, chunk, chunkservers)
+                if write_copies < self.master.data_shards:
+                    raise Exception("FAULTED: Chunk %s only has %d of %d shards." % (chunkuuid, write_copies, self.master.data_shards + self.master.parity_shards))
+            if write_copies < 1:
+                raise Exception("FAULTED: Chunk %s failed to write anywhere." % (chunkuuid))
+        except:
+            # no file will hold it, the gc and reclaim can have it again
+            self.master.release_chunks([chunkuuid])
+            raise
         return chunkuuid, write_copies
 
 
+    def write_shards(self, chunkuuid, chunk, chunkservers):
+        ''' erasure code chunk and write a shard to each of as many
+        chunkservers, return how many shards were written '''
+        k, m = self.master.data_shards, self.master.parity_shards
+        indexed = self.master.get_chunklocs(chunkuuid)
+        if len(indexed) >= k:
+            # already stored, like a chunkserver skipping a chunk it has
+            return len(indexed)
+        enabled = len([i for i in chunkservers if chunkservers[i].enabled])
+        if enabled < k + m:
+            raise Exception("FAULTED: Chunk %s needs %d chunkservers for its shards, only %d are enabled." % (chunkuuid, k + m, enabled))
+        shards = ccaserasure.encode(chunk, k, m)
+        chunklocs = self.master.new_chunklocs(chunkuuid, len(shards))
+        # a shard goes over whatever is there, the chunkserver cannot tell shards apart by name
+        futures = [(i, chunkloc, chunkservers[chunkloc].pool.submit(chunkservers[chunkloc].rewrite, chunkuuid, shards[i])) \
+                    for i, chunkloc in enumerate(chunklocs)]
+        used = list(chunklocs)
+        written = 0
+        for i, chunkloc, future in futures:
+            resp = future.result()
+            while resp is None:
+                if self.debug > 0: print "Failed to write shard %d of %s%s, consider checking the disk." % (i, chunkservers[chunkloc].local_filesystem_root, chunkuuid)
+                # retry on a chunkserver without another shard of this chunk
+                chunkloc = self.master.new_chunkloc(chunkuuid, used)
+                if chunkloc is None:
+                    break
+                used.append(chunkloc)
+                resp = chunkservers[chunkloc].rewrite(chunkuuid, shards[i])
+            if resp is not None:
+                written += 1
+                self.master.add_chunkloc(chunkuuid, chunkloc)
+        if written < len(shards):
+            if self.debug > 0: print "Chunk %s only has %d of %d shards, consider checking the disks." % (chunkuuid, written, len(shards))
+        return written
+
+    def wait_for_copies(self, chunkuuid, futures, quorum):
+        ''' wait until quorum copies are written or every write is done,
+        writes still running finish in the background '''
+        chunkservers = self.master.get_chunkservers()
+        done = threading.Condition()
+        state = {'copies': 0, 'finished': 0}
+        def on_done(future, j):
+            try:
+                resp = future.result()
+            except:
+                resp = None
+            if resp is not None:
+                self.master.add_chunkloc(chunkuuid, j)
+            else:
+                if self.debug > 0: print "Failed to write a copy to %s%s, consider checking the disk." % (chunkservers[j].local_filesystem_root, chunkuuid)
+            with done:
+                if resp is not None:
+                    state['copies'] += 1
+                state['finished'] += 1
+                done.notify()
+        for j in futures:
+            futures[j].add_done_callback(lambda future, j=j: on_done(future, j))
+        with done:
+            while state['copies'] < quorum and state['finished'] < len(futures):
+                done.wait()
+            return state['copies']
+
+    def store_chunk(self, chunk, chunkservers):
+        chunkuuid, write_copies = self.write_one_chunk(chunk, chunkservers)
+        if chunkuuid is None or write_copies < 1:
+            raise Exception("FAULTED: Chunk %s failed to write anywhere." % (chunkuuid))
+        return chunkuuid
+
     def write_chunks(self, data):
-        chunks = [ data[x:x+self.master.chunksize] \
-            for x in range(0, len(data), self.master.chunksize) ]
         chunkservers = self.master.get_chunkservers()
         chunkuuids = []
-        for i in range(0, len(chunks)):
-            chunkuuid, write_copies = self.write_one_chunk(chunks[i], chunkservers)
+        chunklens = []
+        for chunk in self.master.chunker.chunks(StringIO(data)):
+            chunkuuid, write_copies = self.write_one_chunk(chunk, chunkservers)
             if chunkuuid is not None and write_copies > 0:
                 chunkuuids.append(chunkuuid)
+                chunklens.append(len(chunk))
             else:
                 raise Exception("FAULTED: Chunk %s failed to write anywhere." % (chunkuuid))
-        return chunkuuids
+        return chunkuuids, chunklens
 
     def num_chunks(self, size):
         return (size // self.master.chunksize) \
             + (1 if size % self.master.chunksize > 0 else 0)
 
     def write_append(self, filename, data):
-        if not self.exists(filename):
-            raise Exception("append error, file does not exist: %s" % filename)
-        append_chunkuuids = self.write_chunks(data)
-        # TODO appended metadata like file size in a torrent
-        self.master.alloc_append(filename, append_chunkuuids)
+        self.setcontents(filename, StringIO(data), op='append')
 
     def exists(self, filename):
         return self.master.exists(filename)
 
-    def read_chunk(self, filename, length=None):
-        # TODO file-like
-        pass
-
-    def read_all(self, filename, length=None): # get metadata, then read chunks direct
+    def chunkmap(self, filename):
         if not self.exists(filename):
             raise Exception("read error, file does not exist: %s" % filename)
-        chunks = []
-        chunkuuids = self.master.get_chunkuuids(filename)
+        return self.master.get_chunkmap(filename)
+
+    def getsize(self, filename):
+        return self.chunkmap(filename).size
+
+    def read_chunk(self, filename, offset, length=None, chunkmap=None):
+        # file-like reads go through read_range
+        return self.read_range(filename, offset, length, chunkmap=chunkmap)
+
+    def read_range(self, filename, offset, length=None, chunkmap=None): # only read the chunks under the range
+        if chunkmap is None:
+            chunkmap = self.chunkmap(filename)
+        if length is None or offset + length > chunkmap.size:
+            length = max(chunkmap.size - offset, 0)
+        if length <= 0:
+            return ''
+        slices = []
+        i = chunkmap.find(offset)
+        end = offset + length
+        for chunk in self.iter_chunks(filename, i, chunkmap.find(end - 1) + 1, chunkmap=chunkmap):
+            chunkstart = chunkmap.offsets[i]
+            slices.append(chunk[offset - chunkstart:end - chunkstart])
+            offset = chunkmap.offsets[i + 1]
+            i += 1
+        return ''.join(slices)
+
+    def iter_chunks(self, filename, first=0, last=None, chunkmap=None, window=None):
+        ''' yield chunks first to last in order, while the next ones are read
+        and verified in parallel on the chunkservers holding them '''
+        if chunkmap is None:
+            chunkmap = self.chunkmap(filename)
+        if last is None:
+            last = len(chunkmap)
         chunkservers = self.master.get_chunkservers()
-        for chunkuuid in chunkuuids:
-            read_copies = 0
-            chunkloc = self.master.get_chunkloc(chunkuuid)
+        if window is None:
+            window = self.read_window
+        if window is None:
+            window = len([i for i in chunkservers if chunkservers[i].enabled])
+        pending = collections.deque()
+        i = first
+        while i < last or pending:
+            while i < last and len(pending) < max(window, 1):
+                chunkuuid = chunkmap.chunkuuids[i]
+                i += 1
+                chunk = self.cache.get(chunkuuid)
+                if chunk is not None:
+                    pending.append(ccaspool.completed(chunk))
+                    continue
+                indexed = self.master.get_chunklocs(chunkuuid)
+                chunkloc = (indexed + self.master.get_probe_chunklocs(chunkuuid, indexed))[0]
+                pending.append(chunkservers[chunkloc].pool.submit(self.read_one_chunk, chunkuuid, chunkservers, indexed))
+            yield pending.popleft().result()
+
+    def read_one_chunk(self, chunkuuid, chunkservers, indexed=None):
+        ''' read and verify one chunk as the master's verify policy says,
+        iter_chunks checks the cache first '''
+        if indexed is None:
+            indexed = self.master.get_chunklocs(chunkuuid)
+        bad = [] # copies to write back once a good one is found
+        shards = {} # shape to shard index to the good shards read so far, when the chunk is erasure coded
+        # indexed locations first, then probe the rest in case the index is stale
+        chunklocs = indexed + self.master.get_probe_chunklocs(chunkuuid, indexed)
+        for n, chunkloc in enumerate(chunklocs):
             chunk = chunkservers[chunkloc].read(chunkuuid)
             # verify data
-            if chunk is not None:
-                if chunkuuid == ccasutil.hashdata(chunk):
-                    read_copies += 1
+            if chunk is None:
+                if chunkloc in indexed:
+                    if self.debug > 0: print "Chunk %s%s is missing, consider checking the disk." % (chunkservers[chunkloc].local_filesystem_root, chunkuuid)
+                    self.master.remove_chunkloc(chunkuuid, chunkloc)
+                    bad.append(chunkloc)
+            elif self.master.is_shard(chunkuuid, chunk):
+                shard = ccaserasure.parse(chunk)
+                if shard is None:
+                    if self.debug > 0: print "Shard %s%s failed its crc, consider checking the disk." % (chunkservers[chunkloc].local_filesystem_root, chunkuuid)
+                    bad.append(chunkloc)
+                    continue
+                if chunkloc not in indexed:
+                    self.master.add_chunkloc(chunkuuid, chunkloc)
+                shape = shard.shape()
+                found = shards.setdefault(shape, {})
+                found[shard.index] = shard
+                if len(found) < shard.k:
+                    continue
+                chunk = ccaserasure.decode(found.values())
+                if self.master.verify_on_read() and chunkuuid != self.master.hashdata(chunk):
+                    if self.debug > 0: print "Chunk %s failed verification after decoding, consider checking the disks." % (chunkuuid)
+                    continue
+                if bad:
+                    # the shard indexes still there, so the lost ones are written back
+                    for rest in chunklocs[n + 1:]:
+                        data = chunkservers[rest].read(chunkuuid)
+                        shard = ccaserasure.parse(data)
+                        if shard is not None:
+                            if shard.shape() == shape:
+                                found[shard.index] = shard
+                        elif data is None and rest in indexed:
+                            self.master.remove_chunkloc(chunkuuid, rest)
+                            bad.append(rest)
+                        elif self.master.is_shard(chunkuuid, data):
+                            bad.append(rest)
+                    self.master.repair_shards(chunkuuid, chunk, shape, found, bad)
+                self.cache.put(chunkuuid, chunk)
+                return chunk
+            elif not self.master.verify_on_read() or chunkuuid == self.master.hashdata(chunk):
+                if chunkloc not in indexed:
+                    if self.debug > 0: print "Found a good copy at %s%s." % (chunkservers[chunkloc].local_filesystem_root, chunkuuid)
+                    self.master.add_chunkloc(chunkuuid, chunkloc)
+                if bad:
+                    self.master.repair_chunk(chunkuuid, chunk, bad)
+                self.cache.put(chunkuuid, chunk)
+                return chunk
             else:
                 if self.debug > 0: print "Chunk %s%s failed verification, consider checking the disk." % (chunkservers[chunkloc].local_filesystem_root, chunkuuid)
-                for i in chunkservers:
-                    # retry on another chunkserver but let master decide the location
-                    # retryloc = i
-                    retryloc = self.master.get_retryloc(chunkuuid)
-                    while not chunkservers[retryloc].enabled:
-                        retryloc = self.master.get_retryloc(chunkuuid)
-                    chunk = chunkservers[retryloc].read(chunkuuid)
-                    if chunk is not None:
-                        if chunkuuid == ccasutil.hashdata(chunk):
-                            if self.debug > 0: print "Found a good copy at %s%s." % (chunkservers[retryloc].local_filesystem_root, chunkuuid)
-                            read_copies += 1
-                            chunks.append(chunk)
-                            break
-                        else:
-                            if self.debug > 0: print "Chunk %s%s failed verification, consider checking the disk." % (chunkservers[retryloc].local_filesystem_root, chunkuuid)
-            if read_copies > 0:
-                chunks.append(chunk)
-            else:
-                raise Exception("FAULTED: Chunk %s failed to verify anywhere." % (chunkuuid))
-        data = reduce(lambda x, y: x + y, chunks) # reassemble in order
-        return data
+                bad.append(chunkloc)
+        raise Exception("FAULTED: Chunk %s failed to verify anywhere." % (chunkuuid))
+
+    def open_stream(self, filename, offset=0, chunkmap=None):
+        return ChunkStream(self, filename, offset, chunkmap=chunkmap)
+
+    def read_all(self, filename, length=None): # get metadata, then read chunks direct
+        stream = self.open_stream(filename)
+        try:
+            return ''.join(stream) # reassemble in order
+        finally:
+            stream.close()
+
+    def cache_stats(self):
+        return self.cache.stats()
 
     def delete(self, filename):
         self.master.delete(filename)
 
+    def rename(self, old_path, new_path):
+        self.master.rename(old_path, new_path)
+
+
+class ChunkStream(object):
+    ''' read a file front to back, holding no more than the read window of chunks '''
+    def __init__(self, client, filename, offset=0, chunkmap=None):
+        if chunkmap is None:
+            chunkmap = client.chunkmap(filename)
+        self.filename = filename
+        self.size = chunkmap.size
+        self._pos = min(max(offset, 0), self.size)
+        self._chunk = ''
+        self._chunkpos = 0
+        self._skip = 0 # where offset falls in the first chunk
+        self._chunks = iter([])
+        if self._pos < self.size:
+            i = chunkmap.find(self._pos)
+            self._skip = self._pos - chunkmap.offsets[i]
+            self._chunks = client.iter_chunks(filename, i, chunkmap=chunkmap)
+
+    def _next_piece(self, limit=None):
+        ''' the rest of the current chunk, or up to limit bytes of it '''
+        while self._chunkpos >= len(self._chunk):
+            try:
+                self._chunk = self._chunks.next()
+            except StopIteration:
+                self._chunk = ''
+                self._chunkpos = 0
+                return ''
+            self._chunkpos = self._skip
+            self._skip = 0
+        end = len(self._chunk)
+        if limit is not None:
+            end = min(end, self._chunkpos + limit)
+        if self._chunkpos == 0 and end == len(self._chunk):
+            piece = self._chunk # whole chunk, no copy
+        else:
+            piece = self._chunk[self._chunkpos:end]
+        self._chunkpos = end
+        self._pos += len(piece)
+        return piece
+
+    def __iter__(self):
+        while True:
+            piece = self._next_piece()
+            if not piece:
+                break
+            yield piece
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(self)
+        pieces = []
+        while size > 0:
+            piece = self._next_piece(size)
+            if not piece:
+                break
+            pieces.append(piece)
+            size -= len(piece)
+        return ''.join(pieces)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        self._chunk = ''
+
+
+
+class ChunkWriter(object):
+    ''' write a file front to back, each chunk goes to the chunkservers as
+    soon as it can be cut, only the tail of the current chunk is held '''
+    def __init__(self, client, filename, op='write'):
+        if op == 'append' and not client.exists(filename):
+            raise Exception("append error, file does not exist: %s" % filename)
+        self.client = client
+        self.filename = filename
+        self.op = op
+        # track metadata like file size in a torrent, in the same pass as the chunking
+        if op == 'append':
+            torrent = client.master.read_index(filename)
+            chunkmap = client.chunkmap(filename)
+            self.builder = ccasutil.TorrentBuilder.resume(torrent, lambda offset, length: client.read_range(filename, offset, length, chunkmap=chunkmap))
+        else:
+            self.builder = ccasutil.TorrentBuilder(os.path.basename(filename.rstrip('/')))
+        self.chunker = client.master.chunker
+        self.chunkservers = client.master.get_chunkservers()
+        self.chunkuuids = []
+        self.chunklens = []
+        self._pieces = [] # the tail not cut into a chunk yet
+        self._buffered = 0
+        self._pos = 0
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to a closed ChunkWriter: %s" % self.filename)
+        if not data:
+            return
+        try:
+            self.builder.update(data)
+            self._pieces.append(data)
+            self._buffered += len(data)
+            self._pos += len(data)
+            if self._buffered >= self.chunker.max_size:
+                self._emit()
+        except:
+            self.abort()
+            raise
+
+    def _emit(self, eof=False):
+        ''' write every chunk that can be cut, the same cuts Chunker.chunks() makes '''
+        data = ''.join(self._pieces)
+        max_size = self.chunker.max_size
+        start = 0
+        while len(data) - start >= max_size or (eof and start < len(data)):
+            cut = self.chunker.cut(data[start:start + max_size])
+            self.chunkuuids.append(self.client.store_chunk(data[start:start + cut], self.chunkservers))
+            self.chunklens.append(cut)
+            start += cut
+        self._pieces = [data[start:]] if start < len(data) else []
+        self._buffered = len(data) - start
+
+    def tell(self):
+        return self._pos
+
+    def readback(self, f):
+        ''' copy what was written so far into f, chunks read back from the chunkservers '''
+        if self.chunkuuids:
+            chunkmap = ccasmanifest.ChunkMap(self.chunkuuids, self.chunklens)
+            for chunk in self.client.iter_chunks(self.filename, chunkmap=chunkmap):
+                f.write(chunk)
+        for piece in self._pieces:
+            f.write(piece)
+
+    def abort(self):
+        ''' give up, the chunks already written can be reclaimed again '''
+        if not self.closed:
+            self.closed = True
+            self.client.master.release_chunks(self.chunkuuids)
+            self._pieces = []
+            self._buffered = 0
+
+    def close(self):
+        ''' write the tail and allocate the file '''
+        if self.closed:
+            return
+        try:
+            self._emit(eof=True)
+        except:
+            self.abort()
+            raise
+        self.closed = True
+        master = self.client.master
+        if self.op == 'append':
+            if len(self.chunkuuids) > 0:
+                master.alloc_append(self.filename, self.chunkuuids, self.chunklens)
+                master.write_index(self.filename, self.builder.torrent())
+        elif self.op == 'write':
+            master.alloc(self.filename, self.chunkuuids, self.chunklens)
+            master.write_index(self.filename, self.builder.torrent())
+
+
+
+class FileOverlay(object):
+    ''' writes laid over a stored file, kept until commit() splices them in.
+    reads only fetch the stored chunks under them, and hold on to those for
+    the next read in order '''
+    def __init__(self, client, filename, chunkmap=None):
+        if chunkmap is None:
+            chunkmap = client.chunkmap(filename)
+        self.client = client
+        self.filename = filename
+        self.reset(chunkmap)
+
+    def reset(self, chunkmap):
+        self.chunkmap = chunkmap
+        self.size = chunkmap.size
+        self.stored = chunkmap.size # stored bytes past a truncate read as zeros
+        self.writes = [] # [offset, pieces, length] in the order written
+        self.truncated = None # (start, end) covering every truncate since the last commit
+        self._held = {} # chunk index to chunk
+
+    def write(self, offset, data):
+        if not data:
+            return
+        last = self.writes[-1] if self.writes else None
+        if last is not None and last[0] + last[2] == offset:
+            # sequential writes grow one range
+            last[1].append(data)
+            last[2] += len(data)
+        else:
+            self.writes.append([offset, [data], len(data)])
+        self.size = max(self.size, offset + len(data))
+
+    def truncate(self, size):
+        writes = []
+        for offset, pieces, length in self.writes:
+            if offset >= size:
+                continue
+            if offset + length > size:
+                pieces = [''.join(pieces)[:size - offset]]
+                length = size - offset
+            writes.append([offset, pieces, length])
+        self.writes = writes
+        start, end = min(size, self.size), max(size, self.size, self.chunkmap.size)
+        if self.truncated is not None:
+            start, end = min(start, self.truncated[0]), max(end, self.truncated[1])
+        self.truncated = (start, end)
+        self.stored = min(self.stored, size)
+        self.size = size
+
+    def dirty(self):
+        dirty = [(offset, offset + length) for offset, pieces, length in self.writes]
+        if self.truncated is not None:
+            dirty.append(self.truncated)
+        # nothing past the end of the file is left to write
+        return [(start, min(end, self.size)) for start, end in dirty if start <= self.size]
+
+    def _read_stored(self, offset, end):
+        chunkmap = self.chunkmap
+        first = chunkmap.find(offset)
+        last = chunkmap.find(end - 1) + 1
+        held = dict((i, chunk) for i, chunk in self._held.iteritems() if first <= i < last)
+        missing = [i for i in range(first, last) if i not in held]
+        if missing:
+            i = missing[0]
+            for chunk in self.client.iter_chunks(self.filename, missing[0], missing[-1] + 1, chunkmap=chunkmap):
+                held[i] = chunk
+                i += 1
+        self._held = held
+        start = chunkmap.offsets[first]
+        return ''.join(held[i] for i in range(first, last))[offset - start:end - start]
+
+    def read(self, offset, length=None):
+        end = self.size if length is None else min(offset + length, self.size)
+        if offset >= end:
+            return ''
+        stored_end = min(end, self.stored)
+        data = bytearray(self._read_stored(offset, stored_end) if offset < stored_end else '')
+        data.extend('\x00' * (end - offset - len(data)))
+        for woffset, pieces, wlength in self.writes:
+            lo = max(offset, woffset)
+            hi = min(end, woffset + wlength)
+            if lo < hi:
+                if len(pieces) > 1:
+                    pieces[:] = [''.join(pieces)]
+                data[lo - offset:hi - offset] = pieces[0][lo - woffset:hi - woffset]
+        return str(data)
+
+    def commit(self):
+        ''' write the chunks under the writes, return the new chunkmap '''
+        if self.writes or self.truncated is not None:
+            self.reset(self.client.update(self.filename, self.chunkmap, self.size, self.dirty(), self.read))
+        return self.chunkmap
+
 
 class CcasMaster(GFSMaster):
-    def __init__(self, root_path_array, manifest_path, index_path, catalog_path, tmp_path, write_algorithm='mirror', chunksize=10, debug=0):
+    def __init__(self, root_path_array, manifest_path, index_path, catalog_path, tmp_path, write_algorithm='mirror', chunksize=10, debug=0, chunker='fixed', min_chunksize=None, max_chunksize=None, manifest_format='binary', chunkloc_path=None, write_verify=False, io_workers=1, write_quorum=None, compression=None, compress_threshold=0.9, chunkserver_backend='files', pack_size=ccaspack.PACK_SIZE, refcount_path=None, reclaim_on_delete=False, metadata_backend='files', metadata_path=None, hash_algorithm=None, verify='always', verify_sample=0.1, placement='round-robin', data_shards=4, parity_shards=2):
         self.debug = debug
         self.num_chunkservers = len(root_path_array) # number of disks
         self.root_path_array = root_path_array
-        if write_algorithm in ('stripe','mirror'):
-            self.write_algorithm = write_algorithm # stripe, mirror...
+        if write_algorithm in ('stripe','mirror','erasure'):
+            self.write_algorithm = write_algorithm # stripe, mirror, erasure...
         else:
             self.write_algorithm = 'mirror' # default to mirror for data safety
+        ccaserasure.check_shape(data_shards, parity_shards)
+        self.data_shards = data_shards # erasure splits each chunk into this many shards
+        self.parity_shards = parity_shards # and adds this many, any data_shards of them read it back
         self.manifest_path = manifest_path
         self.catalog_path = catalog_path
         self.index_path = index_path
         self.tmp_path = tmp_path
-        self.chunksize = chunksize
-        self.chunkrobin = 0
+        self.meta_path = os.path.dirname(os.path.normpath(manifest_path))
+        self.chunksize = chunksize # average chunksize when chunker is 'cdc'
+        self.write_verify = write_verify # re-hash chunks that already exist before skipping a write
+        self.io_workers = io_workers # threads per chunkserver
+        ccascodec.check_codec(compression)
+        self.compression = compression # None, 'zlib', 'bz2' or 'lzma'
+        self.compress_threshold = compress_threshold # store raw unless compressed is smaller than this fraction
+        if chunkserver_backend in ('files','pack'):
+            self.chunkserver_backend = chunkserver_backend # pack suits many small chunks
+        else:
+            raise ValueError("chunkserver_backend should be 'files' (default) or 'pack'")
+        self.pack_size = pack_size
+        self.chunker = ccaschunker.new_chunker(chunker, chunksize, min_chunksize, max_chunksize)
+        if manifest_format in ('binary','text'):
+            self.manifest_format = manifest_format # text is the older format
+        else:
+            raise ValueError("manifest_format should be 'binary' (default) or 'text'")
+        self.chunkrobin = 0 # rotates reads over mirrors
+        self.placement = ccasplace.new_placement(placement) # picks the chunkserver for each striped chunk
         self.chunkservers = {} # loc id to chunkserver mapping
         self.init_chunkservers()
+        if write_quorum is not None and not 0 < write_quorum <= self.num_chunkservers:
+            # checked against every disk, writes wait for fewer when some are disabled
+            raise ValueError("write_quorum should be between 1 and the number of chunkservers")
+        if self.write_algorithm == 'erasure' and data_shards + parity_shards > self.num_chunkservers:
+            # checked against every disk, a store missing some still opens to be read and repaired
+            raise ValueError("erasure needs a chunkserver for each of the data_shards + parity_shards shards")
+        self.write_quorum = write_quorum # mirror copies to wait for, None waits for all of them
+        if chunkloc_path is None:
+            chunkloc_path = os.path.join(self.meta_path, 'chunkloc.db')
+        self.chunklocs = ccasindex.ChunkLocationIndex(chunkloc_path, debug=self.debug) # chunkuuid to chunkloc mapping
+        if self.chunklocs.created:
+            self.chunklocs.rebuild(self.chunkservers)
+        self.hash_algorithm = self.init_hash_algorithm(hash_algorithm) # chunkuuids are hex digests of this
+        if verify in ('always','sampled','scrub'):
+            self.verify = verify # hash chunks on every read, some reads, or only when scrubbing
+        else:
+            raise ValueError("verify should be 'always' (default), 'sampled' or 'scrub'")
+        self.verify_sample = verify_sample # fraction of reads hashed when verify is 'sampled'
+        if metadata_backend == 'sqlite':
+            if metadata_path is None:
+                metadata_path = os.path.join(self.meta_path, 'metadata.db')
+            self.metadata = ccasmeta.MetadataDB(metadata_path, debug=self.debug) # namespace, torrents and manifests in one db
+            if self.metadata.created:
+                self.migrate_metadata()
+        elif metadata_backend == 'files':
+            self.metadata = None # manifest, index and catalog trees
+        else:
+            raise ValueError("metadata_backend should be 'files' (default) or 'sqlite'")
+        if refcount_path is None:
+            refcount_path = os.path.join(self.meta_path, 'refcount.db')
+        self.refs = ccasrefs.RefCounts(refcount_path, debug=self.debug) # chunkuuid to number of manifests using it
+        if self.refs.created:
+            self.refs.rebuild(self.iter_manifests())
+        self.reclaim_on_delete = reclaim_on_delete # reclaim unreferenced chunks as soon as a file is deleted
+        self.claimed = collections.Counter() # chunks written for files not allocated yet
+        self.released = None # claims given up while a collection checks leaked counts, else None
+
+    def init_hash_algorithm(self, hash_algorithm):
+        ''' the store keeps the hash it was created with, its chunkuuids depend on it '''
+        store_path = os.path.join(self.meta_path, 'store.json')
+        store = {}
+        if os.path.isfile(store_path):
+            with open(store_path, 'r') as f:
+                store = json.load(f)
+        elif len(self.chunklocs) > 0:
+            # chunks written before the hash was recorded
+            store['hash_algorithm'] = ccasutil.DEFAULT_HASH
+        recorded = store.get('hash_algorithm')
+        if recorded is None:
+            recorded = hash_algorithm or ccasutil.DEFAULT_HASH
+        elif hash_algorithm is not None and hash_algorithm != recorded:
+            raise ValueError("hash_algorithm %s does not match the %s this store was created with" % (hash_algorithm, recorded))
+        ccasutil.check_hash(recorded)
+        if not os.path.isfile(store_path):
+            store['hash_algorithm'] = recorded
+            tmp_path = "%s.%s.tmp" % (store_path, uuid.uuid4().hex)
+            with open(tmp_path, 'w') as f:
+                json.dump(store, f)
+            os.rename(tmp_path, store_path)
+        return str(recorded)
+
+    def hashdata(self, data):
+        return ccasutil.hashdata(data, self.hash_algorithm)
+
+    def verify_on_read(self):
+        if self.verify == 'always':
+            return True
+        if self.verify == 'sampled':
+            return random.random() < self.verify_sample
+        return False
+
+    def is_shard(self, chunkuuid, chunk):
+        ''' whether a chunk read back is an erasure coded shard. only an
+        erasure store decodes shards, and there a whole chunk that starts
+        like one is told apart by its hash '''
+        if self.write_algorithm != 'erasure' or not ccaserasure.is_shard(chunk):
+            return False
+        return ccaserasure.parse(chunk) is not None or chunkuuid != self.hashdata(chunk)
 
     def init_chunkservers(self):
         for i in range(0, self.num_chunkservers):
-            chunkserver = CcasChunkserver(self.root_path_array[i], debug=self.debug)
+            kwargs = dict(write_verify=self.write_verify, io_workers=self.io_workers, \
+                        compression=self.compression, compress_threshold=self.compress_threshold, debug=self.debug)
+            if self.chunkserver_backend == 'pack':
+                chunkserver = CcasPackChunkserver(self.root_path_array[i], pack_size=self.pack_size, **kwargs)
+            else:
+                chunkserver = CcasChunkserver(self.root_path_array[i], **kwargs)
             self.chunkservers[i] = chunkserver
         return
 
     def get_chunkservers(self):
         return self.chunkservers
 
-    def alloc(self, filename, chunkuuids): # save to manifest
-        self.write_manifest(filename, chunkuuids)
+    def alloc(self, filename, chunkuuids, chunklens=None): # save to manifest
+        replaced = []
+        if self.exists(filename):
+            replaced = self.read_manifest(filename)
+        # count references before the manifest exists, release them after it is gone
+        self.refs.adjust(increments=chunkuuids)
+        try:
+            self.write_manifest(filename, chunkuuids, chunklens)
+        finally:
+            # claimed until the manifest is there for a collection to find
+            self.release_chunks(chunkuuids)
+        if replaced:
+            self.refs.adjust(decrements=replaced)
+        self.chunklocs.commit()
         return
 
-    def alloc_append(self, filename, append_chunkuuids): # append chunks
-        chunkuuids = self.read_manifest(filename)
-        chunkuuids.extend(append_chunkuuids)
-        self.write_manifest(filename, chunkuuids)
+    def alloc_append(self, filename, append_chunkuuids, append_chunklens=None): # append chunks
+        entries = self.read_manifest_entries(filename)
+        if append_chunklens is None:
+            append_chunklens = [None] * len(append_chunkuuids)
+        entries.extend(zip(append_chunkuuids, append_chunklens))
+        self.refs.adjust(increments=append_chunkuuids)
+        try:
+            self.write_manifest(filename, [c for c, l in entries], [l for c, l in entries])
+        finally:
+            self.release_chunks(append_chunkuuids)
+        self.chunklocs.commit()
         return
 
+    def update_manifest(self, filename, splices):
+        ''' replace some chunks of a manifest, each (first, last, chunkuuids,
+        chunklens) splice replaces chunks first to last - 1, return the new entries '''
+        entries = self.fill_chunklens(self.read_manifest_entries(filename))
+        updated = []
+        added = []
+        removed = []
+        i = 0
+        for first, last, chunkuuids, chunklens in splices:
+            if first < i or last < first:
+                raise Exception("FAULTED: Splice of chunks %d to %d overlaps the one before it in %s." % (first, last, filename))
+            updated.extend(entries[i:first])
+            removed.extend(c for c, l in entries[first:last])
+            updated.extend(zip(chunkuuids, chunklens))
+            added.extend(chunkuuids)
+            i = last
+        updated.extend(entries[i:])
+        # count references before the manifest exists, release them after it is gone
+        self.refs.adjust(increments=added)
+        try:
+            self.write_manifest(filename, [c for c, l in updated], [l for c, l in updated])
+        finally:
+            self.release_chunks(added)
+        if removed:
+            self.refs.adjust(decrements=removed)
+        self.chunklocs.commit()
+        return updated
+
     def cycle_chunkrobin(self):
         self.chunkrobin = (self.chunkrobin + 1) % self.num_chunkservers
 
-    def new_chunkloc(self, chunkuuid):
-        while not self.chunkservers[self.chunkrobin].enabled:
-            self.cycle_chunkrobin()
-        maybe_new = self.chunkrobin
-        self.cycle_chunkrobin()
-        return maybe_new
+    def new_chunkloc(self, chunkuuid, exclude=()):
+        ''' where the placement policy puts a new chunk, None once every
+        enabled chunkserver is in exclude '''
+        return self.placement.place(chunkuuid, self.chunkservers, exclude)
+
+    def new_chunklocs(self, chunkuuid, count):
+        ''' count different locations for the shards of a new chunk '''
+        return self.placement.spread(chunkuuid, self.chunkservers, count)
 
-    def get_retryloc(self, chunkuuid):
-        while not self.chunkservers[self.chunkrobin].enabled:
+    def placement_stats(self):
+        return self.placement.stats()
+
+    def get_chunklocs(self, chunkuuid):
+        ''' enabled locations indexed for chunkuuid, rotated to spread reads over mirrors '''
+        chunklocs = sorted(loc for loc in self.chunklocs.get(chunkuuid) if loc in self.chunkservers and self.chunkservers[loc].enabled)
+        if len(chunklocs) > 1:
+            start = self.chunkrobin % len(chunklocs)
+            chunklocs = chunklocs[start:] + chunklocs[:start]
             self.cycle_chunkrobin()
-        maybe_mirror = self.chunkrobin
-        self.cycle_chunkrobin()
-        return maybe_mirror
+        return chunklocs
+
+    def get_probe_chunklocs(self, chunkuuid, chunklocs):
+        ''' enabled locations not in chunklocs, to probe when the index is stale,
+        where the placement policy would have put chunkuuid first '''
+        ranked = self.placement.locate(chunkuuid, self.chunkservers)
+        if ranked is None:
+            ranked = [loc for loc in sorted(self.chunkservers) if self.chunkservers[loc].enabled]
+        return [loc for loc in ranked if loc not in chunklocs]
 
     def get_chunkloc(self, chunkuuid):
-        while not self.chunkservers[self.chunkrobin].enabled:
-            self.cycle_chunkrobin()
-        maybe_original = self.chunkrobin
-        self.cycle_chunkrobin()
-        return maybe_original
+        chunklocs = self.get_chunklocs(chunkuuid)
+        return (chunklocs + self.get_probe_chunklocs(chunkuuid, chunklocs))[0]
+
+    def add_chunkloc(self, chunkuuid, chunkloc):
+        self.chunklocs.add(chunkuuid, chunkloc)
+
+    def remove_chunkloc(self, chunkuuid, chunkloc):
+        self.chunklocs.discard(chunkuuid, chunkloc)
+
+    def repair_chunk(self, chunkuuid, chunk, chunklocs):
+        ''' write a verified chunk over bad or missing copies, return how many were rewritten '''
+        repaired = 0
+        for chunkloc in chunklocs:
+            chunkserver = self.chunkservers[chunkloc]
+            if chunkserver.rewrite(chunkuuid, chunk) is not None:
+                if self.debug > 0: print "Repaired %s%s." % (chunkserver.local_filesystem_root, chunkuuid)
+                self.add_chunkloc(chunkuuid, chunkloc)
+                repaired += 1
+            else:
+                self.remove_chunkloc(chunkuuid, chunkloc)
+        self.chunklocs.commit()
+        return repaired
+
+    def repair_shards(self, chunkuuid, chunk, shape, present, chunklocs):
+        ''' write the shards missing from present over bad or missing shards
+        at chunklocs, return how many were rewritten '''
+        k, m, length = shape
+        missing = [i for i in range(k + m) if i not in present][:len(chunklocs)]
+        shards = ccaserasure.reencode(chunk, k, m, missing)
+        repaired = 0
+        for chunkloc, i in zip(chunklocs, missing):
+            chunkserver = self.chunkservers[chunkloc]
+            if chunkserver.rewrite(chunkuuid, shards[i]) is not None:
+                if self.debug > 0: print "Repaired shard %d of %s%s." % (i, chunkserver.local_filesystem_root, chunkuuid)
+                self.add_chunkloc(chunkuuid, chunkloc)
+                repaired += 1
+            else:
+                self.remove_chunkloc(chunkuuid, chunkloc)
+        self.chunklocs.commit()
+        return repaired
 
     def get_chunkuuids(self, filename):
         return self.read_manifest(filename)
 
+    def get_chunkmap(self, filename):
+        if self.metadata is not None:
+            manifest = self.metadata.get_manifest(filename)
+            if manifest is None:
+                raise IOError("no manifest for %s" % filename)
+            return manifest
+        local_filename = self.manifest_filename(filename)
+        if ccasmanifest.is_binary(local_filename):
+            return ccasmanifest.Manifest.open(local_filename)
+        entries = self.fill_chunklens(ccasmanifest.read_text_entries(local_filename))
+        return ccasmanifest.ChunkMap([c for c, l in entries], [l for c, l in entries])
+
+    def fill_chunklens(self, entries):
+        # manifests written before chunk lengths were recorded
+        return [(c, l if l is not None else self.get_chunksize(c)) for c, l in entries]
+
+    def get_chunksize(self, chunkuuid):
+        for i in self.chunkservers:
+            size = self.chunkservers[i].size(chunkuuid)
+            if size is not None:
+                return size
+        raise Exception("FAULTED: Chunk %s not found anywhere." % (chunkuuid))
+
     def exists(self, filename):
+        if self.metadata is not None:
+            return self.metadata.has_manifest(filename)
         if filename.startswith('/'): filename = filename[1:]
         local_filename = os.path.join(self.manifest_path, filename)
         return os.path.exists(local_filename)
 
     def rename(self, old_path, new_path):
+        if self.metadata is not None:
+            self.metadata.rename(old_path, new_path)
+            return
         if old_path.startswith('/'): old_path = old_path[1:]
         local_old_filename = os.path.join(self.manifest_path, old_path)
         if new_path.startswith('/'): new_path = new_path[1:]
@@ -243,7 +986,7 @@ class CcasMaster(GFSMaster):
         os.rename(local_old_filename, local_new_filename)
 
     def delete(self, filename): # rename for later garbage collection
-        # chunkuuids = self.read_manifest(filename)
+        chunkuuids = self.read_manifest(filename)
         iso = time.strftime('%Y%m%dT%H%M%SZ')
         timestamp = repr(time.time())
         if self.debug > 0: print "CcasMaster.delete: iso %s" % iso
@@ -255,39 +998,195 @@ class CcasMaster(GFSMaster):
         if self.debug > 0: print "CcasMaster.delete: deleted_filename %s" % deleted_filename
         # self.write_manifest(deleted_filename, chunkuuids)
         self.rename(filename, deleted_filename)
+        self.refs.adjust(decrements=chunkuuids)
         if self.debug > 0: print "deleted file: %s renamed to %s ready for gc" % (filename, deleted_filename)
+        if self.reclaim_on_delete:
+            self.reclaim()
+
+    def claim_chunk(self, chunkuuid):
+        ''' keep a chunk about to be written from being reclaimed until its file is allocated '''
+        with self.refs.lock:
+            self.refs.unqueue(chunkuuid)
+            self.claimed[chunkuuid] += 1
+
+    def release_chunks(self, chunkuuids):
+        with self.refs.lock:
+            for chunkuuid in chunkuuids:
+                self.claimed[chunkuuid] -= 1
+                if self.claimed[chunkuuid] <= 0:
+                    del self.claimed[chunkuuid]
+            if self.released is not None:
+                self.released.update(chunkuuids)
+
+    def reclaim(self, older_than=0, limit=None):
+        ''' delete queued chunks no manifest refers to any more, return how many '''
+        reclaimed = 0
+        while limit is None or reclaimed < limit:
+            batch = self.refs.queued(older_than, 1000 if limit is None else min(1000, limit - reclaimed))
+            if not batch:
+                break
+            for chunkuuid in batch:
+                with self.refs.lock:
+                    # a writer may have claimed it back since
+                    if not self.refs.unqueue(chunkuuid) or chunkuuid in self.claimed:
+                        continue
+                    for i in self.chunkservers:
+                        if self.chunkservers[i].delete(chunkuuid):
+                            self.remove_chunkloc(chunkuuid, i)
+                reclaimed += 1
+            self.refs.commit()
+            self.chunklocs.commit()
+        if reclaimed:
+            self.compact_keys()
+        if self.debug > 0: print "CcasMaster.reclaim: %d chunks" % (reclaimed)
+        return reclaimed
 
     def dump_metadata(self):
         print "Chunkservers: ", len(self.chunkservers)
+        print "Indexed chunks: ", len(self.chunklocs)
+
+    def compact(self, min_dead=0.5):
+        ''' compact every chunkserver, return the bytes reclaimed '''
+        reclaimed = 0
+        for i in self.chunkservers:
+            reclaimed += self.chunkservers[i].compact(min_dead)
+        return reclaimed
+
+    def compact_keys(self):
+        ''' rewrite the key log of every chunkserver that is mostly deleted chunks '''
+        for i in self.chunkservers:
+            self.chunkservers[i].compact_keys()
 
-    def write_catalog(self, filename, torrent_info_path): # save to catalog
-        if self.debug > 0: print "write_catalog: %s" % (filename)
+    def close(self):
+        for i in self.chunkservers:
+            self.chunkservers[i].close()
+        self.chunklocs.close()
+        self.refs.close()
+        if self.metadata is not None:
+            self.metadata.close()
+
+    def write_index(self, filename, torrent): # save to index and catalog
+        if self.debug > 0: print "write_index: %s" % (filename)
+        if self.metadata is not None:
+            self.metadata.put_torrent(filename, torrent)
+            return
         if filename.startswith('/'): filename = filename[1:]
-        local_filename = os.path.join(self.catalog_path, filename)
-        if not os.access(os.path.dirname(local_filename), os.W_OK):
-            os.makedirs(os.path.dirname(local_filename))
-        shutil.copyfile(torrent_info_path, local_filename)
-        os.remove(torrent_info_path)
+        ccasutil.write_torrent(os.path.join(self.index_path, filename), torrent)
+        ccasutil.write_torrent(os.path.join(self.catalog_path, filename), torrent)
         return
 
-    def write_manifest(self, filename, chunkuuids):
-        if self.debug > 0: print "write_manifest: %s %s" % (filename, chunkuuids)
+    def read_index(self, filename):
+        if self.metadata is not None:
+            return self.metadata.get_torrent(filename)
         if filename.startswith('/'): filename = filename[1:]
-        local_filename = os.path.join(self.manifest_path, filename)
+        return ccasutil.read_torrent(os.path.join(self.index_path, filename))
+
+    def manifest_filename(self, filename):
+        if filename.startswith('/'): filename = filename[1:]
+        return os.path.join(self.manifest_path, filename)
+
+    def write_manifest(self, filename, chunkuuids, chunklens=None):
+        if self.debug > 0: print "write_manifest: %s %s" % (filename, chunkuuids)
+        if chunklens is None:
+            chunklens = [None] * len(chunkuuids)
+        if self.metadata is not None:
+            if None in chunklens:
+                chunklens = [l for c, l in self.fill_chunklens(zip(chunkuuids, chunklens))]
+            self.metadata.put_manifest(filename, chunkuuids, chunklens)
+            return
+        local_filename = self.manifest_filename(filename)
         if not os.access(os.path.dirname(local_filename), os.W_OK):
             os.makedirs(os.path.dirname(local_filename))
-        with open(local_filename, "w") as f:
-            f.write("%s" % ("\n".join(c for c in chunkuuids)))
+        if self.manifest_format == 'text':
+            ccasmanifest.write_text(local_filename, chunkuuids, chunklens)
+        else:
+            if None in chunklens:
+                chunklens = [l for c, l in self.fill_chunklens(zip(chunkuuids, chunklens))]
+            ccasmanifest.write_binary(local_filename, chunkuuids, chunklens)
         return
 
     def read_manifest(self, filename):
+        return [c for c, l in self.read_manifest_entries(filename)]
+
+    def read_manifest_entries(self, filename):
         if self.debug > 0: print "read_manifest: %s" % (filename)
-        if filename.startswith('/'): filename = filename[1:]
-        local_filename = os.path.join(self.manifest_path, filename)
-        with open(local_filename, "r") as f:
-            data = f.read()
-        chunkuuids = data.split("\n")
-        return chunkuuids
+        if self.metadata is not None:
+            return ccasmanifest.entries(self.get_chunkmap(filename))
+        return ccasmanifest.read_entries(self.manifest_filename(filename))
+
+    def iter_manifests(self):
+        ''' (filename, entries) of every live manifest, deleted ones are not '''
+        for filename in self.iter_manifest_names():
+            if filename.split(os.sep, 1)[0] == 'hidden':
+                continue
+            yield filename, self.read_manifest_entries(filename)
+
+    def iter_manifest_names(self):
+        ''' every manifest, deleted ones included, in sorted order '''
+        if self.metadata is not None:
+            for filename in self.metadata.iter_files():
+                yield filename
+            return
+        for filename in self._walk_manifests(''):
+            yield filename
+
+    def _walk_manifests(self, path):
+        # sorted on the whole name, so 'a.txt' comes before 'a/b' as it does in the metadata db
+        local_path = os.path.join(self.manifest_path, path)
+        if not os.path.isdir(local_path):
+            return
+        entries = []
+        for fn in os.listdir(local_path):
+            if fn.endswith('.tmp'):
+                continue
+            isdir = os.path.isdir(os.path.join(local_path, fn))
+            entries.append((fn + '/' if isdir else fn, os.path.join(path, fn), isdir))
+        for key, filename, isdir in sorted(entries):
+            if isdir:
+                for filename in self._walk_manifests(filename):
+                    yield filename
+            else:
+                yield filename
+
+    def manifest_mtime(self, filename):
+        if self.metadata is not None:
+            return self.metadata.mtime(filename)
+        return os.path.getmtime(self.manifest_filename(filename))
+
+    def remove_manifest(self, filename):
+        ''' drop a manifest for good, with the directories it leaves empty '''
+        if self.metadata is not None:
+            self.metadata.remove(filename, prune=True)
+            return
+        local_filename = self.manifest_filename(filename)
+        os.remove(local_filename)
+        path = os.path.dirname(local_filename)
+        while path != os.path.normpath(self.manifest_path) and not os.listdir(path):
+            os.rmdir(path)
+            path = os.path.dirname(path)
+
+    def migrate_metadata(self):
+        ''' copy the manifest and index trees into the metadata db '''
+        migrated = ccasmeta.migrate(self.metadata, self.manifest_path, self.index_path, self.fill_chunklens)
+        if self.debug > 0: print "migrate_metadata: %d files" % (migrated)
+        return migrated
+
+    def migrate_manifests(self):
+        ''' rewrite text manifests, including deleted ones, in manifest_format '''
+        migrated = 0
+        if self.metadata is not None:
+            return migrated # the metadata db only holds binary manifests
+        for root, dirs, files in os.walk(self.manifest_path):
+            for fn in files:
+                local_filename = os.path.join(root, fn)
+                if ccasmanifest.is_binary(local_filename) or fn.endswith('.tmp'):
+                    continue
+                filename = os.path.relpath(local_filename, self.manifest_path)
+                entries = self.read_manifest_entries(filename)
+                self.write_manifest(filename, [c for c, l in entries], [l for c, l in entries])
+                migrated += 1
+        if self.debug > 0: print "migrate_manifests: %d manifests" % (migrated)
+        return migrated
 
     '''
     def save_filetable(self):
@@ -317,48 +1216,140 @@ class CcasMaster(GFSMaster):
     '''
 
 class CcasChunkserver(GFSChunkserver):
-    def __init__(self, root_path, debug=0):
+    def __init__(self, root_path, debug=0, write_verify=False, bloom_capacity=1000000, io_workers=1, compression=None, compress_threshold=0.9):
         self.debug = debug
         self.local_filesystem_root = root_path
+        self.write_verify = write_verify
+        self.compression = compression
+        self.compress_threshold = compress_threshold
         if root_path is None:
             self.enabled = False
         else:
             self.enabled = True
             if not os.access(self.local_filesystem_root, os.W_OK):
                 os.makedirs(self.local_filesystem_root)
+            self.open_store()
+            self.known = ccasbloom.ChunkExistence(os.path.join(self.local_filesystem_root, '.ccas_keys'), \
+                        self.iter_chunkuuids, capacity=bloom_capacity, debug=self.debug)
+            self.pool = ccaspool.WorkerPool(io_workers, name=self.local_filesystem_root)
 
-    def write(self, chunkuuid, chunk):
-        ''' return None on any error '''
+    def open_store(self):
+        ''' one file per chunk needs nothing opened '''
+        return
+
+    def write(self, chunkuuid, chunk, encoded=None):
+        ''' return None on any error, encoded is a shared ccascodec.Encoder for chunk '''
         if not self.enabled: return None
-        local_filename = self.chunk_filename(chunkuuid)
-        if not os.access(os.path.dirname(local_filename), os.W_OK):
-            os.makedirs(os.path.dirname(local_filename))
-        # return early if the chunk already exists and we verified it
-        existing_data = self.read(chunkuuid)
-        if existing_data is not None:
-            if chunkuuid == ccasutil.hashdata(existing_data):
-                if self.debug > 1: print '200 Skipping write: Chunk %s already verified on %s' % (chunkuuid, self.local_filesystem_root)
+        # return early if the chunk already exists, without touching its data
+        if chunkuuid in self.known and self.has(chunkuuid):
+            if not self.write_verify:
+                if self.debug > 1: print '200 Skipping write: Chunk %s already on %s' % (chunkuuid, self.local_filesystem_root)
                 return 200
+            existing_data = self.read(chunkuuid)
+            if existing_data is not None:
+                # the same bytes are as good as the same hash, and cheaper
+                if existing_data == chunk:
+                    if self.debug > 1: print '200 Skipping write: Chunk %s already verified on %s' % (chunkuuid, self.local_filesystem_root)
+                    return 200
         try:
-            with open(local_filename, "wb") as f:
-                f.write(chunk)
+            if encoded is None:
+                encoded = ccascodec.Encoder(chunk, self.compression, self.compress_threshold)
+            self.write_data(chunkuuid, encoded())
+            self.known.add(chunkuuid)
             if self.debug > 1: print '201 Chunk written to %s%s' % (self.local_filesystem_root, chunkuuid)
             return 201
         except:
             return None
 
+    def rewrite(self, chunkuuid, chunk):
+        ''' write over whatever copy is there, a bad one or a shard, return None on any error '''
+        if not self.enabled: return None
+        try:
+            self.write_data(chunkuuid, ccascodec.encode(chunk, self.compression, self.compress_threshold))
+            self.known.add(chunkuuid)
+            return 201
+        except:
+            return None
+
+    def write_data(self, chunkuuid, data):
+        local_filename = self.chunk_filename(chunkuuid)
+        if not os.access(os.path.dirname(local_filename), os.W_OK):
+            os.makedirs(os.path.dirname(local_filename))
+        # a chunk file is complete once it has its name
+        tmp_filename = "%s.%s.tmp" % (local_filename, uuid.uuid4().hex)
+        with open(tmp_filename, "wb") as f:
+            f.write(data)
+        os.rename(tmp_filename, local_filename)
+
+    def has(self, chunkuuid):
+        if not self.enabled: return False
+        return os.path.isfile(self.chunk_filename(chunkuuid))
+
     def read(self, chunkuuid):
         ''' return None on any error '''
         if not self.enabled: return None
-        data = None
-        local_filename = self.chunk_filename(chunkuuid)
         try:
-            with open(local_filename, "rb") as f:
-                data = f.read()
-            return data
+            return ccascodec.decode(self.read_data(chunkuuid))
+        except:
+            return None
+
+    def read_data(self, chunkuuid, length=None):
+        ''' the stored bytes, or the first length of them '''
+        with open(self.chunk_filename(chunkuuid), "rb") as f:
+            if length is None:
+                return f.read()
+            return f.read(length)
+
+    def stored_size(self, chunkuuid):
+        return os.path.getsize(self.chunk_filename(chunkuuid))
+
+    def iter_chunkuuids(self):
+        ''' walk the chunk directories in sorted order '''
+        if not self.enabled: return
+        for root, dirs, files in os.walk(self.local_filesystem_root):
+            dirs.sort()
+            for fn in sorted(files):
+                if fn.startswith('.') or fn.endswith('.tmp'):
+                    continue
+                yield fn
+
+    def size(self, chunkuuid):
+        ''' return None on any error '''
+        if not self.enabled: return None
+        try:
+            # the uncompressed size, from the header when there is one
+            head = self.read_data(chunkuuid, ccascodec.HEADER.size)
+            if head is None:
+                return None
+            return ccascodec.raw_size(head, self.stored_size(chunkuuid))
         except:
             return None
 
+    def delete(self, chunkuuid):
+        ''' return False when the chunk was not there '''
+        if not self.enabled: return False
+        try:
+            os.remove(self.chunk_filename(chunkuuid))
+        except OSError:
+            return False
+        self.known.discard(chunkuuid)
+        return True
+
+    def compact(self, min_dead=0.5):
+        ''' one file per chunk frees space on delete, nothing to compact '''
+        return 0
+
+    def compact_keys(self):
+        ''' rewrite the key log once it is mostly deleted chunks, return True if it was '''
+        if not self.enabled: return False
+        return self.known.compact()
+
+    def close(self):
+        if self.enabled:
+            # let background copies finish first
+            self.pool.shutdown(wait=True)
+            self.known.close()
+
     def chunk_filename(self, chunkuuid):
         ''' return None on any error '''
         if not self.enabled: return None
@@ -366,6 +1357,55 @@ class CcasChunkserver(GFSChunkserver):
         return local_filename
 
 
+class CcasPackChunkserver(CcasChunkserver):
+    ''' chunks appended to large pack files, see ccaspack '''
+    def __init__(self, root_path, pack_size=ccaspack.PACK_SIZE, **kwargs):
+        self.pack_size = pack_size
+        CcasChunkserver.__init__(self, root_path, **kwargs)
+
+    def open_store(self):
+        self.store = ccaspack.PackStore(self.local_filesystem_root, pack_size=self.pack_size, debug=self.debug)
+
+    def write_data(self, chunkuuid, data):
+        self.store.put(chunkuuid, data)
+
+    def has(self, chunkuuid):
+        if not self.enabled: return False
+        return chunkuuid in self.store
+
+    def read_data(self, chunkuuid, length=None):
+        return self.store.get(chunkuuid, length)
+
+    def stored_size(self, chunkuuid):
+        return self.store.size(chunkuuid)
+
+    def iter_chunkuuids(self):
+        ''' every indexed chunk in sorted order '''
+        if not self.enabled: return
+        for chunkuuid in self.store:
+            yield chunkuuid
+
+    def delete(self, chunkuuid):
+        if not self.enabled: return False
+        if not self.store.delete(chunkuuid):
+            return False
+        self.known.discard(chunkuuid)
+        return True
+
+    def compact(self, min_dead=0.5):
+        ''' return the bytes reclaimed '''
+        if not self.enabled: return 0
+        return self.store.compact(min_dead)
+
+    def close(self):
+        CcasChunkserver.close(self)
+        if self.enabled:
+            self.store.close()
+
+    def chunk_filename(self, chunkuuid):
+        return None
+
+
 def main():
     # test script for filesystem
 
@@ -0,0 +1,129 @@
+'''
+2015 John Ko <git@johnko.ca>
+Bloom filter over the chunks a chunkserver holds.
+
+The filter is only ever a hint. A miss means the chunk is not stored (or
+was stored behind our back, and writing it again is harmless). A hit
+still has to be confirmed against the store, but by a lookup, not by
+reading and hashing the chunk.
+
+The keys are kept in an append-only log next to the chunks so the filter
+can be loaded at startup without walking the chunk directories. A deleted
+chunk is logged too, as its key after a '-'. Once half the keys logged
+are deleted ones, the log is rewritten from the chunkserver's own list of
+chunks, at startup or when compact() is called after a garbage
+collection or a reclaim.
+'''
+import hashlib
+import math
+import os
+import struct
+import threading
+
+PAIR = struct.Struct('<QQ')
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / float(self.capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing from one digest
+        h1, h2 = PAIR.unpack(hashlib.md5(key).digest())
+        h2 |= 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class ChunkExistence(object):
+    ''' bloom filter of chunkuuids backed by a key log '''
+    def __init__(self, log_path, iter_chunkuuids, capacity=1000000, error_rate=0.001, debug=0):
+        self.debug = debug
+        self.log_path = log_path
+        self.iter_chunkuuids = iter_chunkuuids
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._lock = threading.RLock()
+        self.log = None
+        if not os.path.exists(log_path):
+            # first start on this store, record what is already there
+            if self.debug > 0: print "ChunkExistence: building %s" % (log_path)
+            self.rebuild()
+        else:
+            self.load(capacity)
+            self.log = open(log_path, 'a')
+            self.compact()
+
+    def load(self, capacity):
+        with self._lock:
+            # about one sha256 hex digest and a newline per key
+            estimate = os.path.getsize(self.log_path) // 65
+            self.bloom = BloomFilter(max(capacity, 2 * estimate), self.error_rate)
+            self.removed = 0 # deleted keys still in the log
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    key = line.strip()
+                    if key.startswith('-'):
+                        self.removed += 1
+                    elif key:
+                        self.bloom.add(key)
+
+    def rebuild(self):
+        ''' rewrite the log and the filter from the chunks that are there now '''
+        with self._lock:
+            if self.log is not None:
+                self.log.close()
+            with open(self.log_path + '.tmp', 'w') as f:
+                for chunkuuid in self.iter_chunkuuids():
+                    f.write(chunkuuid + "\n")
+            os.rename(self.log_path + '.tmp', self.log_path)
+            self.load(self.capacity)
+            self.log = open(self.log_path, 'a')
+
+    def compact(self):
+        ''' rebuild once half the keys are deleted ones, return True if it did '''
+        with self._lock:
+            if self.removed == 0 or 2 * self.removed < self.bloom.count:
+                return False
+            if self.debug > 0: print "ChunkExistence: %d of %d keys deleted, rebuilding %s" % (self.removed, self.bloom.count, self.log_path)
+            self.rebuild()
+            return True
+
+    def add(self, chunkuuid):
+        with self._lock:
+            self.log.write(chunkuuid + "\n")
+            self.bloom.add(chunkuuid)
+            if self.bloom.count > self.bloom.capacity:
+                # past capacity the error rate climbs, rebuild twice as big
+                self.log.flush()
+                self.load(2 * self.bloom.capacity)
+
+    def discard(self, chunkuuid):
+        ''' log a deleted chunk, it stays in the filter until a rebuild '''
+        with self._lock:
+            self.log.write('-' + chunkuuid + "\n")
+            self.removed += 1
+
+    def __contains__(self, chunkuuid):
+        with self._lock:
+            return chunkuuid in self.bloom
+
+    def close(self):
+        with self._lock:
+            if not self.log.closed:
+                self.log.close()
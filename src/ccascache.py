@@ -0,0 +1,132 @@
+'''
+2015 John Ko <git@johnko.ca>
+In-process LRU caches of chunks, bounded by bytes, and of file
+attributes, bounded by entries.
+
+Chunks are immutable and named by their hash, so a cached chunk never
+goes stale and was already verified when it was read. Attributes do go
+stale, and are checked against the file they came from.
+'''
+import collections
+import threading
+
+
+class ChunkCache(object):
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes # 0 disables the cache
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chunks = collections.OrderedDict() # oldest first
+        self._lock = threading.Lock()
+
+    def get(self, chunkuuid):
+        ''' return None on a miss '''
+        if not self.max_bytes:
+            return None
+        with self._lock:
+            chunk = self._chunks.pop(chunkuuid, None)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self._chunks[chunkuuid] = chunk
+            self.hits += 1
+            return chunk
+
+    def put(self, chunkuuid, chunk):
+        if len(chunk) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._chunks.pop(chunkuuid, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._chunks[chunkuuid] = chunk
+            self.bytes += len(chunk)
+            while self.bytes > self.max_bytes:
+                evicted_uuid, evicted = self._chunks.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._chunks),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class AttrCache(object):
+    ''' file attributes by path, LRU bounded by entries
+
+    An entry is trusted for ttl seconds, after that it is only used again
+    if the caller's validator, like the index file's inode and mtime,
+    still matches the one it was cached with.
+    '''
+    def __init__(self, max_entries=100000, ttl=1.0):
+        self.max_entries = max_entries # 0 disables the cache
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict() # oldest first, path to (validator, info, checked)
+        self._lock = threading.Lock()
+
+    def get(self, path, now):
+        ''' info cached for path within the ttl, None otherwise '''
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or now - entry[2] > self.ttl:
+                return None
+            self.hits += 1
+            return dict(entry[1])
+
+    def validate(self, path, validator, now):
+        ''' info cached for path with the same validator, None on a miss '''
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None or validator is None or entry[0] != validator:
+                self.misses += 1
+                return None
+            self._entries[path] = (validator, entry[1], now)
+            self.revalidated += 1
+            return dict(entry[1])
+
+    def put(self, path, validator, info, now):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries[path] = (validator, dict(info), now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, path=None):
+        ''' forget path, or everything when path is None '''
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
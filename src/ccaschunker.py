@@ -0,0 +1,182 @@
+'''
+2015 John Ko <git@johnko.ca>
+Chunkers decide where a stream of data is cut into chunks.
+
+FixedChunker cuts every chunksize bytes, like the original read_in_chunks.
+CdcChunker cuts where a rolling gear hash of the content matches a mask
+(FastCDC-style normalized chunking), so inserting or removing bytes only
+moves the boundaries near the edit and the rest of the file still dedups.
+'''
+import hashlib
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+def _gear_table():
+    # deterministic, so every store cuts the same data the same way
+    return [int(hashlib.sha256('ccas-gear-%d' % i).hexdigest()[:16], 16) for i in range(256)]
+
+GEAR = _gear_table()
+BLOCK = 1024 * 1024
+GEAR_NUMPY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+def _spread_mask(bits):
+    # spread the one bits over the high 48 bits of the hash, the low bits
+    # only depend on the last few bytes fed to the gear hash
+    return reduce(lambda x, y: x | y, [1 << (63 - (i * 48) // bits) for i in range(bits)], 0)
+
+def _log2(n):
+    bits = 0
+    while (1 << (bits + 1)) <= n:
+        bits += 1
+    return bits
+
+
+class Chunker(object):
+    ''' subclasses implement cut() '''
+    name = None
+    max_size = 0
+
+    def cut(self, data):
+        ''' return the length of the first chunk in data.
+        data holds at least max_size bytes unless the stream is at eof '''
+        raise NotImplementedError
+
+    def chunks(self, file_object):
+        ''' yield chunks from file_object, holding at most max_size bytes '''
+        buf = ''
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_size:
+                data = file_object.read(self.max_size - len(buf))
+                if not data:
+                    eof = True
+                    break
+                buf += data
+            if not buf:
+                break
+            cut = self.cut(buf)
+            yield buf[:cut]
+            buf = buf[cut:]
+
+
+class FixedChunker(Chunker):
+    name = 'fixed'
+
+    def __init__(self, chunksize):
+        if chunksize < 1:
+            raise ValueError("chunksize should be at least 1")
+        self.chunksize = chunksize
+        self.min_size = chunksize
+        self.avg_size = chunksize
+        self.max_size = chunksize
+
+    def cut(self, data):
+        return min(len(data), self.chunksize)
+
+
+class CdcChunker(Chunker):
+    name = 'cdc'
+
+    def __init__(self, avg_size, min_size=None, max_size=None):
+        if min_size is None: min_size = avg_size // 4
+        if max_size is None: max_size = avg_size * 4
+        if not 0 < min_size <= avg_size <= max_size:
+            raise ValueError("cdc sizes should be 0 < min_size <= avg_size <= max_size")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = _log2(avg_size)
+        # normalized chunking: harder to cut before avg_size, easier after
+        self.mask_s = _spread_mask(min(bits + 2, 48))
+        self.mask_l = _spread_mask(max(bits - 2, 1))
+
+    def cut(self, data):
+        n = len(data)
+        if n <= self.min_size:
+            return n
+        end = min(n, self.max_size)
+        normal = min(self.avg_size, end)
+        scan = self._scan_numpy if numpy is not None else self._scan
+        i = scan(data, self.min_size, normal, self.mask_s)
+        if i is None:
+            i = scan(data, normal, end, self.mask_l)
+        if i is None:
+            return end
+        return i
+
+    def _scan(self, data, start, end, mask):
+        # the hash at each byte covers the 64 bytes ending there, so warm up
+        # on the 63 bytes before start
+        gear = GEAR
+        h = 0
+        for c in bytearray(buffer(data, max(0, start - 63), min(start, 63))):
+            h = ((h << 1) + gear[c]) & MASK64
+        i = start
+        for c in bytearray(buffer(data, start, end - start)):
+            h = ((h << 1) + gear[c]) & MASK64
+            i += 1
+            if not h & mask:
+                return i
+        return None
+
+    def _scan_numpy(self, data, start, end, mask):
+        # same hash as _scan, a block at a time: summing the gear values
+        # shifted by their distance from each byte, doubling the span each step
+        mask = numpy.uint64(mask)
+        for block in range(start, end, BLOCK):
+            lead = min(block, 63)
+            stop = min(block + BLOCK, end)
+            h = GEAR_NUMPY[numpy.frombuffer(data, numpy.uint8, stop - block + lead, block - lead)]
+            shifted = numpy.empty_like(h)
+            for k in (1, 2, 4, 8, 16, 32):
+                # multiply wraps like the shift, and is faster for uint64
+                numpy.multiply(h[:-k], numpy.uint64(1 << k), out=shifted[k:])
+                numpy.add(h[k:], shifted[k:], out=h[k:])
+            hits = numpy.flatnonzero((h[lead:] & mask) == 0)
+            if len(hits):
+                return block + int(hits[0]) + 1
+        return None
+
+
+def new_chunker(chunker, chunksize, min_chunksize=None, max_chunksize=None):
+    ''' chunker can be 'fixed', 'cdc' or an object with cut() and chunks() '''
+    if chunker is None or chunker == 'fixed':
+        return FixedChunker(chunksize)
+    elif chunker == 'cdc':
+        return CdcChunker(chunksize, min_size=min_chunksize, max_size=max_chunksize)
+    elif hasattr(chunker, 'cut') and hasattr(chunker, 'chunks'):
+        return chunker
+    raise ValueError("chunker should be 'fixed' (default), 'cdc' or a Chunker")
+
+
+def main():
+    # dedup ratio of two versions of a file, the second with one byte
+    # inserted near the start
+    import os
+    import sys
+    from cStringIO import StringIO
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 8 * 1024 * 1024
+    avg = int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024
+    v1 = os.urandom(size)
+    v2 = v1[:100] + 'x' + v1[100:]
+    for chunker in (FixedChunker(avg), CdcChunker(avg)):
+        seen = set()
+        stored = 0
+        start = time.time()
+        for version in (v1, v2):
+            for chunk in chunker.chunks(StringIO(version)):
+                digest = hashlib.sha256(chunk).digest()
+                if digest not in seen:
+                    seen.add(digest)
+                    stored += len(chunk)
+        elapsed = time.time() - start
+        print "%-5s avg %d: dedup ratio %.2f, %.1f MB/s" % (chunker.name, avg,
+            float(len(v1) + len(v2)) / stored, (len(v1) + len(v2)) / elapsed / 1024 / 1024)
+
+if __name__ == "__main__":
+    main()
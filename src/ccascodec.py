@@ -0,0 +1,145 @@
+'''
+2015 John Ko <git@johnko.ca>
+Per-chunk compression for chunkservers.
+
+A compressed chunk starts with a small header naming the codec and the
+uncompressed length. A chunk stored raw has no header (so chunks written
+before compression existed still read back), unless its data happens to
+start with the header magic, then it gets a 'raw' header to stay
+unambiguous.
+
+Chunk ids are always the hash of the uncompressed data, so dedup does not
+care how, or whether, a chunk was compressed.
+'''
+import bz2
+import struct
+import threading
+import zlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+MAGIC = '\x00CCZ'
+HEADER = struct.Struct('<4sB3xQ') # magic, codec id, raw length
+
+RAW = 0
+CODECS = {
+    'zlib': (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    'bz2': (2, lambda data: bz2.compress(data, 9), bz2.decompress),
+}
+if lzma is not None:
+    CODECS['lzma'] = (3, lambda data: lzma.compress(data), lzma.decompress)
+DECOMPRESS = dict((codec_id, decompress) for codec_id, compress, decompress in CODECS.values())
+
+SAMPLE_SIZE = 64 * 1024
+SAMPLES = 4
+
+
+def check_codec(codec):
+    if codec is not None and codec not in CODECS:
+        raise ValueError("compression should be None or one of %s" % ", ".join(sorted(CODECS)))
+
+def _sample(chunk):
+    # a few slices spread over the chunk, the start alone is often a header
+    if len(chunk) <= SAMPLE_SIZE:
+        return chunk
+    step = len(chunk) // SAMPLES
+    size = SAMPLE_SIZE // SAMPLES
+    return ''.join(chunk[i * step:i * step + size] for i in range(SAMPLES))
+
+def _raw(chunk):
+    if chunk.startswith(MAGIC):
+        return HEADER.pack(MAGIC, RAW, len(chunk)) + chunk
+    return chunk
+
+def encode(chunk, codec=None, threshold=0.9):
+    ''' bytes to store for chunk, compressed only when it shrinks below
+    threshold times the raw size '''
+    if codec is None or not chunk:
+        return _raw(chunk)
+    codec_id, compress, decompress = CODECS[codec]
+    sample = _sample(chunk)
+    if len(compress(sample)) > len(sample) * threshold:
+        return _raw(chunk)
+    compressed = compress(chunk)
+    if HEADER.size + len(compressed) > len(chunk) * threshold:
+        return _raw(chunk)
+    return HEADER.pack(MAGIC, codec_id, len(chunk)) + compressed
+
+def _header(data):
+    ''' (codec id, raw length) or None when data is a bare raw chunk '''
+    if len(data) < HEADER.size or not data.startswith(MAGIC):
+        return None
+    magic, codec_id, raw_length = HEADER.unpack_from(data, 0)
+    if codec_id != RAW and codec_id not in DECOMPRESS:
+        return None
+    return codec_id, raw_length
+
+def decode(data):
+    header = _header(data)
+    if header is None:
+        return data
+    codec_id, raw_length = header
+    if codec_id == RAW:
+        chunk = data[HEADER.size:]
+    else:
+        try:
+            chunk = DECOMPRESS[codec_id](data[HEADER.size:])
+        except:
+            return data
+    if len(chunk) != raw_length:
+        # an old raw chunk that only looked like it had a header
+        return data
+    return chunk
+
+def raw_size(head, stored_size):
+    ''' uncompressed size from the first HEADER.size bytes of a stored chunk '''
+    header = _header(head)
+    if header is None:
+        return stored_size
+    return header[1]
+
+
+class Encoder(object):
+    ''' encode a chunk at most once, for the first chunkserver that needs it '''
+    def __init__(self, chunk, codec=None, threshold=0.9):
+        self.chunk = chunk
+        self.codec = codec
+        self.threshold = threshold
+        self._encoded = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self._encoded is None:
+                self._encoded = encode(self.chunk, self.codec, self.threshold)
+            return self._encoded
+
+
+def main():
+    # ratio and speed per codec on a file
+    import sys
+    import time
+    with open(sys.argv[1], 'rb') as f:
+        data = f.read(64 * 1024 * 1024)
+    chunksize = 1024 * 1024
+    chunks = [data[i:i + chunksize] for i in xrange(0, len(data), chunksize)]
+    for codec in [None] + sorted(CODECS):
+        start = time.time()
+        stored = [encode(chunk, codec) for chunk in chunks]
+        encode_time = time.time() - start
+        start = time.time()
+        for blob in stored:
+            decode(blob)
+        decode_time = time.time() - start
+        mb = len(data) / 1024.0 / 1024.0
+        print "%-5s ratio %.2f, encode %.1f MB/s, decode %.1f MB/s" % (codec, \
+                len(data) / float(max(1, sum(len(blob) for blob in stored))), \
+                mb / max(encode_time, 1e-6), mb / max(decode_time, 1e-6))
+
+if __name__ == "__main__":
+    main()
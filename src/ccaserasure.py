@@ -0,0 +1,203 @@
+'''
+2015 John Ko <git@johnko.ca>
+Reed-Solomon erasure coding of chunks over GF(256).
+
+A chunk is cut into k data shards, zero padded to the same length, and m
+parity shards are computed from them with a Cauchy matrix, so any k of
+the k+m shards give the chunk back. The code is systematic: when the k
+data shards are all there, decoding is a join.
+
+Each shard goes to a different chunkserver under the chunk's own
+chunkuuid, behind a small header with k, m, the shard's index, the
+chunk's length and a crc32 of the shard, so a shard can be checked on
+its own and read back whatever k and m the store uses now.
+
+Multiplying a shard by a coefficient is a str.translate through a 256
+byte table, which beats a numpy table lookup. Shards are then summed
+with numpy's xor when it is installed, else as longs.
+'''
+import binascii
+import struct
+import zlib
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = '\x00CRS'
+HEADER = struct.Struct('<4sBBBxIQ') # magic, k, m, shard index, crc32 of the shard, chunk length
+
+# log and exp tables for GF(2^8) with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+EXP = [0] * 512
+LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+# a 256 byte table per coefficient: table[x] is coefficient times x
+_TABLES = [''.join(chr(gf_mul(c, x)) for x in range(256)) for c in range(256)]
+
+
+def check_shape(k, m):
+    if not (k >= 1 and m >= 0 and k + m <= 256):
+        raise ValueError("erasure coding needs k of at least 1, m of at least 0 and k + m of at most 256")
+
+def parity_matrix(k, m):
+    ''' m rows of k coefficients, a Cauchy matrix, so any k rows of the
+    identity on top of it are invertible '''
+    return [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+
+def _matrix_row(k, m, index):
+    if index < k:
+        return [1 if j == index else 0 for j in range(k)]
+    return parity_matrix(k, m)[index - k]
+
+def invert(matrix):
+    ''' Gauss-Jordan over GF(256) '''
+    n = len(matrix)
+    rows = [list(row) + [1 if j == i else 0 for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("matrix is singular")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(scale, v) for v in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [v ^ gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def _combine(coefficients, shards, size):
+    ''' sum over GF(256) of coefficient times shard, bytewise '''
+    if numpy is not None:
+        acc = numpy.zeros(size, dtype=numpy.uint8)
+        for c, shard in zip(coefficients, shards):
+            if c == 0:
+                continue
+            if c != 1:
+                shard = shard.translate(_TABLES[c])
+            acc ^= numpy.frombuffer(shard, dtype=numpy.uint8)
+        return acc.tostring()
+    acc = 0
+    for c, shard in zip(coefficients, shards):
+        if c == 0 or not size:
+            continue
+        if c != 1:
+            shard = shard.translate(_TABLES[c])
+        acc ^= long(binascii.hexlify(shard), 16)
+    return binascii.unhexlify('%0*x' % (size * 2, acc)) if size else ''
+
+def _pack(k, m, index, length, shard):
+    return HEADER.pack(MAGIC, k, m, index, zlib.crc32(shard) & 0xffffffff, length) + shard
+
+def encode(chunk, k, m):
+    ''' the k + m shards of chunk, headers included '''
+    check_shape(k, m)
+    size = (len(chunk) + k - 1) // k
+    padded = chunk + '\x00' * (size * k - len(chunk))
+    data = [padded[j * size:(j + 1) * size] for j in range(k)]
+    parity = [_combine(row, data, size) for row in parity_matrix(k, m)]
+    return [_pack(k, m, i, len(chunk), shard) for i, shard in enumerate(data + parity)]
+
+def reencode(chunk, k, m, indexes):
+    ''' only the shards at indexes, to write back over lost ones '''
+    shards = encode(chunk, k, m)
+    return dict((i, shards[i]) for i in indexes)
+
+
+class Shard(object):
+    __slots__ = ('k', 'm', 'index', 'length', 'data')
+
+    def __init__(self, k, m, index, length, data):
+        self.k = k
+        self.m = m
+        self.index = index
+        self.length = length
+        self.data = data
+
+    def shape(self):
+        ''' shards only decode together when they agree on this '''
+        return (self.k, self.m, self.length)
+
+
+def is_shard(data):
+    return data is not None and len(data) >= HEADER.size and data.startswith(MAGIC)
+
+def parse(data):
+    ''' the Shard in stored data, None when data is not a good shard '''
+    if not is_shard(data):
+        return None
+    magic, k, m, index, crc, length = HEADER.unpack_from(data, 0)
+    shard = data[HEADER.size:]
+    if k < 1 or index >= k + m or len(shard) != (length + k - 1) // k:
+        return None
+    if zlib.crc32(shard) & 0xffffffff != crc:
+        return None
+    return Shard(k, m, index, length, shard)
+
+def decode(shards):
+    ''' the chunk from at least k Shards of the same shape, None when
+    there are too few of them '''
+    shards = dict((shard.index, shard) for shard in shards)
+    if not shards:
+        return None
+    k, m, length = next(iter(shards.values())).shape()
+    if len(shards) < k or any(shard.shape() != (k, m, length) for shard in shards.values()):
+        return None
+    size = (length + k - 1) // k
+    if all(j in shards for j in range(k)):
+        return ''.join(shards[j].data for j in range(k))[:length]
+    # the data shards that are there, and enough parity for the rest
+    indexes = sorted(shards)[:k]
+    inverse = invert([_matrix_row(k, m, i) for i in indexes])
+    given = [shards[i].data for i in indexes]
+    data = []
+    for j in range(k):
+        if j in shards:
+            data.append(shards[j].data)
+        else:
+            data.append(_combine(inverse[j], given, size))
+    return ''.join(data)[:length]
+
+
+def main():
+    # encode and decode throughput
+    import os
+    import sys
+    import time
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    m = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    chunk = os.urandom(4 * 1024 * 1024)
+    mb = len(chunk) / 1024.0 / 1024.0
+    start = time.time()
+    shards = encode(chunk, k, m)
+    print "%d+%d encode: %.1f MB/s (numpy %s)" % (k, m, mb / max(time.time() - start, 1e-6), numpy is not None)
+    parsed = [parse(shard) for shard in shards]
+    start = time.time()
+    assert decode(parsed[:k]) == chunk
+    print "%d+%d decode, all data shards: %.1f MB/s" % (k, m, mb / max(time.time() - start, 1e-6))
+    start = time.time()
+    assert decode(parsed[m:]) == chunk
+    print "%d+%d decode, %d data shards lost: %.1f MB/s" % (k, m, m, mb / max(time.time() - start, 1e-6))
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@ This is modified from ZipFS and fs.remote from PyFilesystem
 ISCL License
 '''
 
+import sys
+import threading
+from errno import EINVAL
 from fs.errors import FSError
 from fs.remote import RemoteFileBuffer
 from fs.filelike import StringIO, SpooledTemporaryFile, FileWrapper
@@ -14,7 +17,7 @@ class _CCASFile(RemoteFileBuffer):
 
     max_size_in_memory = 1024 * 64
 
-    def __init__(self, fs, filename, mode, handler, close_callback, write_on_flush=True, debug=0):
+    def __init__(self, fs, filename, mode, handler, close_callback, write_on_flush=True, debug=0, stream_writes=True):
         self.debug = debug
         self.fs = fs
         self.filename = filename
@@ -24,6 +27,18 @@ class _CCASFile(RemoteFileBuffer):
         self.write_on_flush = write_on_flush
         self.offset = 0
         self.op = None
+        # read-only files read ranges straight from the chunks, no buffer
+        self._direct = False
+        self._pos = 0
+        self._chunkmap = None
+        self._stream = None # sequential reads carry on from here
+        # write-only files send chunks out as they fill, no buffer
+        self._writer = None
+        # r+ files keep their writes over the stored chunks, no buffer
+        self._overlay = None
+        # what is stored, so a flush only writes the chunks under dirty ranges
+        self._base = None
+        self._dirty = []
         wrapped_file = SpooledTemporaryFile(max_size=self.max_size_in_memory)
         self._changed = False
         self._readlen = 0  # How many bytes already loaded from rfile
@@ -32,17 +47,29 @@ class _CCASFile(RemoteFileBuffer):
             self._lock = fs._lock.__class__()
         else:
             self._lock = threading.RLock()
-        if "r" in mode or "+" in mode or "a" in mode:
+        if ("r" in mode or "+" in mode or "a" in mode) and "w" not in mode:
             if not self.ccasclient.exists(self.filename):
                 # File was just created, force to write anything
                 self.op = 'write'
                 self._changed = True
                 self._eof = True
+            else:
+                self._chunkmap = self.ccasclient.chunkmap(self.filename)
+                self._base = self._chunkmap
+                if "+" not in mode and "a" not in mode and "w" not in mode:
+                    self._direct = True
+                elif "a" not in mode:
+                    self._overlay = self.ccasclient.open_overlay(self.filename, self._chunkmap)
+                else:
+                    # the buffer is filled to eof before it is written back
+                    self.op = 'write'
         else:
-            # Do not use remote file object
+            # Do not use remote file object, w and w+ start the file over
             self.op = 'write'
             self._eof = True
             self._changed = True
+            if stream_writes and "+" not in mode:
+                self._writer = self.ccasclient.open_writer(self.filename, op='write')
         super(RemoteFileBuffer,self).__init__(wrapped_file,mode)
         # FIXME: What if mode with position on eof?
         if "a" in mode:
@@ -61,6 +88,14 @@ class _CCASFile(RemoteFileBuffer):
     def _write(self,data,flushing=False):
         if self.debug > 0: print "_CCASFile.write %s" % self.mode
         with self._lock:
+            if self._writer is not None:
+                self._writer.write(data)
+                return
+            if self._overlay is not None:
+                self._overlay.write(self._pos, data)
+                self._pos += len(data)
+                self._changed = True
+                return
             toread = len(data) - (self._readlen - self.wrapped_file.tell())
             if toread > 0:
                 if not self._eof:
@@ -68,8 +103,26 @@ class _CCASFile(RemoteFileBuffer):
                 else:
                     self._readlen += toread
             self._changed = True
+            self._mark_dirty(self.wrapped_file.tell(), self.wrapped_file.tell() + len(data))
             self.wrapped_file.write(data)
 
+    def _mark_dirty(self, start, end):
+        if self._dirty and self._dirty[-1][0] <= start <= self._dirty[-1][1]:
+            # sequential writes grow one range
+            self._dirty[-1] = (self._dirty[-1][0], max(end, self._dirty[-1][1]))
+        else:
+            self._dirty.append((start, end))
+
+    def _read_buffer(self, offset, length):
+        ''' length bytes of the file at offset, loaded from the chunks if needed '''
+        pos = self.wrapped_file.tell()
+        try:
+            self.wrapped_file.seek(offset)
+            self._fillbuffer(length)
+            return self.wrapped_file.read(length)
+        finally:
+            self.wrapped_file.seek(pos)
+
     def _read_remote(self, length=None):
         """Read data from the remote file into the local buffer."""
         chunklen = 1024 * 256
@@ -81,7 +134,7 @@ class _CCASFile(RemoteFileBuffer):
             if not toread:
                 break
             #data = self._rfile.read(toread)
-            data = self.ccasclient.read_chunk(self.filename, toread)
+            data = self.ccasclient.read_chunk(self.filename, self._readlen + bytes_read, toread, chunkmap=self._chunkmap)
             datalen = len(data)
             if not datalen:
                 self._eof = True
@@ -126,6 +179,21 @@ class _CCASFile(RemoteFileBuffer):
         if length is not None and length < 0:
             length = None
         with self._lock:
+            if self._overlay is not None:
+                data = self._overlay.read(self._pos, length)
+                self._pos += len(data)
+                if not data:
+                    data = None
+                return data
+            if self._direct:
+                if self._stream is None or self._stream.tell() != self._pos:
+                    self._close_stream()
+                    self._stream = self.ccasclient.open_stream(self.filename, self._pos, chunkmap=self._chunkmap)
+                data = self._stream.read(-1 if length is None else length)
+                self._pos += len(data)
+                if not data:
+                    data = None
+                return data
             self._fillbuffer(length)
             data = self.wrapped_file.read(length if length != None else -1)
             # data = self.ccasclient.read(self.filename, length if length != None else -1)
@@ -137,6 +205,32 @@ class _CCASFile(RemoteFileBuffer):
         self.offset = offset
         if self.debug > 0: print "_CCASFile.seek %i %i" % (offset, whence)
         with self._lock:
+            if self._direct or self._overlay is not None:
+                # nothing to load, the next read fetches only the chunks it needs
+                if whence == SEEK_SET:
+                    self._pos = offset
+                elif whence == SEEK_CUR:
+                    self._pos += offset
+                elif whence == SEEK_END:
+                    if self._overlay is not None:
+                        self._pos = self._overlay.size + offset
+                    else:
+                        self._pos = self._chunkmap.size + offset
+                else:
+                    raise IOError(EINVAL, 'Invalid whence')
+                return
+            if self._writer is not None:
+                if whence == SEEK_SET:
+                    abspos = offset
+                elif whence == SEEK_CUR:
+                    abspos = self._writer.tell() + offset
+                elif whence == SEEK_END:
+                    abspos = self._writer.tell() + offset
+                else:
+                    raise IOError(EINVAL, 'Invalid whence')
+                if abspos == self._writer.tell():
+                    return
+                self._unstream()
             if not self._eof:
                 # Count absolute position of seeking
                 if whence == SEEK_SET:
@@ -157,11 +251,42 @@ class _CCASFile(RemoteFileBuffer):
                     self._fillbuffer()
             self.wrapped_file.seek(offset, whence)
 
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _unstream(self):
+        ''' a write that is not sequential needs the buffer after all,
+        fill it with what was streamed so far '''
+        writer = self._writer
+        self._writer = None
+        try:
+            writer.readback(self.wrapped_file)
+        finally:
+            writer.abort()
+        self._readlen = self.wrapped_file.tell()
+
+    def _tell(self):
+        if self._direct or self._overlay is not None:
+            return self._pos
+        if self._writer is not None:
+            return self._writer.tell()
+        return self.wrapped_file.tell()
+
     def _truncate(self,size):
-        if size == self.offset + 1:
-            self.op = 'append'
         if self.debug > 0: print "_CCASFile.truncate %i" % size
         with self._lock:
+            if self._overlay is not None:
+                self._overlay.truncate(size)
+                self._pos = min(self._pos, size)
+                self._changed = True
+                self.flush()
+                return
+            if self._writer is not None:
+                if size == self._writer.tell():
+                    return
+                self._unstream()
             if not self._eof and self._readlen < size:
                 # Read the rest of file
                 self._fillbuffer(size - self._readlen)
@@ -173,8 +298,12 @@ class _CCASFile(RemoteFileBuffer):
                 # Lock rfile
                 self._eof = True
 
+            # the position stays where it was, or moves back to the new end
+            pos = min(self.wrapped_file.tell(), size)
             self.wrapped_file.truncate(size)
+            self.wrapped_file.seek(pos)
             self._changed = True
+            self._mark_dirty(size, sys.maxint)
 
             self.flush()
             #if self._rfile is not None:
@@ -183,6 +312,9 @@ class _CCASFile(RemoteFileBuffer):
     def flush(self):
         if self.debug > 0: print "_CCASFile.flush"
         with self._lock:
+            if self._writer is not None:
+                # the file appears when the writer is closed
+                return
             self.wrapped_file.flush()
             if self.write_on_flush:
                 self._setcontents()
@@ -192,19 +324,45 @@ class _CCASFile(RemoteFileBuffer):
         if not self._changed:
             # Nothing changed, no need to write data back
             return
-        # If not all data loaded, load until eof
-        if not self._eof:
-            self._fillbuffer()
-        if "w" in self.mode or "a" in self.mode or "+" in self.mode:
-            pos = self.wrapped_file.tell()
+        if "w" not in self.mode and "a" not in self.mode and "+" not in self.mode:
+            return
+        if self._overlay is not None:
+            self._base = self._overlay.commit()
+            self._changed = False
+            return
+        pos = self.wrapped_file.tell()
+        if self._base is not None and self.op == 'write':
+            # only the chunks under the dirty ranges, the rest of the file need not be loaded
+            if self._eof:
+                self.wrapped_file.seek(0, SEEK_END)
+                size = self.wrapped_file.tell()
+                self.wrapped_file.seek(pos)
+            else:
+                size = self._base.size
+            self._base = self.ccasclient.update(self.filename, self._base, size, self._dirty, self._read_buffer)
+        else:
+            # If not all data loaded, load until eof
+            if not self._eof:
+                self._fillbuffer()
             self.wrapped_file.seek(0)
             self.ccasclient.setcontents(self.filename, self.wrapped_file, op=self.op)
             self.wrapped_file.seek(pos)
+            if self.op == 'write':
+                self._base = self.ccasclient.chunkmap(self.filename)
+        self._dirty = []
+        self._changed = False
 
     def close(self):
         if self.debug > 0: print "_CCASFile.close"
         with self._lock:
             if not self.closed:
+                self._close_stream()
+                if self._writer is not None:
+                    try:
+                        self._writer.close()
+                    finally:
+                        self._writer = None
+                        self._changed = False
                 self._setcontents()
                 #if self._rfile is not None:
                 #    self._rfile.close()
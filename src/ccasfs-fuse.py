@@ -6,7 +6,7 @@ This mounts a CCASFS with FUSE
 from ccasfs import CCASFS
 from logging import DEBUG, INFO, ERROR, CRITICAL
 import fs
-from fs.expose import fuse
+import ccasfuse
 
 logger = fs.getLogger('fs.ccasfs')
 logger.setLevel(DEBUG)
@@ -21,4 +21,5 @@ ccasfs = CCASFS( [
         write_algorithm="mirror",
         debug=2)
 
-mountpoint = fuse.mount(ccasfs, "/mnt", foreground=True, fsname="ccasfs")
+# attributes and entries are cached by the kernel for a second, file pages while unchanged
+ccasfuse.mount(ccasfs, "/mnt", attr_timeout=1.0, entry_timeout=1.0, foreground=True, fsname="ccasfs")
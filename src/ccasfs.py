@@ -6,6 +6,7 @@ ISCL License
 '''
 
 import datetime
+import time
 import os.path
 import sys
 from fs.base import *
@@ -16,6 +17,7 @@ import osfs
 import ccas
 import ccasutil
 import ccasfile
+import ccascache
 scandir = None
 try:
     scandir = os.scandir
@@ -38,19 +40,28 @@ class CCASFS(FS):
              'atomic.setcontents': False
              }
 
-    def __init__(self, root_path_array, manifest_path, index_path, catalog_path, tmp_path, write_algorithm="mirror", thread_synchronize=True, encoding='utf-8', debug=0):
+    def __init__(self, root_path_array, manifest_path, index_path, catalog_path, tmp_path, write_algorithm="mirror", thread_synchronize=True, encoding='utf-8', debug=0, chunker='fixed', compression=None, chunkserver_backend='files', metadata_backend='files', hash_algorithm=None, verify='always', placement='round-robin', data_shards=4, parity_shards=2, attr_cache_entries=100000, attr_cache_ttl=1.0):
         """Create a FS that maps to chunks.
 
         :param root_path_array: a (system) path
         :param write_algorithm: can be 'deflated' (default) to compress data or 'stored' to just store date
         :param thread_synchronize: set to True (default) to enable thread-safety
+        :param chunker: 'fixed' (default) to cut every 64 MB or 'cdc' to cut on content, averaging 64 MB
+        :param metadata_backend: 'files' (default) for the manifest and index trees or 'sqlite' for one metadata db
+        :param hash_algorithm: None to keep the store's, a new store defaults to 'sha256', see ccasutil.HASH_ALGORITHMS
+        :param verify: 'always' (default) hashes every chunk read, 'sampled' some of them, 'scrub' none outside a scrub
+        :param placement: where stripe puts each chunk, 'round-robin' (default), 'free-space', 'least-outstanding' or 'rendezvous'
+        :param data_shards: with write_algorithm 'erasure', the shards each chunk is split into, any this many of them read it back
+        :param parity_shards: with write_algorithm 'erasure', the extra shards, how many chunkservers can be lost
+        :param attr_cache_entries: how many paths to keep attributes for, 0 disables the cache
+        :param attr_cache_ttl: seconds to trust cached attributes before checking the index file again
 
         """
         super(CCASFS, self).__init__(thread_synchronize=thread_synchronize)
-        if write_algorithm in ('stripe','mirror'):
+        if write_algorithm in ('stripe','mirror','erasure'):
             self.write_algorithm = write_algorithm
         else:
-            raise ValueError("write_algorithm should be 'mirror' (default) or 'stripe'")
+            raise ValueError("write_algorithm should be 'mirror' (default), 'stripe' or 'erasure'")
 
         self.root_path_array = root_path_array
         self.debug = debug
@@ -61,8 +72,12 @@ class CCASFS(FS):
             os.makedirs(catalog_path)
         self._path_fs = osfs.OSFS(index_path) #MemoryFS()
         self.ccasmaster = ccas.CcasMaster( root_path_array, manifest_path, index_path, catalog_path, tmp_path, \
-                    write_algorithm=self.write_algorithm, debug=self.debug, chunksize=1024*1024*64 ) # 64 MB chunks
+                    write_algorithm=self.write_algorithm, debug=self.debug, chunksize=1024*1024*64, chunker=chunker, compression=compression, chunkserver_backend=chunkserver_backend, \
+                    metadata_backend=metadata_backend, hash_algorithm=hash_algorithm, verify=verify, placement=placement, \
+                    data_shards=data_shards, parity_shards=parity_shards ) # 64 MB chunks
         self.ccasclient = ccas.CcasClient(self.ccasmaster, debug=self.debug )
+        self._metadata = self.ccasmaster.metadata # None with the file trees
+        self._attr_cache = ccascache.AttrCache(attr_cache_entries, attr_cache_ttl)
         #  Enable long pathnames on win32
         if sys.platform == "win32":
             if use_long_paths and not index_path.startswith("\\\\?\\"):
@@ -89,11 +104,12 @@ class CCASFS(FS):
 
     def close(self):
         if self.debug > 0: print "CCASFS.close"
-        pass
+        self.ccasmaster.close()
 
     def setcontents(self, path, data, chunk_size=64*1024, encoding=None, errors=None, newline=None):
         if self.debug > 0: print "CCASFS.setcontents %s %s" % (path, data)
         self.ccasclient.write(path, data)
+        self._attr_cache.invalidate(normpath(relpath(path)))
 
     def open(self, path, mode='r', buffering=-1, encoding=None, errors=None, newline=None, line_buffering=False, **kwargs):
         if self.debug > 0: print "CCASFS.open %s %s" % (path, mode)
@@ -103,14 +119,18 @@ class CCASFS(FS):
             pass
         if 'w' in mode:
             # print "write %s" % mode
+            self._attr_cache.invalidate(path)
             dirname, _filename = pathsplit(path)
             if dirname:
                 self.temp_fs.makedir(dirname, recursive=True, allow_recreate=True)
-            dirpath, _filename = pathsplit(path)
-            if dirpath:
-                self._path_fs.makedir(dirpath, recursive=True, allow_recreate=True)
-            f = self._path_fs.open(path, 'w')
-            f.close()
+            if self._metadata is not None:
+                self._metadata.touch(path)
+            else:
+                dirpath, _filename = pathsplit(path)
+                if dirpath:
+                    self._path_fs.makedir(dirpath, recursive=True, allow_recreate=True)
+                f = self._path_fs.open(path, 'w')
+                f.close()
         f = ccasfile._CCASFile(self.temp_fs, path, mode, self.ccasclient, self._on_write_close, debug=self.debug)
         return f
 
@@ -118,25 +138,39 @@ class CCASFS(FS):
         if self.debug > 0: print "CCASFS.getcontents %s" % (path)
         if not self.exists(path):
             raise fs.errors.ResourceNotFoundError(path)
-        contents = self.ccasclient.read_all(path)
+        stream = self.ccasclient.open_stream(path)
+        try:
+            contents = ''.join(stream)
+        finally:
+            stream.close()
         return contents
 
     def _on_write_close(self, filename):
         if self.debug > 0: print "CCASFS._on_write_close %s" % (filename)
+        self._attr_cache.invalidate(normpath(relpath(filename)))
         # TODO notify transport layer
         return
 
     def isdir(self, path):
+        if self._metadata is not None:
+            return self._metadata.isdir(path)
         return self._path_fs.isdir(path)
 
     def isfile(self, path):
+        if self._metadata is not None:
+            return self._metadata.isfile(path)
         return self._path_fs.isfile(path)
 
     def exists(self, path):
+        if self._metadata is not None:
+            return self._metadata.exists(path)
         return self._path_fs.exists(path)
 
     def makedir(self, dirname, recursive=False, allow_recreate=False):
         dirname = normpath(dirname)
+        if self._metadata is not None:
+            self._metadata.makedir(dirname)
+            return
         self._path_fs.makedir(dirname, recursive=True, allow_recreate=True)
         fn = self._path_fs.getsyspath(os.path.join(dirname, '.__ccasfs_dir__'))
         with open(fn, "w") as f:
@@ -147,6 +181,16 @@ class CCASFS(FS):
         #  Don't remove the root directory of this FS
         if path in ('', '/'):
             raise RemoveRootError(path)
+        self._attr_cache.invalidate()
+        if self._metadata is not None:
+            if not self._metadata.removedir(path, force=force):
+                raise DirectoryNotEmptyError(path)
+            if recursive and dirname(path) not in ('', '/'):
+                try:
+                    self.removedir(dirname(path), recursive=True)
+                except DirectoryNotEmptyError:
+                    pass
+            return
         sys_path = self._path_fs.getsyspath(path)
         fn = self._path_fs.getsyspath(os.path.join(path, '.__ccasfs_dir__'))
         if os.path.isfile(fn):
@@ -167,6 +211,13 @@ class CCASFS(FS):
 
     def remove(self, path):
         if self.debug > 0: print "CCASFS.remove %s" % (path)
+        self._attr_cache.invalidate(normpath(relpath(path)))
+        if self._metadata is not None:
+            if self.ccasclient.exists(path):
+                self.ccasclient.delete(path)
+            else:
+                self._metadata.remove(path) # opened for writing but never written
+            return
         sys_path = self._path_fs.getsyspath(path)
         if self.debug > 0: print "CCASFS.remove %s" % (sys_path)
         self._path_fs.remove(path)
@@ -175,6 +226,16 @@ class CCASFS(FS):
     def listdir(self, path="/", wildcard=None, full=False, absolute=False, dirs_only=False, files_only=False):
         if self.debug > 0: print "CCASFS.listdir %s" % (path)
         #return self._path_fs.listdir(path, wildcard, full, absolute, dirs_only, files_only)
+        if self._metadata is not None:
+            if dirs_only and files_only:
+                raise ValueError("dirs_only and files_only can not both be True")
+            paths = self._metadata.listdir(path, dirs_only, files_only)
+            if paths is None:
+                raise fs.errors.ResourceNotFoundError(path)
+            if normpath(path).strip('/') == '':
+                # deleted files wait under hidden/ in the same db
+                paths = [p for p in paths if p != 'hidden']
+            return self._listdir_helper(path, paths, wildcard, full, absolute, False, False)
         sys_path = self._path_fs.getsyspath(path)
         if scandir is None:
             listing = os.listdir(sys_path)
@@ -196,17 +257,47 @@ class CCASFS(FS):
 
     def rename(self, src, dst):
         if self.debug > 0: print "CCASFS.rename %s %s" % (src, dst)
+        # a directory rename moves every path under it
+        self._attr_cache.invalidate()
+        if self._metadata is not None:
+            self.ccasclient.rename(src, dst)
+            return
         self._path_fs.rename(src, dst)
         self.ccasclient.rename(src, dst)
 
     def _stat(self, path):
         if self.debug > 0: print "CCASFS._stat %s" % (path)
         """Stat the given path, normalising error codes."""
+        path = normpath(relpath(path))
+        now = time.time()
+        info = self._attr_cache.get(path, now)
+        if info is not None:
+            return info
+        if self._metadata is not None:
+            # the db is only changed through us, there is nothing to validate against
+            self._attr_cache.validate(path, None, now)
+            info = self._metadata.stat(path)
+            if info is None:
+                raise fs.errors.ResourceNotFoundError(path)
+            info['size'] = info['st_size']
+            self._attr_cache.put(path, None, info, now)
+            return info
         try:
-            return _os_stat(path)
-        except fs.errors.ResourceInvalidError:
+            sys_path = self._path_fs.getsyspath(path)
+            stats = os.lstat(sys_path)
+            # the torrent is only read again when the index file changed
+            validator = (stats.st_ino, stats.st_mtime, stats.st_size)
+            info = self._attr_cache.validate(path, validator, now)
+            if info is None:
+                info = _os_stat(sys_path, stats)
+                self._attr_cache.put(path, validator, info, now)
+            return info
+        except (OSError, fs.errors.ResourceInvalidError):
             raise fs.errors.ResourceNotFoundError(path)
 
+    def attr_cache_stats(self):
+        return self._attr_cache.stats()
+
     def getmeta(self, meta_name, default=NoDefaultMeta):
         if meta_name == 'free_space':
             if platform.system() == 'Windows':
@@ -240,8 +331,7 @@ class CCASFS(FS):
         if self.debug > 0: print "CCASFS.getinfo %s" % (path)
         if not self.exists(path):
             raise fs.errors.ResourceNotFoundError(path)
-        fn = self._path_fs.getsyspath(path)
-        info = self._stat(fn)
+        info = self._stat(path)
         info['size'] = info['st_size']
         #  TODO: this doesn't actually mean 'creation time' on unix
         fromtimestamp = datetime.datetime.fromtimestamp
@@ -259,32 +349,32 @@ class CCASFS(FS):
     def getinfokeys(self, path, *keys):
         if self.debug > 0: print "CCASFS.getinfokeys %s" % (path)
         info = {}
-        fn = self._path_fs.getsyspath(path)
-        stats = self._stat(fn)
+        stats = self._stat(path)
         fromtimestamp = datetime.datetime.fromtimestamp
         for key in keys:
             try:
                 if key == 'size':
-                    info[key] = stats.st_size
+                    info[key] = stats['st_size']
                 elif key == 'modified_time':
-                    info[key] = fromtimestamp(stats.st_mtime)
+                    info[key] = fromtimestamp(stats['st_mtime'])
                 elif key == 'created_time':
-                    info[key] = fromtimestamp(stats.st_ctime)
+                    info[key] = fromtimestamp(stats['st_ctime'])
                 elif key == 'accessed_time':
-                    info[key] = fromtimestamp(stats.st_atime)
+                    info[key] = fromtimestamp(stats['st_atime'])
                 else:
-                    info[key] = getattr(stats, key)
-            except AttributeError:
+                    info[key] = stats[key]
+            except KeyError:
                 continue
         return info
 
     def getsize(self, path):
-        return self._stat(path).st_size
+        return self._stat(path)['st_size']
 
-def _os_stat(path):
+def _os_stat(path, stats=None):
     """Replacement for os.stat that raises FSError subclasses."""
     st_size = None
-    stats = os.lstat(path)
+    if stats is None:
+        stats = os.lstat(path)
     info = dict((k, getattr(stats, k)) for k in ('st_atime', 'st_ctime',
             'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
     torrent = ccasutil.read_torrent(path)
@@ -0,0 +1,251 @@
+'''
+2015 John Ko <git@johnko.ca>
+FUSE operations for a CCASFS, without the PyFilesystem file wrapper.
+
+Files opened read-only are served straight from the chunks: sequential
+reads carry on from one ChunkStream, so read-ahead keeps the chunkservers
+busy, and a seek only starts a new stream. Files opened for writing go
+through the CCASFS file objects.
+
+Chunks never change, so the kernel may keep a file's pages across opens
+for as long as the file's manifest lists the same chunks. Attribute and
+entry timeouts are mount options.
+
+fusepy is used when it is installed, else the copy in fs.expose.fuse.
+'''
+import errno
+import hashlib
+import os
+import stat
+import threading
+import fs.errors
+from fs.path import normpath, relpath
+try:
+    from fuse import FUSE, Operations
+except (ImportError, EnvironmentError):
+    try:
+        from fs.expose.fuse.fuse3 import FUSE, Operations
+    except (ImportError, EnvironmentError):
+        FUSE = None
+        Operations = object
+
+O_ACCMODE = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+
+
+def _version(chunkmap):
+    ''' the chunks a manifest lists name its content, a rewrite of the same
+    size within the mtime resolution still changes them '''
+    digest = hashlib.sha1()
+    for chunkuuid in chunkmap.chunkuuids:
+        digest.update(chunkuuid)
+    return (chunkmap.size, digest.digest())
+
+
+class _ReadHandle(object):
+    def __init__(self, client, path, chunkmap):
+        self.client = client
+        self.path = path
+        self.chunkmap = chunkmap
+        self.stream = None
+        self.lock = threading.Lock()
+
+    def read(self, size, offset):
+        with self.lock:
+            if self.stream is None or self.stream.tell() != offset:
+                if self.stream is not None:
+                    self.stream.close()
+                self.stream = self.client.open_stream(self.path, offset, chunkmap=self.chunkmap)
+            return self.stream.read(size)
+
+    def close(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            self.chunkmap.close()
+
+
+class _FileHandle(object):
+    def __init__(self, f):
+        self.f = f
+        self.lock = threading.Lock()
+
+    def read(self, size, offset):
+        with self.lock:
+            self.f.seek(offset)
+            return self.f.read(size)
+
+    def write(self, data, offset):
+        with self.lock:
+            self.f.seek(offset)
+            self.f.write(data)
+            return len(data)
+
+    def truncate(self, length):
+        with self.lock:
+            self.f.truncate(length)
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+class CcasFuse(Operations):
+    def __init__(self, ccasfs, debug=0):
+        self.debug = debug
+        self.fs = ccasfs
+        self.client = ccasfs.ccasclient
+        self.handles = {}
+        self.next_fh = 1
+        self.cached = {} # path to the _version() the kernel may have pages of
+        self._lock = threading.Lock()
+
+    def __call__(self, op, *args):
+        if self.debug > 0: print "CcasFuse.%s %s" % (op, args[:1])
+        if not hasattr(self, op):
+            raise OSError(errno.EFAULT, '')
+        try:
+            return getattr(self, op)(*args)
+        except fs.errors.ResourceNotFoundError:
+            raise OSError(errno.ENOENT, '')
+        except fs.errors.DirectoryNotEmptyError:
+            raise OSError(errno.ENOTEMPTY, '')
+        except fs.errors.ResourceInvalidError:
+            raise OSError(errno.EINVAL, '')
+
+    def _path(self, path):
+        return normpath(relpath(path))
+
+    def _add_handle(self, handle):
+        with self._lock:
+            fh = self.next_fh
+            self.next_fh += 1
+            self.handles[fh] = handle
+        return fh
+
+    def getattr(self, path, fh=None):
+        path = self._path(path)
+        if path and not self.fs.exists(path):
+            raise OSError(errno.ENOENT, '')
+        info = self.fs._stat(path)
+        attrs = dict((k, info[k]) for k in ('st_mode', 'st_nlink', 'st_size', 'st_uid', 'st_gid', \
+                        'st_atime', 'st_mtime', 'st_ctime') if k in info)
+        if path and self.fs.isdir(path):
+            attrs['st_mode'] = stat.S_IFDIR | (attrs.get('st_mode', 0755) & 07777)
+        elif path:
+            attrs['st_mode'] = stat.S_IFREG | (attrs.get('st_mode', 0644) & 07777)
+        return attrs
+
+    def readdir(self, path, fh):
+        return ['.', '..'] + [name.encode('utf-8') if isinstance(name, unicode) else name for name in self.fs.listdir(self._path(path))]
+
+    def open(self, path, fi):
+        path = self._path(path)
+        accmode = fi.flags & O_ACCMODE
+        if accmode == os.O_RDONLY and self.client.exists(path):
+            # read from the manifest, not through the attribute cache
+            chunkmap = self.client.chunkmap(path)
+            version = _version(chunkmap)
+            with self._lock:
+                # keep the kernel's pages only while the file is unchanged
+                fi.keep_cache = 1 if self.cached.get(path) == version else 0
+                self.cached[path] = version
+            fi.fh = self._add_handle(_ReadHandle(self.client, path, chunkmap))
+            return 0
+        if fi.flags & os.O_TRUNC:
+            mode = 'w+' if accmode == os.O_RDWR else 'w'
+        elif accmode == os.O_RDONLY:
+            mode = 'r'
+        else:
+            mode = 'r+'
+        with self._lock:
+            self.cached.pop(path, None)
+        fi.fh = self._add_handle(_FileHandle(self.fs.open(path, mode)))
+        return 0
+
+    def create(self, path, mode, fi):
+        path = self._path(path)
+        with self._lock:
+            self.cached.pop(path, None)
+        fi.fh = self._add_handle(_FileHandle(self.fs.open(path, 'w')))
+        return 0
+
+    def read(self, path, size, offset, fi):
+        return self.handles[fi.fh].read(size, offset)
+
+    def write(self, path, data, offset, fi):
+        return self.handles[fi.fh].write(data, offset)
+
+    def truncate(self, path, length, fi=None):
+        if fi is not None and fi.fh in self.handles and hasattr(self.handles[fi.fh], 'truncate'):
+            self.handles[fi.fh].truncate(length)
+            return 0
+        path = self._path(path)
+        with self._lock:
+            self.cached.pop(path, None)
+        f = self.fs.open(path, 'r+' if length else 'w')
+        try:
+            f.truncate(length)
+        finally:
+            f.close()
+        return 0
+
+    def flush(self, path, fi):
+        handle = self.handles.get(fi.fh)
+        if hasattr(handle, 'flush'):
+            handle.flush()
+        return 0
+
+    def release(self, path, fi):
+        with self._lock:
+            handle = self.handles.pop(fi.fh, None)
+        if handle is not None:
+            handle.close()
+        return 0
+
+    def fsync(self, path, datasync, fi):
+        return self.flush(path, fi)
+
+    def unlink(self, path):
+        path = self._path(path)
+        with self._lock:
+            self.cached.pop(path, None)
+        self.fs.remove(path)
+
+    def mkdir(self, path, mode):
+        self.fs.makedir(self._path(path))
+
+    def rmdir(self, path):
+        self.fs.removedir(self._path(path))
+
+    def rename(self, old, new):
+        with self._lock:
+            self.cached.clear()
+        self.fs.rename(self._path(old), self._path(new))
+
+    def chmod(self, path, mode):
+        return 0
+
+    def chown(self, path, uid, gid):
+        return 0
+
+    def utimens(self, path, times=None):
+        return 0
+
+    def statfs(self, path):
+        stv = os.statvfs(self.fs.root_path_array[0])
+        return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree', 'f_blocks', 'f_bsize', 'f_favail', \
+                        'f_ffree', 'f_files', 'f_flag', 'f_frsize', 'f_namemax'))
+
+
+def mount(ccasfs, mountpoint, attr_timeout=1.0, entry_timeout=1.0, foreground=True, nothreads=False, debug=0, **kwargs):
+    ''' mount until unmounted, kwargs are passed on as FUSE mount options '''
+    if FUSE is None:
+        raise ImportError("FUSE is not available, install fusepy and libfuse")
+    kwargs.setdefault('fsname', 'ccasfs')
+    FUSE(CcasFuse(ccasfs, debug=debug), mountpoint, raw_fi=True, foreground=foreground, nothreads=nothreads, \
+            attr_timeout=attr_timeout, entry_timeout=entry_timeout, **kwargs)
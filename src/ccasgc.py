@@ -0,0 +1,339 @@
+'''
+2015 John Ko <git@johnko.ca>
+Mark and sweep garbage collection of chunks no manifest refers to.
+
+Mark streams every live manifest and writes the chunkuuids it finds into
+sorted runs on disk, a run at a time, so memory stays bounded whatever
+the size of the store. Deleted manifests under hidden/deleted count as
+live until they are older than the retention window.
+
+Sweep merges the runs back into one sorted stream and walks it alongside
+each chunkserver's own sorted list of chunks: anything on a chunkserver
+and not in the stream is garbage.
+
+Progress is saved in a state file as it goes, so a collection that is
+stopped, or run with a limit, carries on where it left off. Writes that
+finish while a collection is running are picked up again before each
+sweep. A chunk a writer claims during the sweep itself is kept: each one
+is checked again under the master's claim lock right before it is
+deleted, so a racing writer either keeps it or finds it gone and writes
+it again.
+
+An unmarked chunk with a reference count is either in a file allocated
+since the last look at recent manifests, or its count leaked when a
+writer crashed. Those are put aside and checked against the manifests
+written since then, and any claim given up meanwhile. What is left is
+deleted and its count forgotten.
+'''
+import heapq
+import json
+import os
+import shutil
+import time
+
+RUN_SIZE = 1000000 # chunkuuids per sorted run, about 70 MB to sort
+
+
+class GarbageCollector(object):
+    def __init__(self, master, state_path=None, retention=0, run_size=RUN_SIZE, debug=0):
+        self.debug = debug
+        self.master = master
+        if state_path is None:
+            state_path = os.path.join(master.meta_path, 'gc')
+        self.state_path = state_path
+        self.retention = retention # seconds to keep deleted files recoverable
+        self.run_size = run_size
+        if not os.access(self.state_path, os.W_OK):
+            os.makedirs(self.state_path)
+        self.state = self.load_state()
+
+    def _path(self, name):
+        return os.path.join(self.state_path, name)
+
+    def load_state(self):
+        try:
+            with open(self._path('state.json'), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save_state(self):
+        tmp_path = self._path('state.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_path, self._path('state.json'))
+
+    def reset(self):
+        ''' forget a collection in progress '''
+        for fn in os.listdir(self.state_path):
+            if fn.startswith('run-') or fn in ('recent', 'expired', 'state.json'):
+                os.remove(self._path(fn))
+        self.state = None
+
+    def start(self):
+        self.reset()
+        self.state = {
+            'started': time.time(),
+            'retention': self.retention,
+            'phase': 'mark',
+            'runs': 0,
+            'marked_through': None, # last manifest already in a run
+            'manifests': 0,
+            'expired': 0,
+            'swept': {}, # loc to the last chunkuuid swept there
+            'scanned': 0,
+            'garbage': 0,
+            'garbage_bytes': 0,
+            'leaked': 0, # counts forgotten, no manifest held them
+        }
+        self.save_state()
+
+    def _expired(self, name):
+        ''' True for a deleted manifest past the retention window '''
+        parts = name.split(os.sep)
+        if len(parts) < 5 or parts[0] != 'hidden' or parts[1] != 'deleted':
+            return False
+        try:
+            deleted = float(parts[3]) # hidden/deleted/<iso>/<timestamp>/<path>
+        except ValueError:
+            return False
+        return self.state['started'] - deleted > self.state['retention']
+
+    def _write_run(self, name, chunkuuids):
+        with open(self._path(name), 'w') as f:
+            for chunkuuid in sorted(chunkuuids):
+                f.write(chunkuuid + "\n")
+
+    def _read_run(self, name):
+        with open(self._path(name), 'r') as f:
+            for line in f:
+                yield line.rstrip("\n")
+
+    def mark(self):
+        ''' write the chunkuuids of live manifests into sorted runs '''
+        state = self.state
+        chunkuuids = set()
+        expired = open(self._path('expired'), 'a')
+        try:
+            for name in self.master.iter_manifest_names():
+                if state['marked_through'] is not None and name <= state['marked_through']:
+                    continue
+                if self._expired(name):
+                    if isinstance(name, unicode):
+                        name = name.encode('utf-8')
+                    expired.write(name + "\n")
+                    state['expired'] += 1
+                else:
+                    for chunkuuid, chunklen in self.master.read_manifest_entries(name):
+                        chunkuuids.add(chunkuuid)
+                    state['manifests'] += 1
+                if len(chunkuuids) >= self.run_size:
+                    expired.flush()
+                    self._write_run("run-%06d" % (state['runs']), chunkuuids)
+                    state['runs'] += 1
+                    state['marked_through'] = name
+                    self.save_state()
+                    chunkuuids = set()
+        finally:
+            expired.close()
+        self._write_run("run-%06d" % (state['runs']), chunkuuids)
+        state['runs'] += 1
+        state['phase'] = 'sweep'
+        self.save_state()
+        if self.debug > 0: print "GarbageCollector.mark: %d manifests in %d runs, %d deleted manifests expired" % (state['manifests'], state['runs'], state['expired'])
+
+    def mark_recent(self):
+        ''' one more run for manifests written since the collection started '''
+        self._write_run('recent', self._recent())
+
+    def _recent(self):
+        chunkuuids = set()
+        for name in self.master.iter_manifest_names():
+            if self._expired(name):
+                continue
+            try:
+                mtime = self.master.manifest_mtime(name)
+                if mtime is None or mtime < self.state['started']:
+                    continue
+                for chunkuuid, chunklen in self.master.read_manifest_entries(name):
+                    chunkuuids.add(chunkuuid)
+            except (IOError, OSError):
+                continue # renamed away under us
+        return chunkuuids
+
+    def live(self):
+        ''' every live chunkuuid once, in sorted order '''
+        runs = [self._read_run("run-%06d" % (i)) for i in range(self.state['runs'])]
+        runs.append(self._read_run('recent'))
+        last = None
+        for chunkuuid in heapq.merge(*runs):
+            if chunkuuid != last:
+                yield chunkuuid
+                last = chunkuuid
+
+    def sweep(self, dry_run=False, limit=None):
+        ''' remove unreferenced chunks, at most limit of them scanned,
+        return True once every chunkserver is done '''
+        state = self.state
+        self.mark_recent()
+        scanned = 0
+        counted = [] # unmarked chunks with a reference count, for check_counted()
+        for loc in sorted(self.master.chunkservers):
+            chunkserver = self.master.chunkservers[loc]
+            if not chunkserver.enabled or state['swept'].get(str(loc)) == '':
+                continue
+            swept_through = state['swept'].get(str(loc))
+            live = self.live()
+            next_live = next(live, None)
+            for chunkuuid in chunkserver.iter_chunkuuids():
+                if swept_through is not None and chunkuuid <= swept_through:
+                    continue
+                if limit is not None and scanned >= limit:
+                    self.check_counted(counted, dry_run)
+                    self.save_state()
+                    return False
+                while next_live is not None and next_live < chunkuuid:
+                    next_live = next(live, None)
+                scanned += 1
+                state['scanned'] += 1
+                if chunkuuid != next_live and self.sweep_one(chunkserver, loc, chunkuuid, dry_run):
+                    counted.append((chunkserver, loc, chunkuuid))
+                state['swept'][str(loc)] = chunkuuid
+                if scanned % 1000 == 0:
+                    self.check_counted(counted, dry_run)
+                    counted = []
+                    self.master.chunklocs.commit()
+                    self.save_state()
+            self.check_counted(counted, dry_run)
+            counted = []
+            # an empty string marks a chunkserver as done
+            state['swept'][str(loc)] = ''
+            self.master.chunklocs.commit()
+            self.save_state()
+        return True
+
+    def sweep_one(self, chunkserver, loc, chunkuuid, dry_run=False):
+        ''' delete a chunk missing from the mark, unless a writer has taken it
+        up since. return True for a chunk with a reference count, it is left
+        for check_counted() '''
+        master = self.master
+        with master.refs.lock:
+            # claim_chunk takes the same lock, so no writer can claim it until it is gone
+            if chunkuuid in master.claimed:
+                if self.debug > 0: print "GarbageCollector.sweep: %s%s is in use again, kept" % (chunkserver.local_filesystem_root, chunkuuid)
+                return False
+            if master.refs.count(chunkuuid) > 0:
+                return True
+            self._delete(chunkserver, loc, chunkuuid, dry_run)
+        return False
+
+    def check_counted(self, counted, dry_run=False):
+        ''' delete the (chunkserver, loc, chunkuuid) chunks sweep_one left
+        that no manifest written since the collection started lists, and
+        forget their leaked counts '''
+        if not counted:
+            return
+        master = self.master
+        with master.refs.lock:
+            # claims are given up once the manifest is written, so a file
+            # allocated while the manifests are read has either been read or
+            # shows up here
+            master.released = set()
+        try:
+            recent = self._recent()
+            for chunkserver, loc, chunkuuid in counted:
+                if chunkuuid in recent:
+                    continue
+                with master.refs.lock:
+                    if chunkuuid in master.claimed or chunkuuid in master.released:
+                        if self.debug > 0: print "GarbageCollector.sweep: %s%s is in use again, kept" % (chunkserver.local_filesystem_root, chunkuuid)
+                        continue
+                    if master.refs.count(chunkuuid) > 0:
+                        if self.debug > 0: print "GarbageCollector.sweep: %s has a leaked count of %d" % (chunkuuid, master.refs.count(chunkuuid))
+                        self.state['leaked'] += 1
+                        if not dry_run:
+                            master.refs.forget(chunkuuid)
+                    self._delete(chunkserver, loc, chunkuuid, dry_run)
+        finally:
+            with master.refs.lock:
+                master.released = None
+                master.refs.commit()
+
+    def _delete(self, chunkserver, loc, chunkuuid, dry_run):
+        self.state['garbage'] += 1
+        self.state['garbage_bytes'] += chunkserver.stored_size(chunkuuid) or 0
+        if not dry_run:
+            if self.debug > 1: print "GarbageCollector.sweep: %s%s" % (chunkserver.local_filesystem_root, chunkuuid)
+            chunkserver.delete(chunkuuid)
+            self.master.remove_chunkloc(chunkuuid, loc)
+
+    def finish(self, dry_run=False):
+        ''' drop the expired deleted manifests, their chunks are gone '''
+        if not dry_run:
+            self.master.compact_keys()
+            for name in self._read_run('expired'):
+                try:
+                    self.master.remove_manifest(name.decode('utf-8'))
+                except OSError:
+                    pass
+        report = self.report()
+        self.reset()
+        return report
+
+    def report(self):
+        state = self.state
+        return {
+            'manifests': state['manifests'],
+            'expired': state['expired'],
+            'scanned': state['scanned'],
+            'garbage': state['garbage'],
+            'garbage_bytes': state['garbage_bytes'],
+            'leaked': state['leaked'],
+        }
+
+    def collect(self, dry_run=False, limit=None):
+        ''' run or resume a collection, return its report once it is done
+        and None when limit stopped it early '''
+        if dry_run:
+            # a dry run leaves any real collection in progress alone
+            gc = GarbageCollector(self.master, self._path('dry-run'), self.retention, self.run_size, self.debug)
+            gc.start()
+            gc.mark()
+            gc.sweep(dry_run=True)
+            report = gc.finish(dry_run=True)
+            shutil.rmtree(gc.state_path)
+            return report
+        if self.state is None:
+            self.start()
+        if self.state['phase'] == 'mark':
+            self.mark()
+        if not self.sweep(limit=limit):
+            return None
+        return self.finish()
+
+
+def main():
+    # overwrite and delete, then collect
+    import tempfile
+    import ccas
+    root = tempfile.mkdtemp()
+    master = ccas.CcasMaster([os.path.join(root, 'disk0'), os.path.join(root, 'disk1')], \
+                os.path.join(root, 'meta', 'manifest'), os.path.join(root, 'meta', 'index'), \
+                os.path.join(root, 'meta', 'catalog'), os.path.join(root, 'tmp'), chunksize=4096)
+    client = ccas.CcasClient(master)
+    for i in range(10):
+        client.write("/file%d" % (i), os.urandom(4096 * 16))
+    for i in range(5):
+        client.write("/file%d" % (i), os.urandom(4096 * 16))
+    for i in range(5, 8):
+        client.delete("/file%d" % (i))
+    gc = GarbageCollector(master)
+    print "dry run: %s" % (gc.collect(dry_run=True))
+    print "collect: %s" % (gc.collect())
+    for i in (0, 8, 9):
+        assert len(client.read_all("/file%d" % (i))) == 4096 * 16
+    master.close()
+    shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
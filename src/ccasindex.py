@@ -0,0 +1,128 @@
+'''
+2015 John Ko <git@johnko.ca>
+A persistent index of which chunkservers hold each chunk.
+
+Each chunk has one row, the set of chunkservers is a bitmask of their
+location ids. The index is a cache of what is on disk: it can be rebuilt
+by walking the chunkservers, and readers fall back to probing when an
+entry is missing or stale.
+'''
+import binascii
+import os
+import sqlite3
+import threading
+import time
+
+
+class ChunkLocationIndex(object):
+    def __init__(self, path, batch=10000, debug=0):
+        self.debug = debug
+        self.path = path
+        self.batch = batch # commit after this many changes
+        self.pending = 0
+        self._lock = threading.RLock()
+        self.created = not os.path.exists(path)
+        if not os.access(os.path.dirname(path), os.W_OK):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunklocs (chunkuuid BLOB PRIMARY KEY, locs INTEGER NOT NULL) WITHOUT ROWID")
+        self.db.commit()
+
+    def _key(self, chunkuuid):
+        return buffer(binascii.unhexlify(chunkuuid))
+
+    def get(self, chunkuuid):
+        ''' set of location ids holding chunkuuid, empty when unknown '''
+        with self._lock:
+            row = self.db.execute("SELECT locs FROM chunklocs WHERE chunkuuid = ?", (self._key(chunkuuid),)).fetchone()
+        if row is None:
+            return set()
+        locs = row[0]
+        return set(loc for loc in range(locs.bit_length()) if locs & (1 << loc))
+
+    def add(self, chunkuuid, loc):
+        key = self._key(chunkuuid)
+        with self._lock:
+            self.db.execute("INSERT OR IGNORE INTO chunklocs (chunkuuid, locs) VALUES (?, 0)", (key,))
+            self.db.execute("UPDATE chunklocs SET locs = locs | ? WHERE chunkuuid = ?", (1 << loc, key))
+            self._changed()
+
+    def discard(self, chunkuuid, loc):
+        key = self._key(chunkuuid)
+        with self._lock:
+            self.db.execute("UPDATE chunklocs SET locs = locs & ? WHERE chunkuuid = ?", (~(1 << loc), key))
+            self.db.execute("DELETE FROM chunklocs WHERE chunkuuid = ? AND locs = 0", (key,))
+            self._changed()
+
+    def _changed(self):
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            self.db.commit()
+            self.pending = 0
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM chunklocs").fetchone()[0]
+
+    def __iter__(self):
+        ''' (chunkuuid, set of location ids) for every indexed chunk '''
+        key = buffer('')
+        while True:
+            # a page at a time, so neither memory nor the lock is held for the whole walk
+            with self._lock:
+                rows = self.db.execute("SELECT chunkuuid, locs FROM chunklocs WHERE chunkuuid > ? ORDER BY chunkuuid LIMIT 1000", (key,)).fetchall()
+            if not rows:
+                break
+            for key, locs in rows:
+                yield binascii.hexlify(key), set(loc for loc in range(locs.bit_length()) if locs & (1 << loc))
+
+    def rebuild(self, chunkservers):
+        ''' forget everything and walk every enabled chunkserver '''
+        with self._lock:
+            self.db.execute("DELETE FROM chunklocs")
+            for loc in chunkservers:
+                if not chunkservers[loc].enabled:
+                    continue
+                if self.debug > 0: print "ChunkLocationIndex.rebuild: walking %s" % (chunkservers[loc].local_filesystem_root)
+                for chunkuuid in chunkservers[loc].iter_chunkuuids():
+                    self.add(chunkuuid, loc)
+            self.commit()
+
+    def close(self):
+        with self._lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+
+def main():
+    # lookup latency for a large index
+    import hashlib
+    import random
+    import sys
+    import tempfile
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    path = os.path.join(tempfile.mkdtemp(), 'chunkloc.db')
+    index = ChunkLocationIndex(path)
+    start = time.time()
+    for i in xrange(count):
+        index.add(hashlib.sha256(str(i)).hexdigest(), i % 4)
+    index.commit()
+    print "%d chunks indexed in %.1fs, %d MB on disk" % (count, time.time() - start, os.path.getsize(path) / 1024 / 1024)
+    lookups = 100000
+    keys = [hashlib.sha256(str(random.randrange(count))).hexdigest() for i in xrange(lookups)]
+    start = time.time()
+    for key in keys:
+        index.get(key)
+    print "%.1f us per lookup" % ((time.time() - start) / lookups * 1000000)
+    index.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+'''
+2015 John Ko <git@johnko.ca>
+Manifests list the chunks of a file in order.
+
+The binary layout is made to be mmap'd and read in place:
+
+    header   MAGIC, version, digest size, chunk count
+    digests  count raw digests of digest size bytes each
+    padding  up to a multiple of 8 bytes
+    offsets  count + 1 little-endian uint64, where chunk i starts and
+             the last one is the file size
+
+Chunk i is found without parsing anything else, and the chunk holding
+a byte offset is a binary search over the offsets.
+
+The older text layout, one "chunkuuid [length]" per line, is still read.
+'''
+import binascii
+import bisect
+import mmap
+import os
+import struct
+import uuid
+
+MAGIC = 'CCASMANI'
+VERSION = 1
+HEADER = struct.Struct('<8sHHIQ') # magic, version, digest size, reserved, count
+OFFSET = struct.Struct('<Q')
+
+
+class ChunkMap(object):
+    ''' chunk uuids of a file and the offset where each one starts '''
+    def __init__(self, chunkuuids, chunklens):
+        self.chunkuuids = chunkuuids
+        self.offsets = [0]
+        for chunklen in chunklens:
+            self.offsets.append(self.offsets[-1] + chunklen)
+        self.size = self.offsets[-1]
+
+    def __len__(self):
+        return len(self.chunkuuids)
+
+    def find(self, offset):
+        ''' index of the chunk holding offset '''
+        return bisect.bisect_right(self.offsets, offset, 0, len(self.chunkuuids)) - 1
+
+    def close(self):
+        pass
+
+
+class _DigestView(object):
+    def __init__(self, data, start, count, digest_size):
+        self.data = data
+        self.start = start
+        self.count = count
+        self.digest_size = digest_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0: i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        pos = self.start + i * self.digest_size
+        return binascii.hexlify(self.data[pos:pos + self.digest_size])
+
+
+class _OffsetView(object):
+    def __init__(self, data, start, count):
+        self.data = data
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0: i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return OFFSET.unpack_from(self.data, self.start + i * OFFSET.size)[0]
+
+
+class Manifest(ChunkMap):
+    ''' a binary manifest read in place from a string or an mmap '''
+    def __init__(self, data):
+        magic, version, digest_size, reserved, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("not a binary manifest")
+        if version != VERSION:
+            raise ValueError("unsupported manifest version %d" % version)
+        self.data = data
+        self.version = version
+        self.digest_size = digest_size
+        offsets_start = _offsets_start(count, digest_size)
+        if len(data) < offsets_start + (count + 1) * OFFSET.size:
+            raise ValueError("truncated manifest")
+        self.chunkuuids = _DigestView(data, HEADER.size, count, digest_size)
+        self.offsets = _OffsetView(data, offsets_start, count + 1)
+        self.size = self.offsets[count]
+
+    def find(self, offset):
+        ''' index of the chunk holding offset '''
+        lo = 0
+        hi = len(self.chunkuuids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if offset < self.offsets[mid]:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo - 1
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(data)
+        except:
+            data.close()
+            raise
+
+
+def _offsets_start(count, digest_size):
+    end = HEADER.size + count * digest_size
+    return end + (-end % OFFSET.size)
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def pack(chunkuuids, chunklens):
+    digests = [binascii.unhexlify(c) for c in chunkuuids]
+    digest_size = len(digests[0]) if digests else 32
+    count = len(digests)
+    parts = [HEADER.pack(MAGIC, VERSION, digest_size, 0, count)]
+    parts.extend(digests)
+    parts.append('\0' * (_offsets_start(count, digest_size) - HEADER.size - count * digest_size))
+    offset = 0
+    parts.append(OFFSET.pack(offset))
+    for chunklen in chunklens:
+        offset += chunklen
+        parts.append(OFFSET.pack(offset))
+    return ''.join(parts)
+
+def write_binary(path, chunkuuids, chunklens):
+    # replace rather than rewrite, readers may have the old one mmap'd
+    tmp_path = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        f.write(pack(chunkuuids, chunklens))
+    os.rename(tmp_path, path)
+
+def read_text_entries(path):
+    ''' (chunkuuid, length) per line, length is None when it was left out '''
+    with open(path, 'r') as f:
+        data = f.read()
+    entries = []
+    for line in data.split("\n"):
+        fields = line.split()
+        if len(fields) == 1:
+            entries.append((fields[0], None))
+        elif len(fields) == 2:
+            entries.append((fields[0], int(fields[1])))
+    return entries
+
+def write_text(path, chunkuuids, chunklens):
+    with open(path, "w") as f:
+        # one "chunkuuid length" per line, length is left out when unknown
+        f.write("%s" % ("\n".join(c if l is None else "%s %d" % (c, l) for c, l in zip(chunkuuids, chunklens))))
+
+def entries(manifest):
+    ''' (chunkuuid, length) for every chunk of a ChunkMap '''
+    return [(manifest.chunkuuids[i], manifest.offsets[i + 1] - manifest.offsets[i]) for i in range(len(manifest))]
+
+def read_entries(path):
+    if is_binary(path):
+        manifest = Manifest.open(path)
+        try:
+            return entries(manifest)
+        finally:
+            manifest.close()
+    return read_text_entries(path)
+
+
+def main():
+    # dump a manifest
+    import sys
+    for path in sys.argv[1:]:
+        print "%s (%s)" % (path, 'binary' if is_binary(path) else 'text')
+        for chunkuuid, chunklen in read_entries(path):
+            print "  %s %s" % (chunkuuid, chunklen)
+
+if __name__ == "__main__":
+    main()
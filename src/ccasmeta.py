@@ -0,0 +1,312 @@
+'''
+2015 John Ko <git@johnko.ca>
+File metadata in one sqlite database, instead of three file trees.
+
+Each file and directory is a row holding its path, parent, attributes,
+torrent and binary manifest, so a stat is one indexed lookup and a
+listdir one range over the parent index, with no bdecode. Paths have no
+leading slash and the root directory is ''.
+
+Deleted files keep the same hidden/deleted/<iso>/<timestamp>/<path>
+names as with manifest files, so the garbage collector and retention
+work the same on both.
+'''
+import os
+import sqlite3
+import stat
+import threading
+import time
+import ccasmanifest
+import ccasutil
+
+DIR = 0
+FILE = 1
+
+
+def _norm(path):
+    if isinstance(path, str):
+        path = path.decode('utf-8')
+    return path.strip('/')
+
+def _parent(path):
+    if '/' not in path:
+        return u''
+    return path.rsplit('/', 1)[0]
+
+def _name(path):
+    return path.rsplit('/', 1)[-1]
+
+def _below(path):
+    ''' range of paths under a directory, '0' sorts right after '/' '''
+    if not path:
+        return u'', u'\uffff'
+    return path + u'/', path + u'0'
+
+
+class MetadataDB(object):
+    def __init__(self, path, debug=0):
+        self.debug = debug
+        self.path = path
+        self._lock = threading.RLock()
+        self.created = not os.path.exists(path)
+        if not os.access(os.path.dirname(path), os.W_OK):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, parent TEXT NOT NULL, name TEXT NOT NULL, " \
+                        "kind INTEGER NOT NULL, size INTEGER NOT NULL, ctime REAL NOT NULL, mtime REAL NOT NULL, torrent BLOB, manifest BLOB)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent, name)")
+        self.db.execute("INSERT OR IGNORE INTO nodes (path, parent, name, kind, size, ctime, mtime) VALUES ('', '', '', ?, 0, ?, ?)", (DIR, time.time(), time.time()))
+        self.db.commit()
+
+    def _get(self, path, columns):
+        return self.db.execute("SELECT %s FROM nodes WHERE path = ?" % (columns), (path,)).fetchone()
+
+    def _makedirs(self, path, now):
+        ''' create path and its missing parents as directories '''
+        while True:
+            row = self._get(path, "kind")
+            if row is not None:
+                if row[0] != DIR:
+                    raise ValueError("not a directory: %s" % path)
+                return
+            self.db.execute("INSERT INTO nodes (path, parent, name, kind, size, ctime, mtime) VALUES (?, ?, ?, ?, 0, ?, ?)", \
+                            (path, _parent(path), _name(path), DIR, now, now))
+            path = _parent(path)
+
+    def _file(self, path, now):
+        ''' the file row for path, created empty in its parents when missing '''
+        row = self._get(path, "kind")
+        if row is None:
+            self._makedirs(_parent(path), now)
+            self.db.execute("INSERT INTO nodes (path, parent, name, kind, size, ctime, mtime) VALUES (?, ?, ?, ?, 0, ?, ?)", \
+                            (path, _parent(path), _name(path), FILE, now, now))
+        elif row[0] != FILE:
+            raise ValueError("not a file: %s" % path)
+
+    def touch(self, path):
+        path = _norm(path)
+        with self._lock:
+            self._file(path, time.time())
+            self.db.commit()
+
+    def makedir(self, path):
+        path = _norm(path)
+        with self._lock:
+            self._makedirs(path, time.time())
+            self.db.commit()
+
+    def put_manifest(self, path, chunkuuids, chunklens, mtime=None):
+        path = _norm(path)
+        with self._lock:
+            now = time.time()
+            self._file(path, now)
+            self.db.execute("UPDATE nodes SET manifest = ?, size = ?, mtime = ? WHERE path = ?", \
+                            (buffer(ccasmanifest.pack(chunkuuids, chunklens)), sum(chunklens), mtime or now, path))
+            self.db.commit()
+
+    def get_manifest(self, path):
+        ''' a binary manifest, None when the file has none '''
+        with self._lock:
+            row = self._get(_norm(path), "manifest")
+        if row is None or row[0] is None:
+            return None
+        return ccasmanifest.Manifest(str(row[0]))
+
+    def put_torrent(self, path, torrent):
+        path = _norm(path)
+        with self._lock:
+            now = time.time()
+            self._file(path, now)
+            self.db.execute("UPDATE nodes SET torrent = ?, size = ?, mtime = ? WHERE path = ?", \
+                            (buffer(ccasutil.encode_torrent(torrent)), torrent['info']['length'], now, path))
+            self.db.commit()
+
+    def get_torrent(self, path):
+        with self._lock:
+            row = self._get(_norm(path), "torrent")
+        if row is None or row[0] is None:
+            return None
+        return ccasutil.decode_torrent(str(row[0]))
+
+    def has_manifest(self, path):
+        with self._lock:
+            row = self._get(_norm(path), "manifest IS NOT NULL")
+        return row is not None and bool(row[0])
+
+    def exists(self, path):
+        with self._lock:
+            return self._get(_norm(path), "kind") is not None
+
+    def isdir(self, path):
+        with self._lock:
+            row = self._get(_norm(path), "kind")
+        return row is not None and row[0] == DIR
+
+    def isfile(self, path):
+        with self._lock:
+            row = self._get(_norm(path), "kind")
+        return row is not None and row[0] == FILE
+
+    def stat(self, path):
+        ''' os.stat style info, None when path does not exist '''
+        with self._lock:
+            row = self._get(_norm(path), "kind, size, ctime, mtime")
+        if row is None:
+            return None
+        kind, size, ctime, mtime = row
+        if kind == DIR:
+            mode = stat.S_IFDIR | 0755
+        else:
+            mode = stat.S_IFREG | 0644
+        return {'st_mode': mode, 'st_size': size, 'st_nlink': 1, 'st_uid': os.getuid(), 'st_gid': os.getgid(), \
+                'st_ctime': ctime, 'st_mtime': mtime, 'st_atime': mtime}
+
+    def mtime(self, path):
+        with self._lock:
+            row = self._get(_norm(path), "mtime")
+        if row is None:
+            return None
+        return row[0]
+
+    def listdir(self, path, dirs_only=False, files_only=False):
+        path = _norm(path)
+        query = "SELECT name FROM nodes WHERE parent = ? AND path != ''"
+        if dirs_only:
+            query += " AND kind = %d" % (DIR)
+        elif files_only:
+            query += " AND kind = %d" % (FILE)
+        with self._lock:
+            if self._get(path, "kind") is None:
+                return None
+            return [row[0] for row in self.db.execute(query + " ORDER BY name", (path,))]
+
+    def iter_files(self, prefix=''):
+        ''' paths of every file under prefix with a manifest, in sorted order '''
+        start, end = _below(_norm(prefix))
+        while True:
+            # a page at a time, so the lock is not held for the whole walk
+            with self._lock:
+                rows = self.db.execute("SELECT path FROM nodes WHERE path > ? AND path < ? AND manifest IS NOT NULL ORDER BY path LIMIT 1000", (start, end)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                start = row[0]
+                yield start
+
+    def rename(self, old_path, new_path):
+        old_path = _norm(old_path)
+        new_path = _norm(new_path)
+        with self._lock:
+            try:
+                now = time.time()
+                if self._get(old_path, "kind") is None:
+                    raise OSError("no such file or directory: %s" % old_path)
+                self._makedirs(_parent(new_path), now)
+                # like os.rename, a file in the way is replaced
+                self.db.execute("DELETE FROM nodes WHERE path = ? AND kind = ?", (new_path, FILE))
+                self.db.execute("UPDATE nodes SET path = ?, parent = ?, name = ? WHERE path = ?", \
+                                (new_path, _parent(new_path), _name(new_path), old_path))
+                start, end = _below(old_path)
+                for row_id, path in self.db.execute("SELECT id, path FROM nodes WHERE path >= ? AND path < ?", (start, end)).fetchall():
+                    path = new_path + path[len(old_path):]
+                    self.db.execute("UPDATE nodes SET path = ?, parent = ? WHERE id = ?", (path, _parent(path), row_id))
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+
+    def remove(self, path, prune=False):
+        ''' remove a file, and with prune the directories it leaves empty '''
+        path = _norm(path)
+        with self._lock:
+            self.db.execute("DELETE FROM nodes WHERE path = ? AND kind = ?", (path, FILE))
+            while prune and path:
+                path = _parent(path)
+                if not path or self.db.execute("SELECT 1 FROM nodes WHERE parent = ? LIMIT 1", (path,)).fetchone():
+                    break
+                self.db.execute("DELETE FROM nodes WHERE path = ?", (path,))
+            self.db.commit()
+
+    def removedir(self, path, force=False):
+        ''' return False when the directory is not empty and not forced '''
+        path = _norm(path)
+        start, end = _below(path)
+        with self._lock:
+            if not force and self.db.execute("SELECT 1 FROM nodes WHERE parent = ? LIMIT 1", (path,)).fetchone():
+                return False
+            self.db.execute("DELETE FROM nodes WHERE path >= ? AND path < ?", (start, end))
+            self.db.execute("DELETE FROM nodes WHERE path = ? AND kind = ?", (path, DIR))
+            self.db.commit()
+            return True
+
+    def close(self):
+        with self._lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+
+def migrate(metadata, manifest_path, index_path, fill_chunklens=None):
+    ''' copy a manifest tree and its torrent index into metadata,
+    return the number of files '''
+    migrated = 0
+    if os.path.isdir(index_path):
+        for root, dirs, files in os.walk(index_path):
+            for dn in dirs:
+                metadata.makedir(os.path.relpath(os.path.join(root, dn), index_path))
+            for fn in files:
+                if fn == '.__ccasfs_dir__' or fn.endswith('.tmp'):
+                    continue
+                local_filename = os.path.join(root, fn)
+                filename = os.path.relpath(local_filename, index_path)
+                torrent = None
+                if os.path.getsize(local_filename) > 0:
+                    torrent = ccasutil.read_torrent(local_filename)
+                if torrent:
+                    metadata.put_torrent(filename, torrent)
+                else:
+                    metadata.touch(filename)
+    if os.path.isdir(manifest_path):
+        for root, dirs, files in os.walk(manifest_path):
+            for fn in files:
+                if fn.endswith('.tmp'):
+                    continue
+                local_filename = os.path.join(root, fn)
+                filename = os.path.relpath(local_filename, manifest_path)
+                entries = ccasmanifest.read_entries(local_filename)
+                if fill_chunklens is not None:
+                    entries = fill_chunklens(entries)
+                metadata.put_manifest(filename, [c for c, l in entries], [l for c, l in entries], \
+                                      mtime=os.path.getmtime(local_filename))
+                migrated += 1
+    return migrated
+
+
+def main():
+    # stat and listdir latency over a large namespace
+    import sys
+    import tempfile
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    metadata = MetadataDB(os.path.join(tempfile.mkdtemp(), 'metadata.db'))
+    start = time.time()
+    with metadata._lock:
+        for i in xrange(count):
+            metadata._file(u"dir%d/file%d" % (i % 1000, i), start)
+        metadata.db.commit()
+    print "%d files in %.1fs" % (count, time.time() - start)
+    lookups = 10000
+    start = time.time()
+    for i in xrange(lookups):
+        metadata.stat("dir%d/file%d" % (i % 1000, i * 7 % count))
+    print "%.1f us per stat" % ((time.time() - start) / lookups * 1000000)
+    start = time.time()
+    for i in xrange(1000):
+        metadata.listdir("dir%d" % (i))
+    print "%.1f us per listdir of %d entries" % ((time.time() - start) / 1000 * 1000000, count // 1000)
+    metadata.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+'''
+2015 John Ko <git@johnko.ca>
+Pack files for chunkservers, instead of one file per chunk.
+
+Chunks are appended to large pack files, and a sqlite index maps each
+chunkuuid to (pack, offset, length). Every record in a pack also carries
+its own header and chunkuuid, so the tail of the pack being written can
+be re-indexed after a crash, and the index only has to be committed in
+batches.
+
+Deleted chunks stay in their pack as dead bytes until compact() copies
+the live chunks of mostly dead packs forward and removes the old packs.
+'''
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+
+RECORD_MAGIC = 'CCPK'
+RECORD = struct.Struct('<4sHI') # magic, chunkuuid length, data length
+PACK_SIZE = 1024 * 1024 * 1024
+
+
+class PackStore(object):
+    def __init__(self, root_path, pack_size=PACK_SIZE, batch=1000, debug=0):
+        self.debug = debug
+        self.root_path = root_path
+        self.pack_path = os.path.join(root_path, 'packs')
+        self.pack_size = pack_size # start a new pack past this size
+        self.batch = batch # commit the index after this many changes
+        self.pending = 0
+        self._lock = threading.RLock()
+        self._maps = {} # pack to mmap, remapped as the active pack grows
+        if not os.access(self.pack_path, os.W_OK):
+            os.makedirs(self.pack_path)
+        self.db = sqlite3.connect(os.path.join(root_path, '.ccas_packs.db'), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (chunkuuid TEXT PRIMARY KEY, pack INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS packs (pack INTEGER PRIMARY KEY, size INTEGER NOT NULL, dead INTEGER NOT NULL)")
+        self.db.commit()
+        row = self.db.execute("SELECT MAX(pack) FROM packs").fetchone()
+        if row[0] is None:
+            self._new_pack(0)
+        else:
+            self.active = row[0]
+            self.recover()
+        self.out = open(self.pack_filename(self.active), 'ab')
+
+    def pack_filename(self, pack):
+        return os.path.join(self.pack_path, "%08d.pack" % (pack))
+
+    def _new_pack(self, pack):
+        self.active = pack
+        self.db.execute("INSERT INTO packs (pack, size, dead) VALUES (?, 0, 0)", (pack,))
+        self.db.commit()
+        open(self.pack_filename(pack), 'ab').close()
+
+    def recover(self):
+        ''' index records appended to the active pack after the last commit '''
+        with self._lock:
+            pack = self.active
+            size = self.db.execute("SELECT size FROM packs WHERE pack = ?", (pack,)).fetchone()[0]
+            recovered = 0
+            with open(self.pack_filename(pack), 'r+b') as f:
+                f.seek(size)
+                while True:
+                    head = f.read(RECORD.size)
+                    if len(head) < RECORD.size:
+                        break
+                    magic, key_length, length = RECORD.unpack(head)
+                    chunkuuid = f.read(key_length)
+                    if magic != RECORD_MAGIC or len(chunkuuid) < key_length:
+                        break
+                    offset = f.tell()
+                    f.seek(length, os.SEEK_CUR)
+                    if f.tell() > os.fstat(f.fileno()).st_size:
+                        break
+                    self._index(chunkuuid, pack, offset, length)
+                    size = f.tell()
+                    recovered += 1
+                # drop a torn record at the end
+                f.truncate(size)
+            self.db.execute("UPDATE packs SET size = ? WHERE pack = ?", (size, pack))
+            self.db.commit()
+            if recovered and self.debug > 0: print "PackStore.recover: indexed %d chunks in %s" % (recovered, self.pack_filename(pack))
+
+    def _index(self, chunkuuid, pack, offset, length):
+        old = self.db.execute("SELECT pack, length FROM chunks WHERE chunkuuid = ?", (chunkuuid,)).fetchone()
+        if old is not None:
+            self._dead(old[0], len(chunkuuid), old[1])
+        self.db.execute("INSERT OR REPLACE INTO chunks (chunkuuid, pack, offset, length) VALUES (?, ?, ?, ?)", (chunkuuid, pack, offset, length))
+
+    def _dead(self, pack, key_length, length):
+        self.db.execute("UPDATE packs SET dead = dead + ? WHERE pack = ?", (RECORD.size + key_length + length, pack))
+
+    def _changed(self):
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            self.db.commit()
+            self.pending = 0
+
+    def put(self, chunkuuid, data):
+        chunkuuid = str(chunkuuid)
+        with self._lock:
+            if self.out.tell() >= self.pack_size:
+                self.out.close()
+                self.commit()
+                self._new_pack(self.active + 1)
+                self.out = open(self.pack_filename(self.active), 'ab')
+            self.out.write(RECORD.pack(RECORD_MAGIC, len(chunkuuid), len(data)))
+            self.out.write(chunkuuid)
+            offset = self.out.tell()
+            self.out.write(data)
+            self.out.flush()
+            self._index(chunkuuid, self.active, offset, len(data))
+            self.db.execute("UPDATE packs SET size = ? WHERE pack = ?", (self.out.tell(), self.active))
+            self._changed()
+
+    def _locate(self, chunkuuid):
+        with self._lock:
+            return self.db.execute("SELECT pack, offset, length FROM chunks WHERE chunkuuid = ?", (chunkuuid,)).fetchone()
+
+    def _map(self, pack, end):
+        with self._lock:
+            mm = self._maps.get(pack)
+            if mm is None or len(mm) < end:
+                # readers still slicing an older map keep it alive
+                with open(self.pack_filename(pack), 'rb') as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[pack] = mm
+            return mm
+
+    def get(self, chunkuuid, length=None):
+        ''' stored data, or its first length bytes, None when missing '''
+        row = self._locate(chunkuuid)
+        if row is None:
+            return None
+        pack, offset, stored = row
+        if length is None or length > stored:
+            length = stored
+        if length == 0:
+            return ''
+        return self._map(pack, offset + stored)[offset:offset + length]
+
+    def __contains__(self, chunkuuid):
+        return self._locate(chunkuuid) is not None
+
+    def size(self, chunkuuid):
+        row = self._locate(chunkuuid)
+        if row is None:
+            return None
+        return row[2]
+
+    def delete(self, chunkuuid):
+        ''' forget a chunk, its bytes stay in the pack until compact() '''
+        with self._lock:
+            row = self._locate(chunkuuid)
+            if row is None:
+                return False
+            self.db.execute("DELETE FROM chunks WHERE chunkuuid = ?", (chunkuuid,))
+            self._dead(row[0], len(chunkuuid), row[2])
+            self._changed()
+            return True
+
+    def __iter__(self):
+        ''' every stored chunkuuid in sorted order '''
+        key = ''
+        while True:
+            with self._lock:
+                rows = self.db.execute("SELECT chunkuuid FROM chunks WHERE chunkuuid > ? ORDER BY chunkuuid LIMIT 1000", (key,)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                key = row[0]
+                yield str(key)
+
+    def stats(self):
+        with self._lock:
+            packs, size, dead = self.db.execute("SELECT COUNT(*), TOTAL(size), TOTAL(dead) FROM packs").fetchone()
+            chunks = self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        return {'packs': packs, 'chunks': chunks, 'bytes': int(size), 'dead_bytes': int(dead)}
+
+    def compact(self, min_dead=0.5):
+        ''' rewrite the live chunks of packs that are at least min_dead dead,
+        return the bytes reclaimed, the live chunks take up space again in
+        the active pack '''
+        reclaimed = 0
+        with self._lock:
+            self.commit()
+            packs = self.db.execute("SELECT pack FROM packs WHERE pack != ? AND size > 0 AND dead >= size * ? ORDER BY pack", (self.active, min_dead)).fetchall()
+        for (pack,) in packs:
+            with self._lock:
+                # chunks may have been deleted since, count them too
+                dead = self.db.execute("SELECT dead FROM packs WHERE pack = ?", (pack,)).fetchone()[0]
+                rows = self.db.execute("SELECT chunkuuid FROM chunks WHERE pack = ? ORDER BY offset", (pack,)).fetchall()
+                for row in rows:
+                    chunkuuid = str(row[0])
+                    self.put(chunkuuid, self.get(chunkuuid))
+                # the old copies were only just marked dead by put()
+                self.db.execute("DELETE FROM packs WHERE pack = ?", (pack,))
+                self.commit()
+                self._maps.pop(pack, None)
+                os.remove(self.pack_filename(pack))
+                if self.debug > 0: print "PackStore.compact: %s, moved %d live chunks" % (self.pack_filename(pack), len(rows))
+                reclaimed += dead
+        return reclaimed
+
+    def close(self):
+        with self._lock:
+            if self.db is not None:
+                self.out.close()
+                self.db.commit()
+                self.db.close()
+                self.db = None
+                self._maps = {}
+
+
+def main():
+    # small chunks in packs, then compaction
+    import hashlib
+    import sys
+    import tempfile
+    import time
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    store = PackStore(tempfile.mkdtemp(), pack_size=64 * 1024 * 1024)
+    data = os.urandom(4096)
+    keys = [hashlib.sha256(str(i)).hexdigest() for i in xrange(count)]
+    start = time.time()
+    for key in keys:
+        store.put(key, data)
+    store.commit()
+    print "%d chunks written in %.1fs" % (count, time.time() - start)
+    start = time.time()
+    for key in keys:
+        store.get(key)
+    print "%.1f us per read" % ((time.time() - start) / count * 1000000)
+    for key in keys[::2]:
+        store.delete(key)
+    start = time.time()
+    reclaimed = store.compact()
+    print "compacted %d MB in %.1fs, %s" % (reclaimed / 1024 / 1024, time.time() - start, store.stats())
+    store.close()
+
+if __name__ == "__main__":
+    main()
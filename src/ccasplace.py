@@ -0,0 +1,271 @@
+'''
+2015 John Ko <git@johnko.ca>
+Placement policies decide which chunkserver gets a new chunk when chunks
+are striped.
+
+RoundRobinPlacement takes turns, like the original chunkrobin.
+FreeSpacePlacement picks at random, weighted by each disk's free space,
+so mixed disk sizes fill evenly.
+LeastOutstandingPlacement picks the chunkserver with the least I/O
+queued on its worker pool, so a slow disk gets fewer writes.
+RendezvousPlacement ranks the chunkservers by a hash of the chunkuuid
+and each location, weighted by disk size. A chunk's home is found again
+from its chunkuuid alone, without the location index, and adding a disk
+only moves the chunks that now rank it first.
+
+With erasure coding each shard of a chunk goes to a different
+chunkserver, picked by spread().
+
+Every decision is counted per chunkserver for stats().
+'''
+import collections
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+
+
+class PlacementPolicy(object):
+    ''' subclasses implement choose() '''
+    name = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.placed = collections.Counter() # loc to chunks placed there
+        self.retries = 0 # choices that had to skip a failed chunkserver
+        self.elapsed = 0.0
+
+    def choose(self, chunkuuid, chunkservers, candidates):
+        ''' one of candidates, the enabled locations not excluded '''
+        raise NotImplementedError
+
+    def candidates(self, chunkservers, exclude=()):
+        return [loc for loc in sorted(chunkservers) if chunkservers[loc].enabled and loc not in exclude]
+
+    def _placed(self, locs, start, retry=False):
+        with self._lock:
+            for loc in locs:
+                self.placed[loc] += 1
+            if retry:
+                self.retries += 1
+            self.elapsed += time.time() - start
+
+    def place(self, chunkuuid, chunkservers, exclude=()):
+        ''' the location for a new chunk, None when no chunkserver is left '''
+        candidates = self.candidates(chunkservers, exclude)
+        if not candidates:
+            return None
+        start = time.time()
+        loc = self.choose(chunkuuid, chunkservers, candidates)
+        self._placed([loc], start, retry=bool(exclude))
+        return loc
+
+    def spread(self, chunkuuid, chunkservers, count):
+        ''' count different locations for the shards of a new chunk, fewer
+        when there are not that many enabled chunkservers '''
+        candidates = self.candidates(chunkservers)
+        start = time.time()
+        locs = []
+        while candidates and len(locs) < count:
+            loc = self.choose(chunkuuid, chunkservers, candidates)
+            candidates.remove(loc)
+            locs.append(loc)
+        self._placed(locs, start)
+        return locs
+
+    def locate(self, chunkuuid, chunkservers):
+        ''' enabled locations in the order to look for a chunk without the
+        index, None when this policy cannot tell '''
+        return None
+
+    def stats(self):
+        with self._lock:
+            decisions = sum(self.placed.values())
+            return {
+                'policy': self.name,
+                'decisions': decisions,
+                'placed': dict(self.placed),
+                'retries': self.retries,
+                'us_per_decision': self.elapsed / decisions * 1000000 if decisions else 0.0,
+            }
+
+
+class RoundRobinPlacement(PlacementPolicy):
+    name = 'round-robin'
+
+    def __init__(self):
+        super(RoundRobinPlacement, self).__init__()
+        self.robin = 0
+
+    def choose(self, chunkuuid, chunkservers, candidates):
+        with self._lock:
+            robin = self.robin
+            self.robin += 1
+        return candidates[robin % len(candidates)]
+
+
+def _free_bytes(root_path):
+    stv = os.statvfs(root_path)
+    return stv.f_bavail * stv.f_frsize
+
+def _total_bytes(root_path):
+    stv = os.statvfs(root_path)
+    return stv.f_blocks * stv.f_frsize
+
+
+class FreeSpacePlacement(PlacementPolicy):
+    name = 'free-space'
+
+    def __init__(self, refresh=1.0):
+        super(FreeSpacePlacement, self).__init__()
+        self.refresh = refresh # seconds between statvfs calls per disk
+        self._free = {} # loc to (checked, free bytes)
+
+    def free(self, loc, chunkserver, now):
+        checked, free = self._free.get(loc, (None, 0))
+        if checked is None or now - checked >= self.refresh:
+            free = _free_bytes(chunkserver.local_filesystem_root)
+            self._free[loc] = (now, free)
+        return free
+
+    def choose(self, chunkuuid, chunkservers, candidates):
+        now = time.time()
+        weights = [self.free(loc, chunkservers[loc], now) for loc in candidates]
+        total = sum(weights)
+        if total <= 0:
+            return random.choice(candidates)
+        pick = random.random() * total
+        for loc, weight in zip(candidates, weights):
+            pick -= weight
+            if pick < 0:
+                return loc
+        return candidates[-1]
+
+
+class LeastOutstandingPlacement(PlacementPolicy):
+    name = 'least-outstanding'
+
+    def __init__(self):
+        super(LeastOutstandingPlacement, self).__init__()
+        self.robin = 0
+
+    def choose(self, chunkuuid, chunkservers, candidates):
+        # read each count once, writes finishing meanwhile would change them
+        outstanding = dict((loc, chunkservers[loc].pool.outstanding) for loc in candidates)
+        least = min(outstanding.values())
+        idle = [loc for loc in candidates if outstanding[loc] == least]
+        # take turns among the least busy, so idle disks all get writes
+        with self._lock:
+            robin = self.robin
+            self.robin += 1
+        return idle[robin % len(idle)]
+
+
+class RendezvousPlacement(PlacementPolicy):
+    name = 'rendezvous'
+
+    def __init__(self, weighted=True):
+        super(RendezvousPlacement, self).__init__()
+        self.weighted = weighted # by disk size, or every disk the same
+        self._weights = {}
+
+    def weight(self, loc, chunkserver):
+        if not self.weighted:
+            return 1.0
+        if loc not in self._weights:
+            self._weights[loc] = float(_total_bytes(chunkserver.local_filesystem_root)) or 1.0
+        return self._weights[loc]
+
+    def score(self, chunkuuid, loc, chunkserver):
+        # weighted rendezvous: -weight / ln(hash in (0, 1))
+        digest = hashlib.sha1("%s:%d" % (chunkuuid, loc)).digest()
+        h = (int(digest[:8].encode('hex'), 16) + 0.5) / 2.0 ** 64
+        return -self.weight(loc, chunkserver) / math.log(h)
+
+    def rank(self, chunkuuid, chunkservers, candidates):
+        return sorted(candidates, key=lambda loc: self.score(chunkuuid, loc, chunkservers[loc]), reverse=True)
+
+    def choose(self, chunkuuid, chunkservers, candidates):
+        return self.rank(chunkuuid, chunkservers, candidates)[0]
+
+    def locate(self, chunkuuid, chunkservers):
+        return self.rank(chunkuuid, chunkservers, self.candidates(chunkservers))
+
+
+POLICIES = dict((policy.name, policy) for policy in (RoundRobinPlacement, FreeSpacePlacement, LeastOutstandingPlacement, RendezvousPlacement))
+
+def new_placement(placement):
+    ''' placement can be one of POLICIES by name or an object with place() '''
+    if placement is None:
+        return RoundRobinPlacement()
+    elif placement in POLICIES:
+        return POLICIES[placement]()
+    elif hasattr(placement, 'place') and hasattr(placement, 'stats'):
+        return placement
+    raise ValueError("placement should be one of %s, or a PlacementPolicy" % ", ".join(sorted(POLICIES)))
+
+
+def slow_disk_ingest(placement, writers=6, chunks=30, delay=0.02):
+    ''' striped writes from several threads with the first of three
+    chunkservers slowed down, return (chunks it got, of how many, seconds) '''
+    import shutil
+    import tempfile
+    import ccas
+    root = tempfile.mkdtemp()
+    master = ccas.CcasMaster([os.path.join(root, 'disk%d' % (i)) for i in range(3)], \
+                os.path.join(root, 'meta', 'manifest'), os.path.join(root, 'meta', 'index'), \
+                os.path.join(root, 'meta', 'catalog'), os.path.join(root, 'tmp'), \
+                write_algorithm='stripe', chunksize=4096, placement=placement)
+    slow = master.chunkservers[0]
+    write = slow.write
+    def slow_write(*args):
+        time.sleep(delay)
+        return write(*args)
+    slow.write = slow_write
+    client = ccas.CcasClient(master)
+    threads = [threading.Thread(target=client.write, args=("/file%d" % (i), os.urandom(4096 * chunks))) for i in range(writers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    stats = master.placement_stats()
+    master.close()
+    shutil.rmtree(root)
+    return stats['placed'].get(0, 0), stats['decisions'], elapsed
+
+def main():
+    # spread and cost of each policy, how many chunks move when a fifth disk
+    # is added, and ingest with a slow disk
+    import sys
+    class Disk(object):
+        class pool(object):
+            outstanding = 0
+        enabled = True
+        local_filesystem_root = '/'
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    chunkuuids = [hashlib.sha256(str(i)).hexdigest() for i in xrange(count)]
+    disks = dict((loc, Disk()) for loc in range(4))
+    for name in sorted(POLICIES):
+        policy = new_placement(name)
+        for chunkuuid in chunkuuids:
+            policy.place(chunkuuid, disks)
+        print "%-17s %s" % (name, policy.stats())
+    policy = RendezvousPlacement()
+    before = [policy.place(chunkuuid, disks) for chunkuuid in chunkuuids]
+    disks[4] = Disk()
+    after = [policy.place(chunkuuid, disks) for chunkuuid in chunkuuids]
+    moved = len([1 for b, a in zip(before, after) if b != a])
+    print "rendezvous: adding a fifth disk moves %.1f%% of chunks, all of them to it: %s" % \
+        (100.0 * moved / count, all(a == 4 for b, a in zip(before, after) if b != a))
+    results = {}
+    for name in ('round-robin', 'least-outstanding'):
+        results[name] = slow_disk_ingest(name)
+        print "%-17s slow disk got %d of %d chunks, ingest took %.2fs" % ((name,) + results[name])
+    assert results['least-outstanding'][0] < results['round-robin'][0]
+
+if __name__ == "__main__":
+    main()
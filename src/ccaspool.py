@@ -0,0 +1,134 @@
+'''
+2015 John Ko <git@johnko.ca>
+A small thread pool with futures, one per chunkserver, so slow disks
+queue their own work instead of holding up the others.
+
+The queue is bounded: submit() blocks when a disk falls too far behind,
+which keeps background copies from piling up chunks in memory.
+
+TokenBucket holds background work like scrubbing to a rate.
+'''
+import sys
+import threading
+import time
+import Queue
+
+
+class Future(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("timed out waiting for result")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, fn):
+        ''' fn(future) runs once the result is in, right away if it already is '''
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+def completed(result):
+    ''' a future that already has its result '''
+    future = Future()
+    future._finish(result=result)
+    return future
+
+
+class WorkerPool(object):
+    def __init__(self, workers=1, queue_size=None, name='ccas'):
+        self.workers = max(1, workers)
+        if queue_size is None:
+            queue_size = self.workers * 4
+        self._queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self.outstanding = 0 # queued plus running
+        self._threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            self.outstanding += 1
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                with self._lock:
+                    self.outstanding -= 1
+                future._finish(exc_info=sys.exc_info())
+            else:
+                with self._lock:
+                    self.outstanding -= 1
+                future._finish(result=result)
+
+    def shutdown(self, wait=True):
+        ''' finish what is queued, then stop the workers '''
+        for t in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+        self._threads = []
+
+
+class TokenBucket(object):
+    ''' take(n) waits until n tokens have built up at rate per second,
+    a rate of None is no limit '''
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        if burst is None:
+            burst = rate # up to a second of work at once
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, n=1):
+        ''' return the seconds waited '''
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # more than a burst at once goes into debt, paid off by waiting
+            self._tokens -= n
+            wait = -self._tokens / float(self.rate) if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
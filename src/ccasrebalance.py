@@ -0,0 +1,365 @@
+'''
+2015 John Ko <git@johnko.ca>
+Re-replication and rebalancing after chunkservers are added, disabled or
+replaced.
+
+Every chunk should have a copy on each enabled chunkserver with mirror,
+and one copy with stripe. A pass walks the location index, checks that
+the copies it lists are really there, and copies chunks that are short
+of copies from one that verifies. With stripe it also moves chunks off
+chunkservers holding more than their share, by disk size, onto the ones
+holding less. A chunk is always copied before the copy it replaces is
+removed, so stopping part way only ever leaves an extra copy, which the
+next pass removes.
+
+With erasure every chunk should have data_shards + parity_shards shards,
+each on its own chunkserver. Lost shards are rebuilt from the others, and
+moving a shard copies it as it is.
+
+The copies run on the chunkservers' own worker pools, held to an MB/s
+and an IOPS budget. Progress is saved after every batch, so a pass that
+is stopped carries on where it left off.
+'''
+import collections
+import json
+import os
+import threading
+import time
+import ccascodec
+import ccaserasure
+import ccaspool
+
+COUNTERS = ('chunks', 'missing', 'lost', 'copied', 'moved', 'trimmed', 'failed', 'bytes')
+BATCH = 100 # chunks planned, run in parallel, then checkpointed
+
+
+class Rebalancer(object):
+    def __init__(self, master, state_path=None, mb_per_s=None, iops=None, tolerance=0.05, batch=BATCH, debug=0):
+        self.debug = debug
+        self.master = master
+        if state_path is None:
+            state_path = os.path.join(master.meta_path, 'rebalance')
+        self.state_path = state_path
+        self.tolerance = tolerance # a chunkserver this far over its share is over-full
+        self.batch = batch
+        self.bandwidth = ccaspool.TokenBucket(mb_per_s * 1024 * 1024 if mb_per_s else None)
+        self.ops = ccaspool.TokenBucket(iops)
+        self._lock = threading.Lock() # counters updated by the workers
+        if not os.access(self.state_path, os.W_OK):
+            os.makedirs(self.state_path)
+        self.state = self.load_state()
+
+    def _path(self, name):
+        return os.path.join(self.state_path, name)
+
+    def load_state(self):
+        try:
+            with open(self._path('state.json'), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save_state(self):
+        tmp_path = self._path('state.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_path, self._path('state.json'))
+
+    def reset(self):
+        ''' forget a pass in progress '''
+        if os.path.exists(self._path('state.json')):
+            os.remove(self._path('state.json'))
+        self.state = None
+
+    def enabled(self):
+        return [loc for loc in sorted(self.master.chunkservers) if self.master.chunkservers[loc].enabled]
+
+    def replicas(self):
+        ''' copies each chunk should have '''
+        if self.master.write_algorithm == 'mirror':
+            return len(self.enabled())
+        elif self.master.write_algorithm == 'erasure':
+            return self.master.data_shards + self.master.parity_shards
+        return 1
+
+    def capacity(self, loc):
+        stv = os.statvfs(self.master.chunkservers[loc].local_filesystem_root)
+        return stv.f_blocks * stv.f_frsize
+
+    def start(self):
+        ''' count the copies on each chunkserver from the index, and the share
+        of them each one should hold by disk size '''
+        enabled = self.enabled()
+        counts = dict((loc, 0) for loc in enabled)
+        for chunkuuid, locs in self.master.chunklocs:
+            for loc in locs:
+                if loc in counts:
+                    counts[loc] += 1
+        capacities = dict((loc, self.capacity(loc)) for loc in enabled)
+        total = sum(counts.values())
+        targets = dict((loc, float(total) * capacities[loc] / (sum(capacities.values()) or 1)) for loc in enabled)
+        self.state = {
+            'started': time.time(),
+            'last': None, # last chunkuuid of the last batch done
+            'counts': dict((str(loc), n) for loc, n in counts.items()),
+            'targets': dict((str(loc), n) for loc, n in targets.items()),
+        }
+        for counter in COUNTERS:
+            self.state[counter] = 0
+        self.save_state()
+
+    def _count(self, loc):
+        return self.state['counts'].get(str(loc), 0)
+
+    def _fill(self, loc):
+        ''' copies held over the share this chunkserver should hold '''
+        return self._count(loc) / max(self.state['targets'].get(str(loc), 0), 1.0)
+
+    def _adjust(self, loc, n):
+        self.state['counts'][str(loc)] = self._count(loc) + n
+
+    def plan(self, chunkuuid, locs):
+        ''' (have, add, drop) for one chunk, copies counted as if already done '''
+        enabled = self.enabled()
+        have = []
+        for loc in sorted(locs):
+            if loc not in enabled:
+                continue
+            self.ops.take(1)
+            if self.master.chunkservers[loc].has(chunkuuid):
+                have.append(loc)
+            else:
+                # the index is stale, likely a replaced disk
+                self.master.remove_chunkloc(chunkuuid, loc)
+                self._adjust(loc, -1)
+                self.state['missing'] += 1
+        if not have:
+            return have, [], []
+        replicas = self.replicas()
+        add = []
+        drop = []
+        spare = sorted([loc for loc in enabled if loc not in have], key=self._fill)
+        if len(have) < replicas:
+            add = spare[:replicas - len(have)]
+        elif len(have) > replicas:
+            drop = sorted(have, key=self._fill, reverse=True)[:len(have) - replicas]
+        elif self.master.write_algorithm in ('stripe','erasure') and spare:
+            # move a copy off an over-full chunkserver onto one under its share
+            src = max(have, key=self._fill)
+            dst = spare[0]
+            if self._fill(src) > 1 + self.tolerance and self._fill(dst) < 1:
+                add = [dst]
+                drop = [src]
+        for loc in add:
+            self._adjust(loc, 1)
+        for loc in drop:
+            self._adjust(loc, -1)
+        return have, add, drop
+
+    def _read_good(self, chunkuuid, have):
+        for loc in have:
+            self.ops.take(1)
+            chunk = self.master.chunkservers[loc].read(chunkuuid)
+            if chunk is not None:
+                self.bandwidth.take(len(chunk))
+                if self.master.hashdata(chunk) == chunkuuid:
+                    return chunk
+        return None
+
+    def _counted(self, counter, n=1):
+        with self._lock:
+            self.state[counter] += n
+
+    def apply(self, chunkuuid, have, add, drop):
+        ''' copy to add, then remove the copies in drop while one is left elsewhere '''
+        chunkservers = self.master.chunkservers
+        kept = [loc for loc in have if loc not in drop]
+        if add:
+            chunk = self._read_good(chunkuuid, have)
+            if chunk is None:
+                if self.debug > 0: print "Rebalancer: no good copy of %s" % (chunkuuid)
+                self._counted('failed')
+                return
+            for loc in add:
+                self.ops.take(1)
+                self.bandwidth.take(len(chunk))
+                if chunkservers[loc].write(chunkuuid, chunk) is not None:
+                    self.master.add_chunkloc(chunkuuid, loc)
+                    kept.append(loc)
+                    self._counted('moved' if drop else 'copied')
+                    self._counted('bytes', len(chunk))
+                else:
+                    if self.debug > 0: print "Rebalancer: failed to copy %s to %s" % (chunkuuid, chunkservers[loc].local_filesystem_root)
+                    self._counted('failed')
+        for loc in drop:
+            if not kept:
+                break
+            self.ops.take(1)
+            chunkservers[loc].delete(chunkuuid)
+            self.master.remove_chunkloc(chunkuuid, loc)
+            if not add:
+                self._counted('trimmed')
+
+    def _read_shards(self, chunkuuid, locs):
+        ''' loc to (stored shard, Shard) for the good shards at locs '''
+        shards = {}
+        for loc in locs:
+            self.ops.take(1)
+            data = self.master.chunkservers[loc].read(chunkuuid)
+            shard = ccaserasure.parse(data)
+            if shard is not None:
+                self.bandwidth.take(len(data))
+                shards[loc] = (data, shard)
+        return shards
+
+    def apply_shards(self, chunkuuid, have, add, drop):
+        ''' apply for an erasure coded chunk: a move copies the shard as it is,
+        a new copy is a lost shard rebuilt from the others, and a shard is
+        only removed while another chunkserver has its index '''
+        chunkservers = self.master.chunkservers
+        shards = self._read_shards(chunkuuid, have)
+        if not shards:
+            # whole copies, from before the store was erasure coded
+            return self.apply(chunkuuid, have, add, drop)
+        writes = {} # loc to (stored shard, shard index) to write there
+        if add and drop:
+            for src, dst in zip(drop, add):
+                if src in shards:
+                    writes[dst] = (shards[src][0], shards[src][1].index)
+            if not writes:
+                # the shard to move is bad, a scrub repairs it in place
+                self._counted('failed')
+                return
+        elif add:
+            # the shards of the shape most of them agree on
+            shapes = collections.Counter(shard.shape() for data, shard in shards.values())
+            shape = shapes.most_common(1)[0][0]
+            found = dict((shard.index, shard) for data, shard in shards.values() if shard.shape() == shape)
+            chunk = ccaserasure.decode(found.values())
+            if chunk is None or self.master.hashdata(chunk) != chunkuuid:
+                if self.debug > 0: print "Rebalancer: too few good shards of %s" % (chunkuuid)
+                self._counted('failed')
+                return
+            k, m, length = shape
+            missing = [i for i in range(k + m) if i not in found]
+            rebuilt = ccaserasure.reencode(chunk, k, m, missing)
+            for loc, i in zip(add, missing):
+                writes[loc] = (rebuilt[i], i)
+        indexes = set(shards[loc][1].index for loc in have if loc in shards and loc not in drop)
+        for loc, (data, index) in writes.items():
+            self.ops.take(1)
+            self.bandwidth.take(len(data))
+            if chunkservers[loc].rewrite(chunkuuid, data) is not None:
+                self.master.add_chunkloc(chunkuuid, loc)
+                indexes.add(index)
+                self._counted('moved' if drop else 'copied')
+                self._counted('bytes', len(data))
+            else:
+                if self.debug > 0: print "Rebalancer: failed to copy a shard of %s to %s" % (chunkuuid, chunkservers[loc].local_filesystem_root)
+                self._counted('failed')
+        for loc in drop:
+            if loc in shards and shards[loc][1].index not in indexes:
+                continue # the only copy of this shard
+            self.ops.take(1)
+            chunkservers[loc].delete(chunkuuid)
+            self.master.remove_chunkloc(chunkuuid, loc)
+            if not add:
+                self._counted('trimmed')
+
+    def _run_batch(self, work):
+        futures = []
+        for chunkuuid, have, add, drop in work:
+            loc = (add or drop)[0]
+            apply = self.apply_shards if self.master.write_algorithm == 'erasure' else self.apply
+            futures.append(self.master.chunkservers[loc].pool.submit(apply, chunkuuid, have, add, drop))
+        for future in futures:
+            try:
+                future.result()
+            except:
+                self._counted('failed')
+
+    def rebalance(self, limit=None):
+        ''' run or resume a pass, at most limit chunks looked at. return its
+        report once it is done and None when limit stopped it early '''
+        if self.state is None:
+            self.start()
+        state = self.state
+        seen = 0
+        work = []
+        last = state['last']
+        for chunkuuid, locs in self.master.chunklocs:
+            if state['last'] is not None and chunkuuid <= state['last']:
+                continue
+            if limit is not None and seen >= limit:
+                break
+            seen += 1
+            state['chunks'] += 1
+            have, add, drop = self.plan(chunkuuid, locs)
+            if not have:
+                if self.debug > 0: print "Rebalancer: no copy of %s left on an enabled chunkserver" % (chunkuuid)
+                state['lost'] += 1
+            elif add or drop:
+                work.append((chunkuuid, have, add, drop))
+            last = chunkuuid
+            if seen % self.batch == 0:
+                self._run_batch(work)
+                work = []
+                state['last'] = last
+                self.master.chunklocs.commit()
+                self.save_state()
+        else:
+            self._run_batch(work)
+            self.master.chunklocs.commit()
+            report = self.report()
+            self.reset()
+            if self.debug > 0: print "Rebalancer: pass done, %s" % (report)
+            return report
+        self._run_batch(work)
+        state['last'] = last
+        self.master.chunklocs.commit()
+        self.save_state()
+        return None
+
+    def report(self):
+        report = dict((counter, self.state[counter]) for counter in COUNTERS)
+        report['counts'] = dict((int(loc), n) for loc, n in self.state['counts'].items())
+        report['elapsed'] = time.time() - self.state['started']
+        return report
+
+
+def main():
+    # replace a disk, add one, then rebalance
+    import shutil
+    import tempfile
+    import ccas
+    root = tempfile.mkdtemp()
+    disks = [os.path.join(root, 'disk%d' % (i)) for i in range(3)]
+    def open_master(root_path_array, write_algorithm):
+        return ccas.CcasMaster(root_path_array, os.path.join(root, write_algorithm, 'manifest'), \
+                    os.path.join(root, write_algorithm, 'index'), os.path.join(root, write_algorithm, 'catalog'), \
+                    os.path.join(root, 'tmp'), write_algorithm=write_algorithm, chunksize=64 * 1024)
+    # mirror on two disks, the second one replaced by an empty disk
+    master = open_master(disks[:2], 'mirror')
+    data = os.urandom(64 * 1024 * 200)
+    ccas.CcasClient(master).write("/file", data)
+    master.close()
+    shutil.rmtree(disks[1])
+    master = open_master(disks[:2], 'mirror')
+    start = time.time()
+    print "replaced disk: %s in %.1fs" % (Rebalancer(master, mb_per_s=50).rebalance(), time.time() - start)
+    assert ccas.CcasClient(master).read_all("/file") == data
+    master.close()
+    # stripe on two disks, then a third one added
+    shutil.rmtree(disks[0])
+    shutil.rmtree(disks[1])
+    master = open_master(disks[:2], 'stripe')
+    ccas.CcasClient(master).write("/file2", data)
+    master.close()
+    master = open_master(disks, 'stripe')
+    print "added disk: %s" % (Rebalancer(master).rebalance())
+    assert ccas.CcasClient(master).read_all("/file2") == data
+    master.close()
+    shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+'''
+2015 John Ko <git@johnko.ca>
+Reference counts of chunks, so space is reclaimed without a full scan.
+
+Every live manifest holds one reference on each chunk it lists, once per
+time it lists it. The master increments before a manifest is written and
+decrements after one is removed, so a crash in between only ever leaves
+a count too high: a leaked chunk, never a file missing its data. The
+garbage collector deletes a chunk no manifest lists whatever its count,
+and forgets the count.
+
+A chunk whose count reaches zero goes onto the reclaim queue. Writing a
+chunk takes it back off the queue first, so a chunk cannot be reclaimed
+from under a file that is being written with it.
+'''
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+
+class RefCounts(object):
+    def __init__(self, path, debug=0):
+        self.debug = debug
+        self.path = path
+        self.lock = threading.RLock()
+        self.created = not os.path.exists(path)
+        if not os.access(os.path.dirname(path), os.W_OK):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS refs (chunkuuid TEXT PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS reclaim (chunkuuid TEXT PRIMARY KEY, queued REAL NOT NULL) WITHOUT ROWID")
+        self.db.commit()
+        self.queue_length = self.db.execute("SELECT COUNT(*) FROM reclaim").fetchone()[0]
+
+    def adjust(self, increments=(), decrements=()):
+        ''' apply the changes for one file in one transaction '''
+        with self.lock:
+            try:
+                self._adjust(increments, decrements)
+                self.db.commit()
+            except:
+                self.db.rollback()
+                self.queue_length = self.db.execute("SELECT COUNT(*) FROM reclaim").fetchone()[0]
+                raise
+
+    def _adjust(self, increments, decrements):
+        for chunkuuid, n in collections.Counter(increments).iteritems():
+            self.db.execute("INSERT OR IGNORE INTO refs (chunkuuid, count) VALUES (?, 0)", (chunkuuid,))
+            self.db.execute("UPDATE refs SET count = count + ? WHERE chunkuuid = ?", (n, chunkuuid))
+            self.unqueue(chunkuuid)
+        now = time.time()
+        for chunkuuid, n in collections.Counter(decrements).iteritems():
+            self.db.execute("UPDATE refs SET count = count - ? WHERE chunkuuid = ?", (n, chunkuuid))
+            row = self.db.execute("SELECT count FROM refs WHERE chunkuuid = ?", (chunkuuid,)).fetchone()
+            if row is not None and row[0] <= 0:
+                self.db.execute("DELETE FROM refs WHERE chunkuuid = ?", (chunkuuid,))
+                self.db.execute("INSERT OR REPLACE INTO reclaim (chunkuuid, queued) VALUES (?, ?)", (chunkuuid, now))
+                self.queue_length += 1
+
+    def count(self, chunkuuid):
+        with self.lock:
+            row = self.db.execute("SELECT count FROM refs WHERE chunkuuid = ?", (chunkuuid,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def forget(self, chunkuuid):
+        ''' drop a count no manifest holds, one a crash leaked '''
+        with self.lock:
+            self.db.execute("DELETE FROM refs WHERE chunkuuid = ?", (chunkuuid,))
+
+    def unqueue(self, chunkuuid):
+        ''' take a chunk off the reclaim queue, return True when it was on it '''
+        with self.lock:
+            if not self.queue_length:
+                return False
+            cursor = self.db.execute("DELETE FROM reclaim WHERE chunkuuid = ?", (chunkuuid,))
+            if cursor.rowcount:
+                self.queue_length -= 1
+                return True
+            return False
+
+    def queued(self, older_than=0, limit=1000):
+        ''' up to limit chunkuuids queued at least older_than seconds ago '''
+        with self.lock:
+            if not self.queue_length:
+                return []
+            rows = self.db.execute("SELECT chunkuuid FROM reclaim WHERE queued <= ? ORDER BY queued LIMIT ?", (time.time() - older_than, limit)).fetchall()
+        return [str(row[0]) for row in rows]
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def rebuild(self, manifests):
+        ''' forget everything and count the chunks of (name, entries) manifests '''
+        with self.lock:
+            self.db.execute("DELETE FROM refs")
+            self.db.execute("DELETE FROM reclaim")
+            self.queue_length = 0
+            for name, entries in manifests:
+                if self.debug > 1: print "RefCounts.rebuild: %s" % (name)
+                self._adjust([c for c, l in entries], ())
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
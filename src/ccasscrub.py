@@ -0,0 +1,311 @@
+'''
+2015 John Ko <git@johnko.ca>
+Scrubbing reads every copy of every chunk and checks it against its
+chunkuuid, whatever the verify policy for normal reads is.
+
+A copy that fails is written over from a copy that verifies on another
+chunkserver, and so is a copy the location index lists that is gone.
+An erasure coded shard is checked against its own crc, and a bad or
+missing one is rebuilt from the other shards of its chunk.
+Reads and rewrites are held to an MB/s and an IOPS budget, so a scrub
+can run alongside normal use.
+
+When each copy last verified, and how far each walk got, are kept in a
+sqlite db and committed together, so a scrub that is stopped carries on
+where it left off instead of starting over.
+'''
+import os
+import sqlite3
+import threading
+import time
+import ccascodec
+import ccaserasure
+import ccaspool
+
+COUNTERS = ('checked', 'skipped', 'bytes', 'corrupt', 'missing', 'repaired', 'unrepaired')
+CHECKPOINT = 100 # copies checked between commits
+
+
+class Scrubber(object):
+    def __init__(self, master, path=None, mb_per_s=None, iops=None, interval=0, repair=True, debug=0):
+        self.debug = debug
+        self.master = master
+        if path is None:
+            path = os.path.join(master.meta_path, 'scrub.db')
+        self.path = path
+        self.interval = interval # skip copies verified less than this many seconds ago
+        self.repair = repair # rewrite bad copies from good ones
+        self.bandwidth = ccaspool.TokenBucket(mb_per_s * 1024 * 1024 if mb_per_s else None)
+        self.ops = ccaspool.TokenBucket(iops)
+        self._lock = threading.RLock() # the db
+        self._running = threading.Lock() # one pass at a time
+        self._stop = threading.Event()
+        self._thread = None
+        if not os.access(os.path.dirname(path), os.W_OK):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS verified (chunkuuid TEXT NOT NULL, loc INTEGER NOT NULL, verified REAL NOT NULL, " \
+                        "PRIMARY KEY (chunkuuid, loc)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value) WITHOUT ROWID")
+        self.db.commit()
+        self.state = dict(self.db.execute("SELECT key, value FROM state").fetchall())
+        self._pending = 0
+
+    def save_state(self):
+        with self._lock:
+            self.db.execute("DELETE FROM state")
+            self.db.executemany("INSERT INTO state (key, value) VALUES (?, ?)", self.state.items())
+            self.db.commit()
+            self.master.chunklocs.commit()
+            self._pending = 0
+
+    def _checked(self):
+        self.state['checked'] += 1
+        self._pending += 1
+        if self._pending >= CHECKPOINT:
+            self.save_state()
+
+    def _verified(self, chunkuuid, loc):
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO verified (chunkuuid, loc, verified) VALUES (?, ?, ?)", (chunkuuid, loc, time.time()))
+
+    def last_verified(self, chunkuuid):
+        ''' loc to the time each copy of chunkuuid last verified '''
+        with self._lock:
+            return dict(self.db.execute("SELECT loc, verified FROM verified WHERE chunkuuid = ?", (chunkuuid,)).fetchall())
+
+    def start_pass(self):
+        self.state = {'started': time.time()}
+        for counter in COUNTERS:
+            self.state[counter] = 0
+        self.save_state()
+
+    def finish_pass(self):
+        ''' forget copies not seen this pass, they are gone '''
+        report = self.report()
+        with self._lock:
+            self.db.execute("DELETE FROM verified WHERE verified < ?", (self.state['started'] - self.interval,))
+            self.state = {}
+            self.save_state()
+        return report
+
+    def report(self):
+        report = dict((counter, self.state.get(counter, 0)) for counter in COUNTERS)
+        report['elapsed'] = time.time() - self.state.get('started', time.time())
+        return report
+
+    def _stopped(self, limit):
+        return self._stop.is_set() or (limit is not None and self._count >= limit)
+
+    def _read(self, chunkserver, chunkuuid):
+        ''' the stored bytes, None when the copy is gone '''
+        self.ops.take(1)
+        try:
+            data = chunkserver.read_data(chunkuuid)
+        except (IOError, OSError):
+            return None
+        if data is not None:
+            self.bandwidth.take(len(data))
+            self.state['bytes'] += len(data)
+        return data
+
+    def check_copy(self, loc, chunkuuid):
+        ''' verify one copy and repair it when it is bad, return True when it is good '''
+        if self.interval:
+            with self._lock:
+                row = self.db.execute("SELECT verified FROM verified WHERE chunkuuid = ? AND loc = ?", (chunkuuid, loc)).fetchone()
+            if row is not None and time.time() - row[0] < self.interval:
+                self.state['skipped'] += 1
+                return True
+        chunkserver = self.master.chunkservers[loc]
+        data = self._read(chunkserver, chunkuuid)
+        if data is None:
+            self.state['missing'] += 1
+            if self.debug > 0: print "Scrubber: %s%s is missing" % (chunkserver.local_filesystem_root, chunkuuid)
+            return self._repair(chunkuuid, loc)
+        chunk = ccascodec.decode(data)
+        if self.master.is_shard(chunkuuid, chunk):
+            good = ccaserasure.parse(chunk) is not None
+        else:
+            good = self.master.hashdata(chunk) == chunkuuid
+        if good:
+            self._verified(chunkuuid, loc)
+            if loc not in self.master.chunklocs.get(chunkuuid):
+                self.master.add_chunkloc(chunkuuid, loc)
+            return True
+        self.state['corrupt'] += 1
+        if self.debug > 0: print "Scrubber: %s%s failed verification" % (chunkserver.local_filesystem_root, chunkuuid)
+        return self._repair(chunkuuid, loc)
+
+    def _good_copy(self, chunkuuid, bad_loc):
+        ''' (chunk, shape, shard index to shard) from the other copies, shape is
+        None for a whole copy and chunk is None when no good copy is left '''
+        master = self.master
+        indexed = master.get_chunklocs(chunkuuid)
+        shards = {} # shape to shard index to shard
+        for loc in indexed + master.get_probe_chunklocs(chunkuuid, indexed):
+            if loc == bad_loc:
+                continue
+            data = self._read(master.chunkservers[loc], chunkuuid)
+            if data is None:
+                continue
+            chunk = ccascodec.decode(data)
+            shard = ccaserasure.parse(chunk) if master.is_shard(chunkuuid, chunk) else None
+            if shard is not None:
+                shards.setdefault(shard.shape(), {})[shard.index] = shard
+            elif master.hashdata(chunk) == chunkuuid:
+                return chunk, None, None
+        for shape, found in shards.items():
+            chunk = ccaserasure.decode(found.values())
+            if chunk is not None and master.hashdata(chunk) == chunkuuid:
+                return chunk, shape, found
+        return None, None, None
+
+    def _repair(self, chunkuuid, loc):
+        with self._lock:
+            self.db.execute("DELETE FROM verified WHERE chunkuuid = ? AND loc = ?", (chunkuuid, loc))
+        chunk = None
+        if self.repair:
+            chunk, shape, present = self._good_copy(chunkuuid, loc)
+        if chunk is None:
+            self.state['unrepaired'] += 1
+            if self.debug > 0: print "Scrubber: no good copy of %s to repair loc %d with" % (chunkuuid, loc)
+            return False
+        self.ops.take(1)
+        self.bandwidth.take(len(chunk))
+        if shape is None:
+            repaired = self.master.repair_chunk(chunkuuid, chunk, [loc])
+        else:
+            repaired = self.master.repair_shards(chunkuuid, chunk, shape, present, [loc])
+        if not repaired:
+            self.state['unrepaired'] += 1
+            return False
+        self._verified(chunkuuid, loc)
+        self.state['repaired'] += 1
+        return True
+
+    def _walk_store(self, loc, limit):
+        ''' check every copy on one chunkserver, return True once it is done '''
+        key = "store:%d" % (loc)
+        last = self.state.get(key)
+        if last == '':
+            return True
+        for chunkuuid in self.master.chunkservers[loc].iter_chunkuuids():
+            if last is not None and chunkuuid <= last:
+                continue
+            if self._stopped(limit):
+                return False
+            self.check_copy(loc, chunkuuid)
+            self.state[key] = chunkuuid
+            self._count += 1
+            self._checked()
+        # an empty string marks a walk as done
+        self.state[key] = ''
+        return True
+
+    def _walk_index(self, limit):
+        ''' repair the copies the location index lists that are gone,
+        return True once it is done '''
+        last = self.state.get('index')
+        if last == '':
+            return True
+        for chunkuuid, locs in self.master.chunklocs:
+            if last is not None and chunkuuid <= last:
+                continue
+            if self._stopped(limit):
+                return False
+            for loc in sorted(locs):
+                chunkserver = self.master.chunkservers.get(loc)
+                if chunkserver is None or not chunkserver.enabled:
+                    continue
+                self.ops.take(1)
+                if not chunkserver.has(chunkuuid):
+                    self.state['missing'] += 1
+                    if self.debug > 0: print "Scrubber: %s%s is missing" % (chunkserver.local_filesystem_root, chunkuuid)
+                    self._repair(chunkuuid, loc)
+            self.state['index'] = chunkuuid
+            self._count += 1
+            self._checked()
+        self.state['index'] = ''
+        return True
+
+    def scrub(self, limit=None):
+        ''' run or resume a pass over every chunkserver, at most limit copies
+        checked. return its report once it is done and None when limit or
+        stop() ended it early '''
+        with self._running:
+            self._count = 0
+            if self.state.get('started') is None:
+                self.start_pass()
+            for loc in sorted(self.master.chunkservers):
+                if not self.master.chunkservers[loc].enabled:
+                    continue
+                if not self._walk_store(loc, limit):
+                    self.save_state()
+                    return None
+            if not self._walk_index(limit):
+                self.save_state()
+                return None
+            report = self.finish_pass()
+        if self.debug > 0: print "Scrubber: pass done, %s" % (report)
+        return report
+
+    def start(self, pass_interval=24 * 60 * 60):
+        ''' scrub in a background thread, a pass every pass_interval seconds '''
+        def run():
+            while not self._stop.is_set():
+                if self.scrub() is None:
+                    break
+                self._stop.wait(pass_interval)
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name='ccas-scrub')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        ''' stop a background scrub at the next chunk, it resumes from there '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stop.clear()
+
+    def close(self):
+        self.stop()
+        with self._running:
+            if self.db is not None:
+                self.save_state()
+                self.db.close()
+                self.db = None
+
+
+def main():
+    # damage copies, then scrub them back
+    import shutil
+    import tempfile
+    import ccas
+    root = tempfile.mkdtemp()
+    master = ccas.CcasMaster([os.path.join(root, 'disk0'), os.path.join(root, 'disk1')], \
+                os.path.join(root, 'meta', 'manifest'), os.path.join(root, 'meta', 'index'), \
+                os.path.join(root, 'meta', 'catalog'), os.path.join(root, 'tmp'), chunksize=64 * 1024)
+    client = ccas.CcasClient(master)
+    data = os.urandom(64 * 1024 * 64)
+    client.write("/file", data)
+    chunkuuids = master.read_manifest("/file")
+    with open(master.chunkservers[0].chunk_filename(chunkuuids[0]), 'r+b') as f:
+        f.write('bad')
+    os.remove(master.chunkservers[1].chunk_filename(chunkuuids[1]))
+    scrubber = Scrubber(master, mb_per_s=2, iops=200)
+    start = time.time()
+    report = scrubber.scrub()
+    print "scrubbed in %.1fs: %s" % (time.time() - start, report)
+    assert report['corrupt'] == 1 and report['missing'] == 1 and report['repaired'] == 2
+    print "last verified: %s" % (scrubber.last_verified(chunkuuids[0]))
+    scrubber.close()
+    master.close()
+    shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
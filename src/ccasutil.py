@@ -26,48 +26,158 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import hashlib
 import os
+import time
 import uuid
 import libtorrent
+try:
+    from hashlib import blake2b, blake2s
+except ImportError:
+    try:
+        from pyblake2 import blake2b, blake2s
+    except ImportError:
+        blake2b = blake2s = None
 
-def hashdata(data):
-    return hashlib.sha256(data).hexdigest()
+PIECE_LENGTH = 1024 * 1024
+
+# chunkuuids are the hex digest of the chunk data, a store keeps one algorithm
+HASH_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512, # faster than sha256 on most 64 bit cpus
+    'sha1': hashlib.sha1,
+}
+if blake2b is not None:
+    HASH_ALGORITHMS['blake2b'] = lambda data='': blake2b(data, digest_size=32)
+    HASH_ALGORITHMS['blake2s'] = blake2s
+DEFAULT_HASH = 'sha256'
+
+def check_hash(algorithm):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError("hash_algorithm should be one of %s" % ", ".join(sorted(HASH_ALGORITHMS)))
+
+def hashdata(data, algorithm=DEFAULT_HASH):
+    return HASH_ALGORITHMS[algorithm](data).hexdigest()
 
 def hashdepthwidth(digest, width=2, depth=4):
     return [digest[start:start+width] for start in range(0, depth*width, width)]
 
-def make_torrent(torrent_path, data_path):
-    fs = libtorrent.file_storage()
-    libtorrent.add_files(fs, data_path)
-    t = libtorrent.create_torrent(fs)
-    t.set_creator("ccas")
-    libtorrent.set_piece_hashes(t, os.path.dirname(data_path))
-    tdata = t.generate()
+class TorrentBuilder(object):
+    ''' torrent metadata of a file, built from its data as it streams past '''
+    def __init__(self, name, piece_length=PIECE_LENGTH):
+        self.name = name
+        self.piece_length = piece_length
+        self.length = 0
+        self.pieces = []
+        self._piece = hashlib.sha1()
+        self._piece_fill = 0
+
+    def update(self, data):
+        pos = 0
+        while pos < len(data):
+            take = min(len(data) - pos, self.piece_length - self._piece_fill)
+            self._piece.update(buffer(data, pos, take))
+            self._piece_fill += take
+            pos += take
+            if self._piece_fill == self.piece_length:
+                self.pieces.append(self._piece.digest())
+                self._piece = hashlib.sha1()
+                self._piece_fill = 0
+        self.length += len(data)
+
+    def torrent(self, mtime=None):
+        if mtime is None:
+            mtime = time.time()
+        pieces = list(self.pieces)
+        if self._piece_fill:
+            pieces.append(self._piece.digest())
+        return {
+            'created by': 'ccas',
+            'creation date': int(mtime),
+            'info': {
+                'name': self.name,
+                'length': self.length,
+                'piece length': self.piece_length,
+                'pieces': ''.join(pieces),
+            },
+        }
+
+    @classmethod
+    def resume(cls, torrent, read_range):
+        ''' carry on from an existing torrent, read_range(offset, length)
+        returns the bytes of a last piece that was not full '''
+        info = torrent['info']
+        builder = cls(info['name'], info['piece length'])
+        length = info['length']
+        tail = length % builder.piece_length
+        pieces = info['pieces']
+        full = (length - tail) // builder.piece_length
+        builder.pieces = [pieces[i * 20:(i + 1) * 20] for i in range(full)]
+        builder.length = length - tail
+        if tail:
+            builder.update(read_range(length - tail, tail))
+        return builder
+
+def update_torrent(torrent, length, dirty, read_range):
+    ''' the torrent of a file after its dirty (start, end) ranges changed and
+    it became length bytes, only the pieces under the ranges are hashed again '''
+    info = torrent['info']
+    piece_length = info['piece length']
+    old = info['pieces']
+    count = (length + piece_length - 1) // piece_length
+    stale = set()
+    for start, end in dirty:
+        stale.update(xrange(min(start, length) // piece_length, min(count, (max(end, start + 1) - 1) // piece_length + 1)))
+    if info['length'] != length and min(info['length'], length) > 0:
+        # the old last piece or the new one is not the same length any more
+        stale.add((min(info['length'], length) - 1) // piece_length)
+    pieces = []
+    for i in xrange(count):
+        if i < len(old) // 20 and i not in stale:
+            pieces.append(old[i * 20:(i + 1) * 20])
+        else:
+            offset = i * piece_length
+            pieces.append(hashlib.sha1(read_range(offset, min(piece_length, length - offset))).digest())
+    updated = dict(torrent)
+    updated['creation date'] = int(time.time())
+    updated['info'] = dict(info, length=length, pieces=''.join(pieces))
+    return updated
+
+def write_torrent(torrent_path, torrent):
     if not os.access(os.path.dirname(torrent_path), os.W_OK):
         os.makedirs(os.path.dirname(torrent_path))
-    with open(torrent_path, 'wb') as f:
-        f.write(libtorrent.bencode(tdata))
+    tmp_path = "%s.%s.tmp" % (torrent_path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_torrent(torrent))
+    os.rename(tmp_path, torrent_path)
     return
 
-def write_torrent(torrent_path, data, tmp_path):
-    tmp_data_path = os.path.join(tmp_path, uuid.uuid4().hex)
-    if not os.access(os.path.dirname(tmp_data_path), os.W_OK):
-        os.makedirs(os.path.dirname(tmp_data_path))
-    with open(tmp_data_path, 'wb') as f:
-        f.write(data)
-    make_torrent(torrent_path, tmp_data_path)
-    #os.remove() #don't clean here, let the caller cleanup
-    return tmp_data_path
-
 def read_torrent(path):
     if os.path.isfile(path):
         with open(path, 'rb') as f:
-            return libtorrent.bdecode(f.read())
+            return decode_torrent(f.read())
+
+def encode_torrent(torrent):
+    return libtorrent.bencode(torrent)
+
+def decode_torrent(data):
+    return libtorrent.bdecode(data)
 
 def main():
     # good idea to test via command line
+    # hash throughput decides the hash_algorithm
     test = hashdata('Test')
     print test
     print hashdepthwidth(test)
+    data = os.urandom(4 * 1024 * 1024)
+    rounds = 16
+    for algorithm in sorted(HASH_ALGORITHMS):
+        start = time.time()
+        for i in range(rounds):
+            hashdata(data, algorithm)
+        elapsed = time.time() - start
+        print "%-8s %7.1f MB/s" % (algorithm, len(data) * rounds / elapsed / 1024 / 1024)
+    for algorithm in ('blake2b', 'blake2s'):
+        if algorithm not in HASH_ALGORITHMS:
+            print "%-8s not available, install pyblake2" % (algorithm)
 
 if __name__ == "__main__":
     main()
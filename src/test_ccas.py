@@ -0,0 +1,173 @@
+'''
+2015 John Ko <git@johnko.ca>
+Tests for CcasClient and CcasMaster on a small store, 16 byte chunks
+mirrored over two disks.
+
+run from src: python -m unittest discover -p 'test_*.py'
+'''
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import ccas
+import ccaserasure
+import ccasscrub
+
+
+def put(model, offset, data):
+    ''' write data into the bytearray model like a file, zeros fill any gap '''
+    model.extend('\x00' * (offset - len(model)))
+    model[offset:offset + len(data)] = data
+
+
+class StoreTest(unittest.TestCase):
+    chunksize = 16
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.master = self.open_master()
+        self.client = ccas.CcasClient(self.master)
+
+    def tearDown(self):
+        self.master.close()
+        shutil.rmtree(self.root)
+
+    def open_master(self, **kwargs):
+        root = self.root
+        return ccas.CcasMaster([os.path.join(root, 'disk%d' % (i)) for i in range(2)], \
+                    os.path.join(root, 'meta', 'manifest'), os.path.join(root, 'meta', 'index'), \
+                    os.path.join(root, 'meta', 'catalog'), os.path.join(root, 'tmp'), chunksize=self.chunksize, **kwargs)
+
+    def assertStored(self, filename, model):
+        self.assertEqual(self.client.getsize(filename), len(model))
+        self.assertEqual(self.client.read_all(filename), str(model))
+
+
+class FileOverlayTest(StoreTest):
+
+    def test_truncate_twice(self):
+        self.client.write('/f', os.urandom(200))
+        overlay = self.client.open_overlay('/f')
+        overlay.truncate(50)
+        overlay.truncate(20)
+        overlay.commit()
+        self.assertEqual(self.client.getsize('/f'), 20)
+
+    def test_write_then_truncate(self):
+        model = bytearray(os.urandom(200))
+        self.client.write('/f', str(model))
+        overlay = self.client.open_overlay('/f')
+        overlay.write(100, 'x' * 50)
+        put(model, 100, 'x' * 50)
+        overlay.truncate(120)
+        del model[120:]
+        overlay.write(150, 'y' * 10)
+        put(model, 150, 'y' * 10)
+        self.assertEqual(overlay.read(0), str(model))
+        overlay.commit()
+        self.assertStored('/f', model)
+
+    def test_against_bytearray(self):
+        rand = random.Random(1)
+        for run in range(50):
+            model = bytearray(os.urandom(rand.randint(0, 100)))
+            self.client.write('/f', str(model))
+            overlay = self.client.open_overlay('/f')
+            for op in range(rand.randint(1, 8)):
+                if rand.random() < 0.5:
+                    offset = rand.randint(0, len(model) + 20)
+                    data = os.urandom(rand.randint(1, 40))
+                    overlay.write(offset, data)
+                    put(model, offset, data)
+                else:
+                    size = rand.randint(0, len(model) + 40)
+                    overlay.truncate(size)
+                    del model[size:]
+                    put(model, size, '')
+                if rand.random() < 0.3:
+                    overlay.commit()
+                self.assertEqual(overlay.read(0), str(model))
+            overlay.commit()
+            self.assertStored('/f', model)
+
+
+
+class ClaimTest(StoreTest):
+
+    def fail_writes(self):
+        for chunkserver in self.master.chunkservers.values():
+            chunkserver.write = lambda *args: None
+
+    def test_failed_chunk_write_releases_its_claim(self):
+        self.fail_writes()
+        self.assertRaises(Exception, self.client.store_chunk, 'x' * 16, self.master.get_chunkservers())
+        self.assertEqual(len(self.master.claimed), 0)
+
+    def test_aborted_writer_releases_every_claim(self):
+        writer = self.client.open_writer('/f')
+        writer.write(os.urandom(100))
+        self.fail_writes()
+        self.assertRaises(Exception, writer.write, os.urandom(100))
+        self.assertTrue(writer.closed)
+        self.assertEqual(len(self.master.claimed), 0)
+        self.assertFalse(self.client.exists('/f'))
+
+
+class KeyLogTest(StoreTest):
+
+    def keys(self, chunkserver):
+        with open(chunkserver.known.log_path, 'r') as f:
+            return f.read().split()
+
+    def test_reclaim_rewrites_the_key_log(self):
+        for i in range(4):
+            self.client.write('/f%d' % (i), os.urandom(64))
+        for i in range(3):
+            self.client.delete('/f%d' % (i))
+        self.master.reclaim()
+        for chunkserver in self.master.chunkservers.values():
+            self.assertEqual(sorted(self.keys(chunkserver)), sorted(chunkserver.iter_chunkuuids()))
+            self.assertEqual(chunkserver.known.bloom.count, 4)
+        self.assertEqual(len(self.client.read_all('/f3')), 64)
+
+    def test_reopen_rebuilds_a_stale_key_log(self):
+        chunkuuids = [self.client.store_chunk(os.urandom(16), self.master.get_chunkservers()) for i in range(4)]
+        self.master.release_chunks(chunkuuids)
+        for chunkuuid in chunkuuids[:2]:
+            for chunkserver in self.master.chunkservers.values():
+                chunkserver.delete(chunkuuid)
+        self.master.close()
+        self.master = self.open_master()
+        for chunkserver in self.master.chunkservers.values():
+            self.assertEqual(sorted(self.keys(chunkserver)), sorted(chunkuuids[2:]))
+            self.assertEqual(chunkserver.known.removed, 0)
+
+
+class ShardMagicTest(StoreTest):
+    chunksize = 64
+
+    def test_mirror_chunk_starting_like_a_shard(self):
+        # the magic alone, then a well formed shard stored as a file's data
+        for data in (ccaserasure.MAGIC + os.urandom(40), ccaserasure.encode(os.urandom(40), 1, 1)[0]):
+            self.client.write('/f', data)
+            self.assertEqual(self.client.read_all('/f'), data)
+            scrubber = ccasscrub.Scrubber(self.master)
+            report = scrubber.scrub()
+            scrubber.close()
+            self.assertEqual(report['corrupt'], 0)
+
+    def test_erasure_store_reads_whole_chunks_starting_like_a_shard(self):
+        data = ccaserasure.MAGIC + os.urandom(40)
+        self.client.write('/whole', data)
+        self.master.close()
+        # the same disks erasure coded from now on, one data and one parity shard each
+        self.master = self.open_master(write_algorithm='erasure', data_shards=1, parity_shards=1)
+        self.client = ccas.CcasClient(self.master)
+        self.client.write('/sharded', data[::-1])
+        self.assertEqual(self.client.read_all('/whole'), data)
+        self.assertEqual(self.client.read_all('/sharded'), data[::-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+'''
+2015 John Ko <git@johnko.ca>
+Tests for _CCASFile, each file mode against a bytearray of what the file
+should hold. Chunks are 16 bytes so writes and truncates span several.
+
+run from src: python -m unittest discover -p 'test_*.py'
+'''
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import ccas
+import ccasfile
+
+
+def put(model, offset, data):
+    ''' write data into the bytearray model like a file, zeros fill any gap '''
+    model.extend('\x00' * (offset - len(model)))
+    model[offset:offset + len(data)] = data
+
+
+class CCASFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        root = self.root
+        self.master = ccas.CcasMaster([os.path.join(root, 'disk%d' % (i)) for i in range(2)], \
+                    os.path.join(root, 'meta', 'manifest'), os.path.join(root, 'meta', 'index'), \
+                    os.path.join(root, 'meta', 'catalog'), os.path.join(root, 'tmp'), chunksize=16)
+        self.client = ccas.CcasClient(self.master)
+        self.data = os.urandom(200)
+        self.client.write('/f', self.data)
+
+    def tearDown(self):
+        self.master.close()
+        shutil.rmtree(self.root)
+
+    def open(self, mode, write_on_flush=True):
+        return ccasfile._CCASFile(None, '/f', mode, self.client, lambda filename: None, write_on_flush=write_on_flush)
+
+    def assertStored(self, model):
+        self.assertEqual(self.client.getsize('/f'), len(model))
+        self.assertEqual(self.client.read_all('/f'), str(model))
+
+    def test_write_then_truncate_in_one_flush(self):
+        for mode in ('r+', 'a'):
+            self.client.write('/f', self.data)
+            model = bytearray(self.data)
+            f = self.open(mode, write_on_flush=False)
+            offset = len(model) if 'a' in mode else 100
+            f.seek(offset)
+            f.write('x' * 50)
+            put(model, offset, 'x' * 50)
+            f.truncate(offset + 20)
+            del model[offset + 20:]
+            f.close()
+            self.assertStored(model)
+
+    def test_truncate_twice_in_one_flush(self):
+        for mode in ('r+', 'a'):
+            self.client.write('/f', self.data)
+            f = self.open(mode, write_on_flush=False)
+            f.truncate(50)
+            f.truncate(20)
+            f.close()
+            self.assertStored(self.data[:20])
+
+    def test_truncate_grow_in_one_flush(self):
+        for mode in ('r+', 'a'):
+            self.client.write('/f', self.data)
+            model = bytearray(self.data)
+            f = self.open(mode, write_on_flush=False)
+            f.truncate(40)
+            f.truncate(100)
+            del model[40:]
+            put(model, 100, '')
+            f.seek(90)
+            f.write('y' * 30)
+            put(model, 90, 'y' * 30)
+            f.close()
+            self.assertStored(model)
+
+    def run_ops(self, mode, rand, ops=8):
+        ''' random writes, seeks, truncates and reads on a file opened in mode,
+        each checked against a bytearray model, then what is stored '''
+        old = os.urandom(rand.randint(0, 100))
+        self.client.write('/f', old)
+        model = bytearray('' if 'w' in mode else old)
+        f = self.open(mode, write_on_flush=rand.random() < 0.5)
+        pos = len(model) if 'a' in mode else 0
+        for op in range(ops):
+            r = rand.random()
+            if r < 0.45:
+                data = os.urandom(rand.randint(1, 40))
+                f.write(data)
+                put(model, pos, data)
+                pos += len(data)
+            elif r < 0.65 and 'a' not in mode:
+                pos = rand.randint(0, len(model) + 20)
+                f.seek(pos)
+            elif r < 0.8:
+                size = rand.randint(0, len(model) + 40)
+                f.truncate(size)
+                del model[size:]
+                put(model, size, '')
+                pos = min(pos, size)
+                if 'a' in mode:
+                    pos = len(model)
+                    f.seek(0, 2)
+            elif '+' in mode:
+                n = rand.randint(1, 40)
+                self.assertEqual(f.read(n), str(model[pos:pos + n]))
+                pos = min(pos + n, max(pos, len(model)))
+            self.assertEqual(f.tell(), pos)
+        f.close()
+        self.assertStored(model)
+
+    def test_write_only(self):
+        rand = random.Random(1)
+        for run in range(50):
+            self.run_ops('w', rand)
+
+    def test_read_write(self):
+        rand = random.Random(2)
+        for run in range(50):
+            self.run_ops('r+', rand)
+
+    def test_append(self):
+        rand = random.Random(3)
+        for run in range(50):
+            self.run_ops('a', rand)
+
+    def test_write_read_over_an_existing_file(self):
+        rand = random.Random(4)
+        for run in range(50):
+            self.run_ops('w+', rand)
+
+    def test_sequential_write_only(self):
+        # stays on the streaming writer, no seek or truncate to leave it
+        model = bytearray()
+        f = self.open('w')
+        for i in range(10):
+            data = os.urandom(i * 7)
+            f.write(data)
+            model.extend(data)
+        self.assertTrue(f._writer is not None)
+        f.close()
+        self.assertStored(model)
+
+    def test_seek_and_truncate_after_streamed_writes(self):
+        model = bytearray(os.urandom(100))
+        f = self.open('w')
+        f.write(str(model))
+        f.seek(30)
+        self.assertTrue(f._writer is None)
+        f.write('x' * 10)
+        put(model, 30, 'x' * 10)
+        f.truncate(70)
+        del model[70:]
+        f.close()
+        self.assertStored(model)
+
+    def test_aborted_write_keeps_the_old_file(self):
+        f = self.open('w')
+        f.write(os.urandom(100))
+        for chunkserver in self.master.chunkservers.values():
+            chunkserver.write = lambda *args: None
+        self.assertRaises(Exception, f.write, os.urandom(100))
+        f.close()
+        self.assertStored(self.data)
+        self.assertEqual(len(self.master.claimed), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
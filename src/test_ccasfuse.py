@@ -0,0 +1,65 @@
+'''
+2015 John Ko <git@johnko.ca>
+Tests for CcasFuse opens, whether the kernel may keep a file's pages.
+
+run from src: python -m unittest discover -p 'test_*.py'
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import ccas
+import ccasfuse
+
+
+class _Store(object):
+    ''' the one part of a CCASFS a read-only open uses '''
+    def __init__(self, client):
+        self.ccasclient = client
+
+
+class _Info(object):
+    def __init__(self, flags=os.O_RDONLY):
+        self.flags = flags
+        self.fh = None
+        self.keep_cache = 0
+
+
+class KeepCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        root = self.root
+        self.master = ccas.CcasMaster([os.path.join(root, 'disk%d' % (i)) for i in range(2)], \
+                    os.path.join(root, 'meta', 'manifest'), os.path.join(root, 'meta', 'index'), \
+                    os.path.join(root, 'meta', 'catalog'), os.path.join(root, 'tmp'), chunksize=16)
+        self.client = ccas.CcasClient(self.master)
+        self.fuse = ccasfuse.CcasFuse(_Store(self.client))
+
+    def tearDown(self):
+        for fh in list(self.fuse.handles):
+            self.fuse.handles.pop(fh).close()
+        self.master.close()
+        shutil.rmtree(self.root)
+
+    def keep_cache(self):
+        fi = _Info()
+        self.fuse.open('/f', fi)
+        return fi.keep_cache
+
+    def test_unchanged_file_keeps_its_pages(self):
+        self.client.write('/f', os.urandom(100))
+        self.assertEqual(self.keep_cache(), 0)
+        self.assertEqual(self.keep_cache(), 1)
+
+    def test_same_size_rewrite_drops_its_pages(self):
+        self.client.write('/f', os.urandom(100))
+        self.assertEqual(self.keep_cache(), 0)
+        # another client, within the same second, the size and mtime can match
+        self.client.write('/f', os.urandom(100))
+        self.assertEqual(self.keep_cache(), 0)
+        self.assertEqual(self.keep_cache(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
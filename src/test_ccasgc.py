@@ -0,0 +1,75 @@
+'''
+2015 John Ko <git@johnko.ca>
+Tests for GarbageCollector on a small store, 16 byte chunks mirrored over
+two disks.
+
+run from src: python -m unittest discover -p 'test_*.py'
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import ccas
+import ccasgc
+
+
+class GarbageCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        root = self.root
+        self.master = ccas.CcasMaster([os.path.join(root, 'disk%d' % (i)) for i in range(2)], \
+                    os.path.join(root, 'meta', 'manifest'), os.path.join(root, 'meta', 'index'), \
+                    os.path.join(root, 'meta', 'catalog'), os.path.join(root, 'tmp'), chunksize=16)
+        self.client = ccas.CcasClient(self.master)
+
+    def tearDown(self):
+        self.master.close()
+        shutil.rmtree(self.root)
+
+    def stored(self, chunkuuid):
+        return [loc for loc in self.master.chunkservers if self.master.chunkservers[loc].read(chunkuuid) is not None]
+
+    def test_leaked_count_is_collected(self):
+        data = os.urandom(64)
+        self.client.write('/f', data)
+        # a writer that counted its chunks and crashed before the manifest
+        leaked = self.client.store_chunk(os.urandom(16), self.master.get_chunkservers())
+        self.master.refs.adjust(increments=[leaked])
+        self.master.release_chunks([leaked])
+        report = ccasgc.GarbageCollector(self.master).collect()
+        self.assertEqual(report['leaked'], 1)
+        self.assertEqual(report['garbage'], 2)
+        self.assertEqual(self.stored(leaked), [])
+        self.assertEqual(self.master.refs.count(leaked), 0)
+        self.assertEqual(self.client.read_all('/f'), data)
+
+    def test_claimed_chunk_is_kept(self):
+        chunkuuid = self.client.store_chunk(os.urandom(16), self.master.get_chunkservers())
+        report = ccasgc.GarbageCollector(self.master).collect()
+        self.assertEqual(report['garbage'], 0)
+        self.assertEqual(len(self.stored(chunkuuid)), 2)
+        self.master.release_chunks([chunkuuid])
+        report = ccasgc.GarbageCollector(self.master).collect()
+        self.assertEqual(report['garbage'], 2)
+        self.assertEqual(self.stored(chunkuuid), [])
+
+    def test_file_allocated_during_the_sweep_is_kept(self):
+        gc = ccasgc.GarbageCollector(self.master)
+        gc.start()
+        gc.mark()
+        # written after the sweep has read the recent manifests
+        gc.mark_recent = lambda: gc._write_run('recent', set())
+        time.sleep(0.1) # file mtimes are coarser than time.time()
+        data = os.urandom(64)
+        self.client.write('/late', data)
+        self.assertTrue(gc.sweep())
+        report = gc.finish()
+        self.assertEqual(report['garbage'], 0)
+        self.assertEqual(report['leaked'], 0)
+        self.assertEqual(self.client.read_all('/late'), data)
+
+
+if __name__ == "__main__":
+    unittest.main()